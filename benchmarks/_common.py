@@ -0,0 +1,76 @@
+"""
+Shared helpers for the benchmark scripts in this directory.
+
+Scripts are run from the repo root, e.g. `python benchmarks/connect_bench.py`,
+and import the service modules from src/ the same way server.py does.
+"""
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+from flask import Config  # noqa: E402
+
+
+def load_config(path=None):
+    """
+    Builds a config from a pyfile (like instance/.env.py) and BENCH_* env vars,
+    e.g. BENCH_LOCAL_DB_USER=postgres sets LOCAL_DB_USER.
+    """
+    config = Config(os.getcwd())
+    if path:
+        config.from_pyfile(os.path.abspath(path))
+    config.from_prefixed_env('BENCH')
+    return config
+
+
+def summarize(samples):
+    """
+    Latency summary in milliseconds for a list of durations in seconds.
+    """
+    if not samples:
+        return {'n': 0}
+    ms = sorted(s * 1000 for s in samples)
+
+    def pct(p):
+        return round(ms[min(len(ms) - 1, int(round(p / 100 * (len(ms) - 1))))], 3)
+
+    return {
+        'n': len(ms),
+        'mean_ms': round(statistics.fmean(ms), 3),
+        'p50_ms': pct(50),
+        'p95_ms': pct(95),
+        'p99_ms': pct(99),
+        'max_ms': round(ms[-1], 3),
+    }
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def environment():
+    """
+    Where a result was measured; compare.py warns when two results differ here.
+    """
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()}
+
+
+def report(name, results, output=None):
+    """
+    Prints results and, if `output` is given, writes them as JSON.
+    """
+    payload = {'benchmark': name, 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'environment': environment(), 'results': results}
+    print(json.dumps(payload, indent=2))
+    if output:
+        with open(output, 'w') as f:
+            json.dump(payload, f, indent=2)
@@ -0,0 +1,93 @@
+"""
+Compares a benchmark result with a baseline and lists what got worse:
+
+    python benchmarks/micro_bench.py --output /tmp/micro.json
+    python benchmarks/compare.py benchmarks/baselines/micro.json /tmp/micro.json
+
+Any of the scripts' --output files can be compared with one from the same
+script run with the same options (a shorter load run, for one, has a colder
+user cache). Latencies (*_ms, *_us, *_s) and DB round trips count as worse when
+they go up, *_rps when it goes down; counts and maxima are ignored. Exits 1
+if anything regressed by more than --threshold, so it can gate CI.
+"""
+import argparse
+import json
+import sys
+
+LOWER_IS_BETTER = ('_ms', '_us', '_s')
+HIGHER_IS_BETTER = ('_rps',)
+IGNORED = ('max_ms', 'elapsed_s', 'build_s')
+
+
+def flatten(results, prefix=''):
+    """
+    {'a': {'p50_ms': 1}} -> {'a.p50_ms': 1}, numeric leaves only.
+    """
+    flat = {}
+    for key, value in results.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, path + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[path] = value
+    return flat
+
+
+def direction(path):
+    """
+    1 if higher is worse, -1 if lower is worse, None if not compared.
+    """
+    name = path.rsplit('.', 1)[-1]
+    if name in IGNORED:
+        return None
+    if '.db_round_trips_per_request.' in f".{path}" or name.endswith(LOWER_IS_BETTER):
+        return 1
+    if name.endswith(HIGHER_IS_BETTER):
+        return -1
+    return None
+
+
+def compare(baseline, current):
+    """
+    (path, baseline, current, change) for every compared value, worst first;
+    change is the relative change, positive meaning worse.
+    """
+    old, new = flatten(baseline['results']), flatten(current['results'])
+    changes = []
+    for path in sorted(old.keys() & new.keys()):
+        sign = direction(path)
+        if sign is None or old[path] == 0:
+            continue
+        changes.append((path, old[path], new[path], sign * (new[path] - old[path]) / old[path]))
+    return sorted(changes, key=lambda change: -change[3])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('baseline', help='baseline JSON, e.g. benchmarks/baselines/load.json')
+    parser.add_argument('current', help='JSON written by the same script with --output')
+    parser.add_argument('--threshold', type=float, default=0.2, help='relative change that counts as a regression')
+    parser.add_argument('--all', action='store_true', help='list every compared value, not just regressions')
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    if baseline['benchmark'] != current['benchmark']:
+        raise SystemExit(f"Cannot compare '{baseline['benchmark']}' with '{current['benchmark']}' results")
+    if baseline.get('environment') != current.get('environment'):
+        print(f"warning: measured on different machines: {baseline.get('environment')} vs "
+              f"{current.get('environment')}", file=sys.stderr)
+
+    changes = compare(baseline, current)
+    regressions = [change for change in changes if change[3] > args.threshold]
+    for path, old, new, change in (changes if args.all else regressions):
+        flag = 'REGRESSED' if change > args.threshold else ''
+        print(f"{path:60} {old:>12} -> {new:<12} {change:+7.1%} {flag}")
+    print(f"{len(regressions)} of {len(changes)} values regressed by more than {args.threshold:.0%}")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Cold-start vs steady-state connect time for a DB connector.
+
+    python benchmarks/connect_bench.py --config instance/.env.py --connector cloud-sql
+    BENCH_LOCAL_DB_USER=postgres BENCH_LOCAL_DB_PASS= BENCH_LOCAL_DB_NAME=postgres \\
+        python benchmarks/connect_bench.py --connector local
+
+"shared" reuses one connector for every connection, as the service does now.
+"per-connection" builds a new connector for each one, as it did before.
+"""
+import argparse
+
+from _common import load_config, report, summarize, timed
+
+from user.connectors import load_connector_class
+
+
+def run_shared(connector_class, config, n):
+    connector = connector_class(config)
+    try:
+        cold, conn = timed(connector.connect)
+        conn.close()
+        steady = []
+        for _ in range(n):
+            seconds, conn = timed(connector.connect)
+            conn.close()
+            steady.append(seconds)
+    finally:
+        connector.close()
+    return {'cold_ms': round(cold * 1000, 3), 'steady': summarize(steady)}
+
+
+def run_per_connection(connector_class, config, n):
+    samples = []
+    for _ in range(n):
+        def connect():
+            connector = connector_class(config)
+            try:
+                return connector.connect()
+            finally:
+                connector.close()
+        seconds, conn = timed(connect)
+        conn.close()
+        samples.append(seconds)
+    return {'steady': summarize(samples)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', help='pyfile with DB settings, e.g. instance/.env.py')
+    parser.add_argument('--connector', default=None, help="'local', 'cloud-sql' or module:Class")
+    parser.add_argument('-n', type=int, default=20, help='connections per mode')
+    parser.add_argument('--output', help='write JSON results here')
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    name = args.connector or config.get('DB_CONNECTOR', 'cloud-sql')
+    connector_class = load_connector_class(name)
+
+    report('connect', {
+        'connector': name,
+        'shared': run_shared(connector_class, config, args.n),
+        'per_connection': run_per_connection(connector_class, config, args.n),
+    }, args.output)
+
+
+if __name__ == '__main__':
+    main()
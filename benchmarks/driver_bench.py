@@ -0,0 +1,73 @@
+"""
+Per-query latency of the DAO's hot queries for each DBAPI driver, with and
+without server-side prepared statements (DB_DRIVER, DB_PREPARED_STATEMENTS).
+
+    BENCH_LOCAL_DB_USER=postgres BENCH_LOCAL_DB_PASS= BENCH_LOCAL_DB_NAME=postgres \\
+        python benchmarks/driver_bench.py -n 2000
+
+Needs a local Postgres with at least 50 users. Drivers that are not installed
+are skipped. Every variant uses one pooled connection, so the first
+execution of each statement (which prepares it) is left out as warm-up.
+"""
+import argparse
+import importlib.util
+
+import sqlalchemy
+
+from _common import load_config, report, summarize, timed
+
+from resources.user_dao import GET_ACCOUNT_BY_ID, GET_LOGIN_BY_EMAIL, GET_PROFILES_BY_IDS
+from user.connectors import LocalConnector
+from user.db import DRIVERS, build_engine
+
+
+def measure(connection, query, params, n):
+    for _ in range(min(n, 50)):
+        query.execute(connection, params).fetchall()
+        connection.commit()
+    samples = []
+    for _ in range(n):
+        elapsed, _rows = timed(lambda: query.execute(connection, params).fetchall())
+        connection.commit()
+        samples.append(elapsed)
+    return summarize(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', help='pyfile with DB settings, e.g. instance/.env.py')
+    parser.add_argument('--drivers', default=','.join(DRIVERS), help='comma-separated drivers to compare')
+    parser.add_argument('-n', type=int, default=2000, help='executions per query and variant')
+    parser.add_argument('--output', help='write JSON results here')
+    args = parser.parse_args()
+
+    results = {}
+    for driver in args.drivers.split(','):
+        if importlib.util.find_spec(driver) is None:
+            results[driver] = 'not installed'
+            continue
+        for prepared in (False, True):
+            config = load_config(args.config)
+            config.update(DB_DRIVER=driver, DB_PREPARED_STATEMENTS=prepared, DB_POOL_SIZE=1, DB_MAX_OVERFLOW=0)
+            connector = LocalConnector(config)
+            engine = build_engine(config, connector.connect)
+            try:
+                with engine.connect() as connection:
+                    rows = connection.execute(sqlalchemy.text(
+                        "SELECT id, email FROM users ORDER BY id LIMIT 50;")).fetchall()
+                    connection.commit()
+                    ids = [row.id for row in rows]
+                    results[f"{driver}/{'prepared' if prepared else 'plain'}"] = {
+                        'account_by_id': measure(connection, GET_ACCOUNT_BY_ID, {'id': ids[0]}, args.n),
+                        'login_by_email': measure(connection, GET_LOGIN_BY_EMAIL, {'email': rows[0].email}, args.n),
+                        'profiles_by_ids': measure(connection, GET_PROFILES_BY_IDS,
+                                                   {'ids': ids, 'emails': []}, args.n),
+                    }
+            finally:
+                engine.dispose()
+                connector.close()
+    report('driver', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
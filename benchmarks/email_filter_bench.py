@@ -0,0 +1,74 @@
+"""
+Memory, lookup time and false-positive rate of the known-email filter
+(resources.email_filter.BloomFilter), against a plain set of the same emails.
+
+    python benchmarks/email_filter_bench.py --sizes 10000,100000,1000000
+
+Emails are synthetic, so no database is needed. The filter is sized like a
+rebuild sizes it for a table of that many users. "measured_fp_rate" tests
+--probes emails that were never added; "estimated_fp_rate" is what
+GET /email-filter reports for the same filter.
+"""
+import argparse
+import sys
+import time
+
+from _common import report
+
+from resources.email_filter import EMAIL_FILTER_DEFAULTS, KnownEmails
+
+
+def set_bytes(emails):
+    return sys.getsizeof(emails) + sum(sys.getsizeof(email) for email in emails)
+
+
+def per_call_us(fn, items):
+    start = time.perf_counter()
+    for item in items:
+        fn(item)
+    return round((time.perf_counter() - start) / len(items) * 1e6, 3)
+
+
+def measure(size, error_rate, probes):
+    emails = [f"user{i}@example{i % 97}.com" for i in range(size)]
+    absent = [f"nobody{i}@example{i % 89}.org" for i in range(probes)]
+    known = KnownEmails(error_rate, EMAIL_FILTER_DEFAULTS['EMAIL_FILTER_SYNC_INTERVAL'],
+                        EMAIL_FILTER_DEFAULTS['EMAIL_FILTER_REBUILD_INTERVAL'])
+    bloom = known.new_filter(size)
+
+    start = time.perf_counter()
+    for email in emails:
+        bloom.add(email)
+    build = time.perf_counter() - start
+
+    as_set = set(emails)
+    return {
+        'bloom': dict(
+            bloom.stats(),
+            build_s=round(build, 3),
+            lookup_us=per_call_us(bloom.__contains__, absent[:10000]),
+            measured_fp_rate=round(sum(email in bloom for email in absent) / probes, 6),
+        ),
+        'set': {
+            'memory_bytes': set_bytes(as_set),
+            'lookup_us': per_call_us(as_set.__contains__, absent[:10000]),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='10000,100000,1000000', help='comma-separated user counts')
+    parser.add_argument('--error-rate', type=float, default=EMAIL_FILTER_DEFAULTS['EMAIL_FILTER_ERROR_RATE'])
+    parser.add_argument('--probes', type=int, default=200000, help='absent emails tested per size')
+    parser.add_argument('--output', help='write JSON results here')
+    args = parser.parse_args()
+
+    results = {'error_rate': args.error_rate}
+    for size in (int(s) for s in args.sizes.split(',')):
+        results[size] = measure(size, args.error_rate, args.probes)
+    report('email_filter', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+"""
+Stand-in for Google's OAuth endpoints, so the Google sign-in flow can be
+load-tested without network access:
+
+    python benchmarks/fake_oauth.py --port 9099
+
+then start the service with the environment it prints (GOOGLE_AUTHORIZE_URL
+and friends, see controller.endpoints.google_oauth_settings).
+
+The authorize endpoint signs in whoever `login_hint` names: it redirects back
+with a code that encodes the email, and the token endpoint turns the code
+into an access token and an RS256 ID token for it, issued as Google's. The
+signing keys are served from /certs with a Cache-Control max-age
+(--jwks-max-age); `FakeOAuthProvider.rotate_key()` starts signing with a new
+key, publishing it next to the previous one as Google does. Request counts
+per endpoint are kept in `requests`.
+"""
+import argparse
+import base64
+import collections
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+ISSUER = 'https://accounts.google.com'
+
+
+def encode_code(grant):
+    return base64.urlsafe_b64encode(json.dumps(grant).encode('utf-8')).decode('ascii')
+
+
+def decode_code(code):
+    return json.loads(base64.urlsafe_b64decode(code.encode('ascii')))
+
+
+def profile(email):
+    name = email.split('@')[0]
+    return {'email': email, 'email_verified': True, 'given_name': name, 'family_name': 'Sso',
+            'name': f"{name} Sso"}
+
+
+class SigningKeys:
+    """
+    The current RSA signing key and the one before it.
+    """
+
+    def __init__(self):
+        self.keys = []
+        self.rotate()
+
+    def rotate(self):
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.keys = [(uuid.uuid4().hex, key)] + self.keys[:1]
+
+    def sign(self, claims):
+        kid, key = self.keys[0]
+        return jwt.encode(claims, key, algorithm='RS256', headers={'kid': kid})
+
+    def jwk_set(self):
+        keys = []
+        for kid, key in self.keys:
+            jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(key.public_key()))
+            keys.append(dict(jwk, kid=kid, alg='RS256', use='sig'))
+        return {'keys': keys}
+
+
+class FakeOAuthHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload, status=200, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        self.server.requests[url.path] += 1
+        if url.path == '/authorize':
+            grant = {'email': query.get('login_hint', 'sso-user@example.com'), 'client_id': query.get('client_id'),
+                     'nonce': query.get('nonce'), 'openid': 'openid' in query.get('scope', '').split()}
+            location = query['redirect_uri'] + '?' + urlencode({'code': encode_code(grant),
+                                                                'state': query.get('state', '')})
+            self.send_response(302)
+            self.send_header('Location', location)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif url.path == '/certs':
+            self.send_json(self.server.keys.jwk_set(),
+                           headers={'Cache-Control': f"public, max-age={self.server.jwks_max_age}"})
+        elif url.path == '/userinfo':
+            token = self.headers.get('Authorization', '').removeprefix('Bearer ')
+            try:
+                email = decode_code(token)['email']
+            except ValueError:
+                return self.send_json({'error': 'invalid_token'}, 401)
+            self.send_json(profile(email))
+        else:
+            self.send_json({'error': 'not_found'}, 404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length', 0))
+        form = {key: values[0] for key, values in parse_qs(self.rfile.read(length).decode('utf-8')).items()}
+        self.server.requests[url.path] += 1
+        if url.path != '/token' or 'code' not in form:
+            return self.send_json({'error': 'invalid_request'}, 400)
+        grant = decode_code(form['code'])
+        token = {'access_token': form['code'], 'token_type': 'Bearer', 'expires_in': 3600}
+        if grant['openid']:
+            now = int(time.time())
+            claims = dict(profile(grant['email']), iss=ISSUER, aud=grant['client_id'], sub=grant['email'],
+                          iat=now, exp=now + 3600)
+            if grant['nonce']:
+                claims['nonce'] = grant['nonce']
+            token['id_token'] = self.server.keys.sign(claims)
+        self.send_json(token)
+
+
+class FakeOAuthProvider:
+    """
+    The fake provider on a background thread; `env()` is the environment
+    that points the service at it.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, jwks_max_age=3600):
+        self.server = ThreadingHTTPServer((host, port), FakeOAuthHandler)
+        self.server.daemon_threads = True
+        self.server.keys = SigningKeys()
+        self.server.jwks_max_age = jwks_max_age
+        self.server.requests = collections.Counter()
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def env(self):
+        return {
+            'GOOGLE_CLIENT_ID': 'bench-client',
+            'GOOGLE_CLIENT_SECRET': 'bench-secret',
+            'GOOGLE_AUTHORIZE_URL': f"{self.url}/authorize",
+            'GOOGLE_ACCESS_TOKEN_URL': f"{self.url}/token",
+            'GOOGLE_API_BASE_URL': f"{self.url}/",
+            'GOOGLE_JWKS_URI': f"{self.url}/certs",
+        }
+
+    @property
+    def requests(self):
+        return self.server.requests
+
+    def rotate_key(self):
+        self.server.keys.rotate()
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9099)
+    parser.add_argument('--jwks-max-age', type=int, default=3600, help='Cache-Control max-age of /certs')
+    args = parser.parse_args()
+
+    provider = FakeOAuthProvider(args.host, args.port, args.jwks_max_age)
+    for key, value in provider.env().items():
+        print(f"export {key}={value}")
+    try:
+        provider.server.serve_forever()
+    except KeyboardInterrupt:
+        provider.server.server_close()
+
+
+if __name__ == '__main__':
+    main()
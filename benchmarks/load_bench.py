@@ -0,0 +1,354 @@
+"""
+End-to-end load test: a weighted mix of register, login, profile read,
+update and delete requests at a fixed concurrency, against a running
+service or one this script starts under gunicorn.
+
+    python benchmarks/load_bench.py --workers 2 --concurrency 8 --duration 30
+    python benchmarks/load_bench.py --asgi --mix login=50,get=50
+    python benchmarks/load_bench.py --url http://localhost:9090 -n 5000 --service-token "$TOKEN"
+
+Without --url the service is started with gunicorn.conf.py on a free port,
+with its own config (src/instance), PROMETHEUS_MULTIPROC_DIR set so /metrics
+covers every worker, and the Google endpoints pointed at fake_oauth.py. The
+"google" op runs the whole sign-in redirect flow for a new email each time.
+
+--users accounts are registered first (not measured); login, get and update
+pick among them, and delete removes accounts registered during the run, so
+the table ends up as it started. refresh renews the session of an account
+registered during the run (give register or google some weight too). Results give throughput, latency
+percentiles and errors per op, plus the database round trips per request of
+each endpoint, from the user_service_request_db_round_trips histogram
+(/metrics needs --service-token, one of the service's SERVICE_TOKENS). The
+client runs on the same machine as the service, so compare runs from the
+same host only.
+"""
+import argparse
+import collections
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from urllib.parse import urlencode
+
+import httpx
+from prometheus_client.parser import text_string_to_metric_families
+
+from _common import report, summarize
+from fake_oauth import FakeOAuthProvider
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_MIX = 'login=30,get=40,update=15,register=10,delete=5,refresh=0,google=0'
+PASSWORD = 'bench-password'
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        op, _, weight = part.partition('=')
+        if op not in OPS:
+            raise SystemExit(f"Unknown op '{op}'; choose from {', '.join(OPS)}")
+        mix[op] = float(weight)
+    return {op: weight for op, weight in mix.items() if weight > 0}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(args, workdir, oauth):
+    """
+    Starts gunicorn with gunicorn.conf.py and waits until it answers.
+    """
+    port = free_port()
+    env = dict(os.environ, PORT=str(port), GUNICORN_WORKERS=str(args.workers),
+               GUNICORN_ACCESSLOG='/dev/null', PROMETHEUS_MULTIPROC_DIR=workdir,
+               # Refresh tokens and profile versions per worker; no Redis needed
+               ALLOW_PER_WORKER_STATE='1', **oauth.env())
+    if args.asgi:
+        env.update(GUNICORN_APP='asgi:app', GUNICORN_WORKER_CLASS='uvicorn.workers.UvicornWorker')
+    log = open(os.path.join(workdir, 'server.log'), 'w')
+    process = subprocess.Popen([sys.executable, '-m', 'gunicorn', '--config', 'gunicorn.conf.py'],
+                               cwd=REPO_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+    url = f"http://127.0.0.1:{port}"
+    ready_path = '/' if args.asgi else '/ready'
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"Server exited; see {log.name}")
+        try:
+            # Every worker has to be up, not just the first to answer
+            if all(httpx.get(url + ready_path).status_code == 200 for _ in range(args.workers * 2)):
+                return process, url
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise SystemExit(f"Server not ready after 60s; see {log.name}")
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def round_trips(url, service_token):
+    """
+    (sum, count) of the DB round-trips histogram per endpoint; empty if
+    /metrics refuses the service token.
+    """
+    totals = collections.defaultdict(lambda: [0.0, 0.0])
+    response = httpx.get(url + '/metrics', headers={'X-Service-Token': service_token or ''})
+    if response.status_code != 200:
+        print(f"/metrics answered {response.status_code}; pass --service-token for round trips", file=sys.stderr)
+        return totals
+    for family in text_string_to_metric_families(response.text):
+        if family.name != 'user_service_request_db_round_trips':
+            continue
+        for sample in family.samples:
+            if sample.name.endswith('_sum'):
+                totals[sample.labels['endpoint']][0] += sample.value
+            elif sample.name.endswith('_count'):
+                totals[sample.labels['endpoint']][1] += sample.value
+    return totals
+
+
+def round_trips_per_request(before, after):
+    per_request = {}
+    for endpoint, (total, count) in sorted(after.items()):
+        total -= before.get(endpoint, (0, 0))[0]
+        count -= before.get(endpoint, (0, 0))[1]
+        if count:
+            per_request[endpoint] = round(total / count, 2)
+    return per_request
+
+
+def new_account(tag):
+    name = f"bench-{tag}-{uuid.uuid4().hex[:12]}"
+    return {'username': name, 'email': f"{name}@example.com", 'first_name': 'Bench',
+            'last_name': 'User', 'password': PASSWORD}
+
+
+def bearer(account):
+    return {'Authorization': f"Bearer {account['token']}"}
+
+
+class Run:
+    """
+    Accounts shared by the client threads: `seeded` for login, get and
+    update, `fresh` (registered during the run) for delete and refresh.
+    """
+
+    def __init__(self, seeded):
+        self.seeded = seeded
+        self.fresh = collections.deque()
+        self.lock = threading.Lock()
+
+    def add_fresh(self, account):
+        with self.lock:
+            self.fresh.append(account)
+
+    def take_fresh(self):
+        with self.lock:
+            return self.fresh.popleft() if self.fresh else None
+
+
+def register(client, account):
+    response = client.post('/api/user/register', json=account)
+    if response.status_code == 201:
+        account['token'] = response.json()['auth_token']
+        account['refresh_token'] = response.json()['refresh_token']
+    return response
+
+
+def op_register(client, run, rng):
+    account = new_account('run')
+    response = register(client, account)
+    if response.status_code == 201:
+        run.add_fresh(account)
+    return response
+
+
+def op_login(client, run, rng):
+    account = rng.choice(run.seeded)
+    return client.post('/api/user/login', json={'email': account['email'], 'password': PASSWORD})
+
+
+def op_get(client, run, rng):
+    return client.get('/api/user/', headers=bearer(rng.choice(run.seeded)))
+
+
+def op_update(client, run, rng):
+    return client.put('/api/user/update', headers=bearer(rng.choice(run.seeded)),
+                      json={'first_name': f"Bench{rng.randrange(1000)}"})
+
+
+def op_delete(client, run, rng):
+    account = run.take_fresh()
+    if account is None:
+        return None
+    return client.delete('/api/user/delete', headers=bearer(account))
+
+
+def op_refresh(client, run, rng):
+    # A refresh token works once, so each account is held by one thread at a time
+    account = run.take_fresh()
+    if account is None:
+        return None
+    response = client.post('/api/user/refresh', headers={'Authorization': f"Bearer {account['refresh_token']}"})
+    if response.status_code == 200:
+        account['token'] = response.json()['auth_token']
+        account['refresh_token'] = response.json()['refresh_token']
+        run.add_fresh(account)
+    return response
+
+
+def op_google(client, run, rng):
+    account = new_account('sso')
+    start = client.get('/api/user/login/google')
+    if start.status_code != 302:
+        return start
+    # The fake provider signs in whoever login_hint names
+    provider = httpx.get(start.headers['Location'] + '&' + urlencode({'login_hint': account['email']}))
+    response = client.get(provider.headers['Location'])
+    if response.status_code == 200:
+        account['token'] = response.json().get('auth_token')
+        account['refresh_token'] = response.json().get('refresh_token')
+        run.add_fresh(account)
+    return response
+
+
+OPS = {'register': op_register, 'login': op_login, 'get': op_get, 'update': op_update,
+       'delete': op_delete, 'refresh': op_refresh, 'google': op_google}
+
+
+def client_loop(url, run, mix, rng, stop, budget, samples, errors):
+    ops, weights = list(mix), list(mix.values())
+    with httpx.Client(base_url=url, timeout=30) as client:
+        while not stop.is_set():
+            if budget is not None:
+                with budget['lock']:
+                    if budget['left'] <= 0:
+                        return
+                    budget['left'] -= 1
+            op = rng.choices(ops, weights)[0]
+            start = time.perf_counter()
+            try:
+                response = OPS[op](client, run, rng)
+            except httpx.HTTPError as e:
+                errors[op][type(e).__name__] += 1
+                continue
+            elapsed = time.perf_counter() - start
+            if response is None:
+                continue
+            if response.status_code < 400:
+                samples[op].append(elapsed)
+            else:
+                errors[op][str(response.status_code)] += 1
+
+
+def seed_accounts(url, count, concurrency):
+    accounts = [new_account('seed') for _ in range(count)]
+
+    def work(chunk):
+        with httpx.Client(base_url=url, timeout=30) as client:
+            for account in chunk:
+                response = register(client, account)
+                if response.status_code != 201:
+                    raise SystemExit(f"Seeding failed: {response.status_code} {response.text}")
+
+    threads = [threading.Thread(target=work, args=(accounts[i::concurrency],)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return accounts
+
+
+def clean_up(url, accounts):
+    with httpx.Client(base_url=url, timeout=30) as client:
+        for account in accounts:
+            if account.get('token'):
+                client.delete('/api/user/delete', headers=bearer(account))
+
+
+def run_load(url, args, mix):
+    seeded = seed_accounts(url, args.users, args.concurrency)
+    # Other workers' known-email filters see the seeded emails after their next sync
+    time.sleep(2)
+    run = Run(seeded)
+    samples = collections.defaultdict(list)
+    errors = collections.defaultdict(collections.Counter)
+    stop = threading.Event()
+    budget = {'left': args.n, 'lock': threading.Lock()} if args.n else None
+
+    before = round_trips(url, args.service_token)
+    threads = [threading.Thread(target=client_loop,
+                                args=(url, run, mix, random.Random(args.seed + i), stop, budget, samples, errors))
+               for i in range(args.concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    if budget is None:
+        time.sleep(args.duration)
+        stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    after = round_trips(url, args.service_token)
+
+    clean_up(url, seeded + list(run.fresh))
+    completed = sum(len(s) for s in samples.values())
+    return {
+        'elapsed_s': round(elapsed, 2),
+        'requests': completed,
+        'throughput_rps': round(completed / elapsed, 1),
+        'ops': {op: dict(summarize(samples[op]), errors=dict(errors[op])) for op in mix},
+        'db_round_trips_per_request': round_trips_per_request(before, after),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='load an already running service instead of starting one')
+    parser.add_argument('--asgi', action='store_true', help='start the ASGI variant (asgi:app under uvicorn)')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers to start')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='op=weight pairs, ops: ' + ', '.join(OPS))
+    parser.add_argument('--concurrency', type=int, default=8, help='client threads')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to run')
+    parser.add_argument('-n', type=int, help='stop after this many requests instead of --duration')
+    parser.add_argument('--users', type=int, default=200, help='accounts registered before the run')
+    parser.add_argument('--seed', type=int, default=1, help='seed for the op sequence')
+    parser.add_argument('--service-token', default=os.getenv('SERVICE_TOKEN'),
+                        help='X-Service-Token for /metrics (default $SERVICE_TOKEN)')
+    parser.add_argument('--output', help='write JSON results here')
+    args = parser.parse_args()
+    mix = parse_mix(args.mix)
+
+    settings = {'mix': mix, 'concurrency': args.concurrency, 'users': args.users,
+                'server': args.url or ('asgi' if args.asgi else 'wsgi') + f"/{args.workers} workers"}
+    if args.url:
+        results = run_load(args.url.rstrip('/'), args, mix)
+    else:
+        with tempfile.TemporaryDirectory(prefix='load-bench-') as workdir:
+            oauth = FakeOAuthProvider().start()
+            process, url = start_server(args, workdir, oauth)
+            try:
+                results = run_load(url, args, mix)
+            finally:
+                stop_server(process)
+                oauth.stop()
+    report('load', dict(settings, **results), args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+Microbenchmarks of the per-request CPU work outside the database: bcrypt
+hashing and checking, row to DTO conversion, and access-token encoding and
+decoding.
+
+    python benchmarks/micro_bench.py --rounds 4,12
+
+No database is needed. JWT settings come from create_app() (src/instance
+config), with and without JWT_PROFILE_CLAIMS, then with each asymmetric
+algorithm (a throwaway key per algorithm in JWT_SIGNING_KEYS). Results are per
+call; bcrypt gets fewer calls (--hash-n) since each costs milliseconds.
+"""
+import argparse
+
+from _common import report, summarize, timed
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
+
+from controller.endpoints import create_user_access_token
+from flask_jwt_extended import decode_token
+from model.user import UserRecord
+from resources.user_dao import ACCOUNT_COLUMNS
+from resources.user_dto import UserDTO
+from user import create_app
+from util.utils import DEFAULT_ROUNDS, check_password, dummy_hash, hash_password
+
+ROW = {
+    'id': 4242, 'username': 'bench', 'email': 'bench@example.com', 'first_name': 'Bench',
+    'last_name': 'User', 'auth_type': 'local', 'profile_version': 3,
+}
+
+
+def measure(fn, n, warmup=20):
+    for _ in range(min(n, warmup)):
+        fn()
+    return summarize([timed(fn)[0] for _ in range(n)])
+
+
+def per_call_us(fn, n):
+    """
+    Mean microseconds per call over a tight loop, for calls too short to time one by one.
+    """
+    for _ in range(min(n, 1000)):
+        fn()
+    elapsed, _ = timed(lambda: [fn() for _ in range(n)])
+    return round(elapsed / n * 1e6, 3)
+
+
+def bcrypt_results(rounds, n):
+    hashed = hash_password('bench-password', rounds)
+    return {
+        'hash': measure(lambda: hash_password('bench-password', rounds), n, warmup=1),
+        'check': measure(lambda: check_password('bench-password', hashed), n, warmup=1),
+        # What an unknown email costs once the filter lets it through (see dummy_hash)
+        'check_dummy': measure(lambda: check_password('bench-password', dummy_hash(rounds)), n, warmup=1),
+    }
+
+
+def dto_results(n):
+    row = {column: ROW.get(column) for column in ACCOUNT_COLUMNS}
+    record = UserRecord.from_row(row)
+    return {
+        'from_row_us': per_call_us(lambda: UserRecord.from_row(row), n * 10),
+        'from_model_us': per_call_us(lambda: UserDTO.from_model(record), n * 10),
+        'row_to_dto_us': per_call_us(lambda: UserDTO.from_model(UserRecord.from_row(row)), n * 10),
+    }
+
+
+def token_results(app, dto, n):
+    with app.test_request_context():
+        token = create_user_access_token(dto)
+        return {
+            'token_bytes': len(token),
+            'encode': measure(lambda: create_user_access_token(dto), n),
+            'decode': measure(lambda: decode_token(token), n),
+        }
+
+
+def pem(private_key):
+    return private_key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                     serialization.NoEncryption()).decode('ascii')
+
+
+def jwt_results(app, n):
+    dto = UserDTO.from_model(UserRecord.from_row(ROW))
+    results = {}
+    for claims in (False, True):
+        app.config['JWT_PROFILE_CLAIMS'] = claims
+        results['profile_claims' if claims else 'identity_only'] = token_results(app, dto, n)
+    # Signing with published keys (resources.signing_keys), identity-only tokens
+    app.config['JWT_PROFILE_CLAIMS'] = False
+    for algorithm, key in (('RS256', rsa.generate_private_key(public_exponent=65537, key_size=3072)),
+                           ('EdDSA', ed25519.Ed25519PrivateKey.generate())):
+        app.config.update(JWT_ALGORITHM=algorithm, JWT_SIGNING_KEYS=[pem(key)])
+        results[algorithm] = token_results(app, dto, n)
+    app.config.update(JWT_ALGORITHM='HS256', JWT_SIGNING_KEYS=[])
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rounds', default=str(DEFAULT_ROUNDS), help='comma-separated bcrypt work factors')
+    parser.add_argument('--hash-n', type=int, default=20, help='calls per bcrypt measurement')
+    parser.add_argument('-n', type=int, default=20000, help='calls per DTO and JWT measurement')
+    parser.add_argument('--output', help='write JSON results here')
+    args = parser.parse_args()
+
+    app = create_app()
+    results = {
+        'bcrypt': {rounds: bcrypt_results(int(rounds), args.hash_n) for rounds in args.rounds.split(',')},
+        'dto': dto_results(args.n),
+        'jwt': jwt_results(app, args.n),
+    }
+    report('micro', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
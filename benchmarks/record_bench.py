@@ -0,0 +1,140 @@
+"""
+CPU time and memory per request for the login and profile row handling:
+SELECT * into ORM model instances (before) vs. projected columns into
+UserRecord (now). Both end in UserDTO.from_model; bcrypt is left out.
+
+    BENCH_LOCAL_DB_USER=postgres BENCH_LOCAL_DB_PASS= BENCH_LOCAL_DB_NAME=postgres \\
+        python benchmarks/record_bench.py --connector local
+
+Needs at least one user in the database. "convert" is the row handling
+alone, "request" includes the query. "cpu_us" is process time per call and
+"peak_bytes" the largest tracemalloc peak seen for a single call.
+"""
+import argparse
+import time
+import tracemalloc
+
+import sqlalchemy
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
+
+from _common import load_config, report, summarize, timed
+
+from model.user import UserRecord
+from resources.user_dao import ACCOUNT_COLUMNS, LOGIN_COLUMNS
+from resources.user_dto import UserDTO
+from user.connectors import load_connector_class
+
+
+class Base(DeclarativeBase):
+    pass
+
+
+class LegacyUser(Base):
+    """
+    The Flask-SQLAlchemy model the DAO used to build (same declarative machinery).
+    """
+    __tablename__ = 'legacy_user'
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    username: Mapped[str]
+    email: Mapped[str]
+    first_name: Mapped[str]
+    last_name: Mapped[str]
+    password: Mapped[str | None]
+    auth_type: Mapped[str]
+    oath_token: Mapped[str | None]
+    profile_version: Mapped[int]
+
+
+LEGACY_LOGIN = "SELECT * FROM users WHERE lower(email) = lower(:email);"
+LEGACY_PROFILE = ("SELECT id, username, email, first_name, last_name, auth_type, profile_version "
+                  "FROM users WHERE id = :id;")
+RECORD_LOGIN = f"SELECT {', '.join(LOGIN_COLUMNS)} FROM users WHERE lower(email) = lower(:email);"
+RECORD_PROFILE = f"SELECT {', '.join(ACCOUNT_COLUMNS)} FROM users WHERE id = :id;"
+
+
+def legacy_convert(row):
+    user = row._asdict()
+    return UserDTO.from_model(LegacyUser(
+        id=user['id'], username=user['username'], email=user['email'], first_name=user['first_name'],
+        last_name=user['last_name'], password=None, auth_type=user['auth_type'],
+        profile_version=user.get('profile_version', 1)))
+
+
+def record_convert(row):
+    user = UserRecord.from_row(row)
+    user.password = None
+    return UserDTO.from_model(user)
+
+
+def cpu_and_memory(fn, n):
+    """
+    Process time per call in microseconds, and the largest tracemalloc peak
+    of a single call in bytes.
+    """
+    for _ in range(min(n, 50)):
+        fn()  # warm statement caches
+    cpu_start = time.process_time()
+    for _ in range(n):
+        fn()
+    cpu = time.process_time() - cpu_start
+
+    peak = 0
+    tracemalloc.start()
+    for _ in range(min(n, 200)):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        fn()
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - before)
+    tracemalloc.stop()
+    return {'cpu_us': round(cpu / n * 1e6, 2), 'peak_bytes': peak}
+
+
+def measure(connection, sql, params, convert, n):
+    query = sqlalchemy.text(sql)
+    row = connection.execute(query, params).fetchone()
+
+    def request():
+        return convert(connection.execute(query, params).fetchone())
+
+    wall = [timed(request)[0] for _ in range(n)]
+    return {
+        'convert': cpu_and_memory(lambda: convert(row), n * 10),
+        'request': dict(cpu_and_memory(request, n), wall=summarize(wall)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', help='pyfile with DB settings, e.g. instance/.env.py')
+    parser.add_argument('--connector', default=None, help="'local', 'cloud-sql' or module:Class")
+    parser.add_argument('-n', type=int, default=2000, help='requests per variant')
+    parser.add_argument('--output', help='write JSON results here')
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    name = args.connector or config.get('DB_CONNECTOR', 'cloud-sql')
+    connector = load_connector_class(name)(config)
+    engine = sqlalchemy.create_engine("postgresql+pg8000://", creator=connector.connect)
+    try:
+        with engine.connect() as connection:
+            user_id, email = connection.execute(sqlalchemy.text(
+                "SELECT id, email FROM users ORDER BY id LIMIT 1;")).one()
+            results = {'connector': name}
+            login, profile = {'email': email}, {'id': user_id}
+            results['login'] = {
+                'orm_model': measure(connection, LEGACY_LOGIN, login, legacy_convert, args.n),
+                'user_record': measure(connection, RECORD_LOGIN, login, record_convert, args.n),
+            }
+            results['profile'] = {
+                'orm_model': measure(connection, LEGACY_PROFILE, profile, legacy_convert, args.n),
+                'user_record': measure(connection, RECORD_PROFILE, profile, record_convert, args.n),
+            }
+        report('record', results, args.output)
+    finally:
+        engine.dispose()
+        connector.close()
+
+
+if __name__ == '__main__':
+    main()
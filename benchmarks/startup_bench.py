@@ -0,0 +1,88 @@
+"""
+Cold-start time of a fresh worker: importing the app module, serving its first
+request and, with --ready, warming the DB pool through /ready.
+
+    python benchmarks/startup_bench.py -n 10
+    python benchmarks/startup_bench.py --app asgi:app
+    python benchmarks/startup_bench.py --ready
+
+Every run is a new interpreter started in src/, as in a freshly scheduled
+container, and the app reads its usual instance/.env.py; --ready needs the
+database that config points at. The report also lists which optional backends
+the import pulled in; a deployment that does not use them should not pay for
+loading them.
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+from _common import SRC_DIR, report, summarize
+
+OPTIONAL_MODULES = [
+    'authlib',
+    'google.cloud.sql.connector',
+    'psycopg2',
+    'asyncpg',
+    'redis',
+]
+
+CHILD = r'''
+import json, sys, time
+start = time.perf_counter()
+import importlib
+module_name, attr = sys.argv[1].split(':')
+app = getattr(importlib.import_module(module_name), attr)
+imported = time.perf_counter()
+
+first_request = ready = None
+if hasattr(app, 'test_client'):
+    client = app.test_client()
+    client.get('/')
+    first_request = time.perf_counter()
+    if sys.argv[2] == '1':
+        status = client.get('/ready').status_code
+        ready = time.perf_counter() if status == 200 else None
+
+print(json.dumps({
+    'import': imported - start,
+    'first_request': first_request - start if first_request else None,
+    'ready': ready - start if ready else None,
+    'loaded': [m for m in json.loads(sys.argv[3]) if m in sys.modules],
+}))
+'''
+
+
+def run_once(app_path, ready):
+    output = subprocess.run(
+        [sys.executable, '-c', CHILD, app_path, '1' if ready else '0', json.dumps(OPTIONAL_MODULES)],
+        cwd=SRC_DIR, capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--app', default='server:app', help="module:attribute to import, run from src/")
+    parser.add_argument('--ready', action='store_true', help='also time GET /ready (needs a database)')
+    parser.add_argument('-n', type=int, default=10, help='fresh interpreters to start')
+    parser.add_argument('--output', help='write JSON results here')
+    args = parser.parse_args()
+
+    runs = [run_once(args.app, args.ready) for _ in range(args.n)]
+
+    results = {
+        'app': args.app,
+        'import': summarize([r['import'] for r in runs]),
+        'loaded_modules': runs[-1]['loaded'],
+    }
+    if runs[-1]['first_request'] is not None:
+        results['first_request'] = summarize([r['first_request'] for r in runs])
+    if args.ready:
+        results['ready'] = summarize([r['ready'] for r in runs if r['ready'] is not None])
+        results['ready_failures'] = sum(r['ready'] is None for r in runs)
+    report('startup', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
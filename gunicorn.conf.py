@@ -0,0 +1,63 @@
+"""
+Production server settings: `gunicorn --config gunicorn.conf.py`.
+
+Every setting can be overridden from the environment. The defaults start
+with the default config: one process, whose password pool spreads bcrypt
+over every core (bcrypt releases the GIL), and a thread per core for
+requests. More processes need the shared refresh-token backend (and the
+shared user cache with JWT_PROFILE_CLAIMS); the app refuses to start
+without it.
+"""
+import multiprocessing
+import os
+
+# Serve the Flask app by default; GUNICORN_APP=asgi:app with
+# GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker serves the ASGI variant.
+wsgi_app = os.getenv('GUNICORN_APP', 'server:app')
+chdir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src')
+
+bind = f"0.0.0.0:{os.getenv('PORT', '9090')}"
+workers = int(os.getenv('GUNICORN_WORKERS', 1))
+# Lets the app refuse per-worker security state when there are several workers
+os.environ['SERVER_WORKERS'] = str(workers)
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.getenv('GUNICORN_THREADS', max(4, multiprocessing.cpu_count())))
+
+# Seconds to hold idle client connections open; behind a load balancer, set it
+# above the balancer's idle timeout so the server never closes first
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', 5))
+# Seconds a worker may spend on one request before it is restarted
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 30))
+# Seconds in-flight requests get to finish on SIGTERM
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 30))
+
+# Recycle workers now and then to contain slow leaks
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 10000))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', 1000))
+
+# Each worker imports the app itself, so pools, connectors and OAuth clients
+# are always created after fork
+preload_app = os.getenv('GUNICORN_PRELOAD', 'false').lower() == 'true'
+
+accesslog = os.getenv('GUNICORN_ACCESSLOG', '-')
+loglevel = os.getenv('GUNICORN_LOGLEVEL', 'info')
+
+
+def post_worker_init(worker):
+    if wsgi_app == 'server:app':
+        from server import warm_worker
+        warm_worker()
+
+
+def worker_exit(server, worker):
+    if wsgi_app == 'server:app':
+        from resources.user_dao import manager
+        manager.close_db()
+
+
+def child_exit(server, worker):
+    # Runs in the master for every worker that exits, including ones killed
+    # on timeout, so their live metrics files do not outlive them
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,15 @@
+"""
+ASGI entry point for the asyncio variant of the service:
+
+    uvicorn asgi:app --app-dir src --host 0.0.0.0 --port 9090
+
+More than one worker (--workers, or under gunicorn.conf.py) needs the shared
+refresh-token backend, as for the Flask app; see README.md.
+"""
+from dotenv import load_dotenv
+load_dotenv()
+
+from controller.async_endpoints import create_asgi_app
+
+# App instance
+app = create_asgi_app()
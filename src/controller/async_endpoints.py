@@ -0,0 +1,466 @@
+"""
+asyncio (ASGI) variant of the user endpoints in controller/endpoints.py.
+
+Same routes and response shapes, served by Starlette. Database calls go
+through AsyncUserDAO (asyncpg) and password work through the shared password
+pool, so one worker can hold thousands of concurrent connections. Tokens are
+created and verified with the Flask app's Flask-JWT-Extended configuration,
+so tokens from either server work on the other. Tokens are read from the
+Authorization header only.
+"""
+import contextlib
+import logging
+import time
+
+from flask_jwt_extended import decode_token
+from jwt import ExpiredSignatureError, InvalidTokenError
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.sessions import SessionMiddleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+
+from controller.endpoints import (
+    BATCH_LOOKUP_MAX, GOOGLE_ID_TOKEN_CLAIMS, LIST_PAGE_MAX, batch_lookup_body, create_user_access_token,
+    create_user_refresh_token, google_email_verified, google_oauth_settings,
+    list_users_body, parse_batch_lookup, parse_list_query, parse_login, parse_registration, parse_user_patch,
+    service_token_valid, user_profile,
+)
+from resources.async_user_dao import AsyncDatabase, AsyncUserDAO
+from resources.login_throttle import LoginThrottled, get_login_throttle
+from resources.refresh_tokens import RefreshTokenRejected, get_refresh_tokens
+from resources.signing_keys import get_key_ring
+from resources.user_dao import UserWriteFailed
+from resources.user_cache import get_profile_versions
+from resources.user_dto import UserDTO
+from util import metrics
+from util.password_pool import PasswordPoolSaturated, run_password_task_async
+from util.utils import DEFAULT_ROUNDS, dummy_hash, hash_password
+
+logger = logging.getLogger()
+
+
+class AuthError(Exception):
+    def __init__(self, status_code, msg):
+        super().__init__(msg)
+        self.status_code = status_code
+        self.msg = msg
+
+
+def jwt_claims(request, refresh=False):
+    """
+    Verifies the bearer token and returns its claims, like
+    @jwt_required(refresh=refresh).
+    """
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme != 'Bearer' or not token:
+        raise AuthError(401, 'Missing Authorization Header')
+    try:
+        with request.app.state.flask_app.app_context():
+            claims = decode_token(token)
+    except ExpiredSignatureError:
+        raise AuthError(401, 'Token has expired')
+    except InvalidTokenError as e:
+        raise AuthError(422, str(e))
+    if refresh and claims.get('type') != 'refresh':
+        raise AuthError(422, 'Only refresh tokens are allowed')
+    if not refresh and claims.get('type') != 'access':
+        raise AuthError(422, 'Only non-refresh tokens are allowed')
+    return claims
+
+
+def jwt_identity(request, claims):
+    return claims[request.app.state.config.get('JWT_IDENTITY_CLAIM', 'sub')]
+
+
+def client_address(request):
+    """
+    The caller's address. Behind TRUSTED_PROXY_HOPS proxies it is that many
+    X-Forwarded-For entries from the right, as ProxyFix gives the Flask app.
+    """
+    hops = request.app.state.config.get('TRUSTED_PROXY_HOPS', 0)
+    if hops:
+        forwarded = [part.strip() for part in ','.join(request.headers.getlist('x-forwarded-for')).split(',')]
+        if len(forwarded) >= hops and forwarded[-hops]:
+            return forwarded[-hops]
+    return request.client.host if request.client else None
+
+
+def google_client(request):
+    """
+    The app's Google OAuth client, registered on first use so authlib is only
+    imported by deployments that offer Google sign-in. ID tokens are verified
+    against the worker's cached Google keys, as in google_oauth_client().
+    """
+    state = request.app.state
+    if state.oauth is None:
+        from authlib.integrations.starlette_client import OAuth
+        from resources.jwks_cache import get_jwks_cache
+        oauth = OAuth()
+        oauth.register(**google_oauth_settings())
+        oauth.google.fetch_jwk_set = get_jwks_cache(state.config, oauth.google.server_metadata['jwks_uri']).key_set_async
+        state.oauth = oauth
+    return state.oauth.google
+
+
+def access_token_for(request, user_dto_response):
+    with request.app.state.flask_app.app_context():
+        return create_user_access_token(user_dto_response)
+
+
+def refresh_token_for(request, user_id, family=None):
+    with request.app.state.flask_app.app_context():
+        return create_user_refresh_token(user_id, family)
+
+
+# Email + password
+async def create_user(request):
+    try:
+        data = await request.json()  # get user data
+    except ValueError:
+        data = None
+    try:
+        user_model = parse_registration(data)
+    except ValueError as e:
+        return JSONResponse({'error': str(e)}, 400)
+
+    config = request.app.state.config
+    user_data = UserDTO.from_model(user_model)
+    user_data['password'] = await run_password_task_async(
+        config, hash_password, user_model.password, config.get('BCRYPT_ROUNDS', DEFAULT_ROUNDS))
+    result = await request.app.state.dao.create_user(user_data)
+
+    created_user = result.get('resource')
+    if created_user is None:
+        if 'error' in result:
+            return JSONResponse({'error': 'Failed to create user'}, 500)
+        return JSONResponse({'error': result['status']}, 409)
+
+    access_token = access_token_for(request, created_user)
+    refresh_token = refresh_token_for(request, created_user['id'])
+    return JSONResponse({'auth_token': access_token, 'refresh_token': refresh_token,
+                         'user': user_profile(created_user)}, 201)
+
+
+async def login_user(request):
+    """
+    Login using email password
+    """
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    # Make sure fields are there
+    try:
+        email, password = parse_login(data)
+    except ValueError as e:
+        return JSONResponse({'error': str(e)}, 400)
+
+    # Throttled attempts stop here, before any query or bcrypt work
+    throttle = get_login_throttle(request.app.state.config)
+    attempt = throttle.reserve(email, client_address(request))
+
+    try:
+        user = await request.app.state.dao.get_user_by_credentials(email, password)
+    except Exception:
+        throttle.release(attempt)  # not a failed login
+        raise
+    if user:
+        throttle.record_success(email, attempt)
+        access_token = access_token_for(request, user)
+        refresh_token = refresh_token_for(request, user['id'])
+        return JSONResponse({'auth_token': access_token, 'refresh_token': refresh_token,
+                             'user': user_profile(user)}, 200)
+    return JSONResponse({'error': 'Invalid credentials'}, 401)
+
+
+async def refresh_session(request):
+    """
+    Exchanges a refresh token for a new access token and the session's next
+    refresh token, as the Flask endpoint does.
+    """
+    claims = jwt_claims(request, refresh=True)
+    current_user_id = jwt_identity(request, claims)
+    family = get_refresh_tokens(request.app.state.config).rotate(claims, current_user_id)
+
+    user = {'id': current_user_id}
+    if request.app.state.config.get('JWT_PROFILE_CLAIMS'):
+        user = await request.app.state.dao.get_user_by_id(current_user_id)
+        if user is None:
+            return JSONResponse({'error': 'User not found'}, 404)
+    return JSONResponse({'auth_token': access_token_for(request, user),
+                         'refresh_token': refresh_token_for(request, current_user_id, family)}, 200)
+
+
+async def jwks(request):
+    """
+    The published token verification keys, as the Flask endpoint serves them.
+    """
+    ring = get_key_ring(request.app.state.config)
+    if ring is None:
+        return JSONResponse({'error': 'Tokens are not signed with a published key'}, 404)
+    headers = {'Cache-Control': f"public, max-age={ring.max_age}", 'ETag': f'"{ring.etag}"'}
+    if headers['ETag'] in request.headers.get('if-none-match', ''):
+        return Response(status_code=304, headers=headers)
+    return Response(ring.jwks_body, 200, media_type='application/json', headers=headers)
+
+
+# Google OAUTH
+async def google_login(request):
+    """
+    Redirects to Google's OAuth 2.0 server for user authentication.
+    """
+    redirect_uri = request.url_for('google_authorize')
+    return await google_client(request).authorize_redirect(request, redirect_uri)
+
+
+async def google_authorize(request):
+    """
+    Handles the callback from Google OAuth and returns a JWT for the user.
+    """
+    from authlib.jose.errors import JoseError
+    google = google_client(request)
+    # Exchange authorization code for tokens; the ID token is verified locally
+    try:
+        token = await google.authorize_access_token(request, claims_options=GOOGLE_ID_TOKEN_CLAIMS)
+    except (JoseError, ValueError) as e:  # ValueError: signed with a key not (yet) in the cache
+        logger.warning(f"Google ID token rejected: {e}")
+        return JSONResponse({'error': 'Authentication failed'}, 401)
+    userinfo = token.get('userinfo')  # The ID token's claims
+    if userinfo is None:
+        userinfo = (await google.get('userinfo', token=token)).json()  # No ID token in the response
+    if not google_email_verified(userinfo):
+        logger.warning("Google sign-in refused: email not verified")
+        return JSONResponse({'error': 'Google account email is not verified'}, 403)
+    user = await request.app.state.dao.get_or_create_user_by_google_info(userinfo)
+
+    if user:
+        access_token = access_token_for(request, user)
+        return JSONResponse({
+            'logged_in_as': user['username'],
+            'first_name': user['first_name'],
+            'last_name': user['last_name'],
+            'email': user['email'],
+            'auth_type': user['auth_type'],
+            'auth_token': access_token,
+            'refresh_token': refresh_token_for(request, user['id']),
+        }, 200)
+    return JSONResponse({'error': 'Authentication failed'}, 401)
+
+
+async def get_users_batch(request):
+    """
+    Resolves many user ids and/or emails to public profiles (service token required).
+    """
+    config = request.app.state.config
+    if not service_token_valid(config, request.headers.get('X-Service-Token')):
+        return JSONResponse({'error': 'Invalid service token'}, 401)
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    try:
+        ids, emails = parse_batch_lookup(data, config.get('BATCH_LOOKUP_MAX', BATCH_LOOKUP_MAX))
+    except ValueError as e:
+        return JSONResponse({'error': str(e)}, 400)
+
+    rows = await request.app.state.dao.get_users_by_ids(ids, emails)
+    return StreamingResponse(batch_lookup_body(rows), 200, media_type='application/json')
+
+
+async def list_users(request):
+    """
+    Lists users a keyset page at a time (service token required).
+    """
+    config = request.app.state.config
+    if not service_token_valid(config, request.headers.get('X-Service-Token')):
+        return JSONResponse({'error': 'Invalid service token'}, 401)
+    try:
+        options = parse_list_query(request.query_params, config.get('LIST_PAGE_MAX', LIST_PAGE_MAX))
+    except ValueError as e:
+        return JSONResponse({'error': str(e)}, 400)
+
+    rows, next_after = await request.app.state.dao.list_users(**options)
+    return StreamingResponse(list_users_body(options['fields'], rows, next_after), 200,
+                             media_type='application/json')
+
+
+async def get_user(request):
+    """
+    Returns the profile of the user the token belongs to.
+    """
+    claims = jwt_claims(request)
+    current_user_id = jwt_identity(request, claims)
+
+    if 'profile' in claims and not get_profile_versions(request.app.state.config).is_stale(
+            current_user_id, claims.get('pv')):
+        return JSONResponse(claims['profile'], 200)
+
+    user = await request.app.state.dao.get_user_by_id(current_user_id)
+    if user:
+        return JSONResponse(user_profile(user), 200)
+    return JSONResponse({'error': 'User not found'}, 404)
+
+
+async def update_user(request):
+    """
+    Updates the information of the currently logged-in user.
+
+    Returns the user info after updated
+    """
+    claims = jwt_claims(request)
+    try:
+        data = await request.json()  # user inputed updates
+    except ValueError:
+        data = None
+    try:
+        patch = parse_user_patch(data)  # only the fields the user sent are written
+    except ValueError as e:
+        return JSONResponse({'error': str(e)}, 400)
+
+    current_user_id = jwt_identity(request, claims)
+    config = request.app.state.config
+    if 'password' in patch:
+        patch['password'] = await run_password_task_async(
+            config, hash_password, patch['password'], config.get('BCRYPT_ROUNDS', DEFAULT_ROUNDS))
+
+    updated = await request.app.state.dao.update_user(current_user_id, patch)
+    if updated is None:
+        return JSONResponse({'error': 'User not found'}, 404)
+    return JSONResponse(user_profile(updated), 200)
+
+
+async def delete_user(request):
+    """
+    Deletes the currently logged-in user.
+    """
+    current_user_id = jwt_identity(request, jwt_claims(request))
+    deleted = await request.app.state.dao.delete_user(current_user_id)
+    if deleted is None:
+        return JSONResponse({'error': 'User does not exist'}, 404)
+
+    return JSONResponse({
+        'message': f"Account for {deleted['username']} with email {deleted['email']} deleted successfully"},
+        200)
+
+
+async def home(request):
+    return JSONResponse({'home': 'Please go to a specific endpoint'})
+
+
+async def metrics_endpoint(request):
+    """
+    Prometheus metrics, like server.metrics (service token required).
+    """
+    if not service_token_valid(request.app.state.config, request.headers.get('X-Service-Token')):
+        return JSONResponse({'error': 'Invalid service token'}, 401)
+    payload, content_type = metrics.metrics_payload()
+    return Response(payload, 200, media_type=content_type)
+
+
+class RequestMetricsMiddleware:
+    """
+    Per-endpoint latency and phase timings for /api/user requests, as the
+    Flask blueprint records them (see util.metrics).
+    """
+
+    def __init__(self, app, config):
+        self.app = app
+        self.config = config
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not scope['path'].startswith('/api/user'):
+            return await self.app(scope, receive, send)
+        token, start, status = metrics.start_request(), time.perf_counter(), 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # The router leaves the matched endpoint in the scope
+            endpoint = getattr(scope.get('endpoint'), '__name__', 'unmatched')
+            metrics.finish_request(token, endpoint, scope['method'], status, time.perf_counter() - start,
+                                   self.config)
+
+
+async def auth_error(request, e):
+    return JSONResponse({'msg': e.msg}, e.status_code)
+
+
+async def password_pool_saturated(request, e):
+    return JSONResponse({'error': 'Too many requests, retry later'}, 503,
+                        headers={'Retry-After': str(e.retry_after)})
+
+
+async def refresh_token_rejected(request, e):
+    return JSONResponse({'error': str(e)}, 401)
+
+
+async def user_write_failed(request, e):
+    return JSONResponse({'error': str(e)}, 500)
+
+
+async def login_throttled(request, e):
+    return JSONResponse({'error': 'Too many failed logins, retry later'}, 429,
+                        headers={'Retry-After': str(e.retry_after)})
+
+
+routes = [
+    Route('/', home, methods=['GET']),
+    Route('/metrics', metrics_endpoint, methods=['GET']),
+    Mount('/api/user', routes=[
+        Route('/register', create_user, methods=['POST']),
+        Route('/login', login_user, methods=['POST']),
+        Route('/refresh', refresh_session, methods=['POST']),
+        Route('/jwks.json', jwks, methods=['GET']),
+        Route('/login/google', google_login, methods=['GET']),
+        Route('/login/google/authorize', google_authorize, methods=['GET'], name='google_authorize'),
+        Route('/batch', get_users_batch, methods=['POST']),
+        Route('/list', list_users, methods=['GET']),
+        Route('/', get_user, methods=['GET']),
+        Route('/update', update_user, methods=['PUT']),
+        Route('/delete', delete_user, methods=['DELETE']),
+    ]),
+]
+
+
+def create_asgi_app(flask_app=None) -> Starlette:
+    """
+    Builds the ASGI app. `flask_app` supplies config and JWT settings;
+    defaults to create_app().
+    """
+    if flask_app is None:
+        from user import create_app
+        flask_app = create_app()
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        get_key_ring(flask_app.config)  # a bad signing key stops startup here
+        dummy_hash(flask_app.config.get('BCRYPT_ROUNDS', DEFAULT_ROUNDS))  # see AsyncUserDAO.get_user_by_credentials
+        await app.state.database.start()
+        await app.state.dao.refresh_email_filter(wait=True)
+        yield
+        await app.state.database.stop()
+
+    app = Starlette(
+        routes=routes,
+        middleware=[
+            Middleware(SessionMiddleware, secret_key=flask_app.config['SECRET_KEY']),
+            Middleware(RequestMetricsMiddleware, config=flask_app.config),
+        ],
+        exception_handlers={AuthError: auth_error, PasswordPoolSaturated: password_pool_saturated,
+                            LoginThrottled: login_throttled, RefreshTokenRejected: refresh_token_rejected,
+                            UserWriteFailed: user_write_failed},
+        lifespan=lifespan,
+    )
+    app.state.flask_app = flask_app
+    app.state.config = flask_app.config
+    app.state.database = AsyncDatabase(flask_app.config)
+    app.state.dao = AsyncUserDAO(app.state.database)
+    app.state.oauth = None  # see google_client()
+    return app
@@ -1,17 +1,23 @@
-from flask import Flask, Blueprint, request, jsonify, redirect, url_for, make_response
-from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity, set_access_cookies
-from authlib.integrations.flask_client import OAuth
-from user import create_app
-from resources import user_dao, user_dto
-from resources.user_dao import UserDAO
+from flask import Blueprint, Response, current_app, g, request, jsonify, url_for, make_response
+from flask_jwt_extended import (
+    create_access_token, create_refresh_token, jwt_required, get_jwt, get_jwt_identity, set_access_cookies,
+    set_refresh_cookies,
+)
+from resources.user_dao import PROFILE_COLUMNS, UPDATABLE_COLUMNS, UserDAO, UserWriteFailed
 from resources.user_dto import UserDTO
+from resources.login_throttle import LoginThrottled, get_login_throttle
+from resources.refresh_tokens import RefreshTokenRejected, RefreshTokens, get_refresh_tokens
+from resources.signing_keys import get_key_ring
+from resources.user_cache import get_profile_versions
+import functools
+import hmac
+import json
 import os
-from util.utils import hash_password, check_password
-
-# app = create_app()
-from user import create_app
-
-app = create_app()
+import threading
+import time
+from util import metrics
+from util.utils import hash_password
+from util.password_pool import PasswordPoolSaturated, bcrypt_rounds, run_password_task
 
 # Ensure environment variables are set
 # required_env_vars = ["JWT_SECRET_KEY", "GOOGLE_CLIENT_ID", "GOOGLE_CLIENT_SECRET"]
@@ -20,28 +26,129 @@ app = create_app()
 #         raise EnvironmentError(f"Missing required environment variable: {var}")
 
 
-jwt = JWTManager(app)
+# Issuers Google signs ID tokens as; checked on every SSO login
+GOOGLE_ID_TOKEN_CLAIMS = {'iss': {'essential': True, 'values': ['https://accounts.google.com', 'accounts.google.com']}}
+
+
+def google_email_verified(google_info):
+    """
+    True if Google vouches for the email in an ID token's claims (or
+    userinfo). Unverified emails never sign in: the email is what links the
+    Google identity to an account, password accounts included.
+    """
+    return google_info.get('email_verified') in (True, 'true')
+
+
+def google_oauth_settings():
+    """
+    Google OAuth registration, shared by the Flask and ASGI apps. The
+    provider URLs can be pointed elsewhere (e.g. benchmarks/fake_oauth.py)
+    from the environment.
+    """
+    return dict(
+        name='google',
+        client_id=os.getenv('GOOGLE_CLIENT_ID'),
+        client_secret=os.getenv('GOOGLE_CLIENT_SECRET'),
+        access_token_url=os.getenv('GOOGLE_ACCESS_TOKEN_URL', 'https://accounts.google.com/o/oauth2/token'),
+        authorize_url=os.getenv('GOOGLE_AUTHORIZE_URL', 'https://accounts.google.com/o/oauth2/auth'),
+        api_base_url=os.getenv('GOOGLE_API_BASE_URL', 'https://www.googleapis.com/oauth2/v1/'),
+        jwks_uri=os.getenv('GOOGLE_JWKS_URI', 'https://www.googleapis.com/oauth2/v3/certs'),
+        id_token_signing_alg_values_supported=['RS256'],
+        client_kwargs={'scope': 'openid email profile'},
+    )
+
+
+_oauth_lock = threading.Lock()
+
+
+def google_oauth_client(app=None):
+    """
+    The Google OAuth client for `app` (default: the current app). authlib is
+    imported and the client registered on first use, so deployments without
+    Google sign-in never load it. ID tokens are verified against the
+    worker's cached Google keys (resources.jwks_cache) instead of keys
+    fetched by authlib.
+    """
+    app = app or current_app._get_current_object()
+    with _oauth_lock:
+        oauth = app.extensions.get('authlib.integrations.flask_client')
+        if oauth is None:
+            from authlib.integrations.flask_client import OAuth
+            from resources.jwks_cache import get_jwks_cache
+            oauth = OAuth(app)
+            oauth.register(**google_oauth_settings())
+            google = oauth.create_client('google')
+            google.fetch_jwk_set = get_jwks_cache(app.config, google.server_metadata['jwks_uri']).key_set
+    return oauth.create_client('google')
 
-# Setup Google OAuth with environment variables
-oauth = OAuth(app)
-oauth.register(
-    name='google',
-    client_id=os.getenv('GOOGLE_CLIENT_ID'),
-    client_secret=os.getenv('GOOGLE_CLIENT_SECRET'),
-    access_token_url='https://accounts.google.com/o/oauth2/token',
-    authorize_url='https://accounts.google.com/o/oauth2/auth',
-    api_base_url='https://www.googleapis.com/oauth2/v1/',
-    jwks_uri='https://www.googleapis.com/oauth2/v3/certs',
-    client_kwargs={'scope': 'openid email profile'},
-)
 
 bp = Blueprint('user-endpoints', __name__, url_prefix='/api/user')
 
 
-def auth_user_profile(access_token, user_dto_response):
-    if user_dto_response is None:
-        return {'error': "No User"}
-    user_type = {
+@bp.before_request
+def start_request_metrics():
+    g.request_metrics = (metrics.start_request(), time.perf_counter())
+
+
+def finish_request_metrics(status):
+    token, start = g.pop('request_metrics', (None, None))
+    if token is not None:
+        metrics.finish_request(token, request.endpoint.rsplit('.', 1)[-1], request.method, status,
+                               time.perf_counter() - start, current_app.config)
+
+
+@bp.after_request
+def record_request_metrics(response):
+    """
+    Per-endpoint latency and phase timings (see util.metrics).
+    """
+    finish_request_metrics(response.status_code)
+    return response
+
+
+@bp.teardown_request
+def record_failed_request_metrics(e=None):
+    # Requests that raised past every error handler never reach after_request
+    finish_request_metrics(500)
+
+
+@bp.errorhandler(PasswordPoolSaturated)
+def password_pool_saturated(e):
+    """
+    Sheds password work beyond the pool's capacity instead of queueing it.
+    """
+    return {'error': 'Too many requests, retry later'}, 503, {'Retry-After': str(e.retry_after)}
+
+
+@bp.errorhandler(LoginThrottled)
+def login_throttled(e):
+    """
+    Refuses logins for an email or client with too many recent failures.
+    """
+    return {'error': 'Too many failed logins, retry later'}, 429, {'Retry-After': str(e.retry_after)}
+
+
+@bp.errorhandler(UserWriteFailed)
+def user_write_failed(e):
+    """
+    Reports a failed account change without the database's error text.
+    """
+    return {'error': str(e)}, 500
+
+
+@bp.errorhandler(RefreshTokenRejected)
+def refresh_token_rejected(e):
+    """
+    Refuses spent, revoked or reused refresh tokens; the client logs in again.
+    """
+    return {'error': str(e)}, 401
+
+
+def user_profile(user_dto_response):
+    """
+    The non-sensitive profile fields that are safe to hand back to clients.
+    """
+    return {
         'id': user_dto_response['id'],
         'username': user_dto_response['username'],
         'first_name': user_dto_response['first_name'],
@@ -49,34 +156,119 @@ def auth_user_profile(access_token, user_dto_response):
         'email': user_dto_response['email'],
         'auth_type': user_dto_response['auth_type']
     }
-    return {'auth_token': access_token, 'user': user_type}
+
+
+def auth_user_profile(access_token, user_dto_response, refresh_token):
+    if user_dto_response is None:
+        return {'error': "No User"}
+    return {'auth_token': access_token, 'refresh_token': refresh_token, 'user': user_profile(user_dto_response)}
+
+
+def create_user_access_token(user_dto_response):
+    """
+    Access token for a user. With JWT_PROFILE_CLAIMS on, it also carries the
+    user's profile and profile version so GET /api/user/ can skip the DB.
+    """
+    if not current_app.config.get('JWT_PROFILE_CLAIMS'):
+        return create_access_token(identity=user_dto_response['id'])
+    return create_access_token(
+        identity=user_dto_response['id'],
+        additional_claims={
+            'profile': user_profile(user_dto_response),
+            'pv': user_dto_response.get('profile_version'),
+        },
+    )
+
+
+def create_user_refresh_token(user_id, family=None):
+    """
+    Refresh token for a user: the first of a new session, or the next one
+    of the session `family` (claims from RefreshTokens.rotate) continues.
+    """
+    return create_refresh_token(identity=user_id, additional_claims=family or RefreshTokens.new_family())
 
 
 # Email + password
+# Longest value the users table's VARCHAR(255) columns hold
+FIELD_MAX_LENGTH = 255
+# What a password account is registered with
+REGISTRATION_FIELDS = ('username', 'email', 'first_name', 'last_name', 'password')
+
+
+def check_user_field(field, value):
+    """
+    Raises ValueError with a message for the client unless `value` is a
+    non-blank string that fits `field`'s column.
+    """
+    if not isinstance(value, str) or not value.strip():
+        raise ValueError(f"{field} must be a non-empty string")
+    if field != 'password' and len(value) > FIELD_MAX_LENGTH:
+        raise ValueError(f"{field} must be at most {FIELD_MAX_LENGTH} characters")
+
+
+def parse_registration(data):
+    """
+    Validates a registration body: every REGISTRATION_FIELDS entry, as
+    check_user_field requires. Both servers register through it.
+
+    Returns a UserRecord for a password account; raises ValueError with a
+    message for the client
+    """
+    if not isinstance(data, dict):
+        raise ValueError("Expected a JSON object with the new user's fields")
+    for field in REGISTRATION_FIELDS:
+        check_user_field(field, data.get(field))
+    # Only these fields: a client cannot pick its id or auth_type
+    return UserDTO.to_model({field: data[field] for field in REGISTRATION_FIELDS})
+
+
+def parse_login(data):
+    """
+    Validates a login body: email and password, both non-empty strings.
+    Both servers log in through it.
+
+    Returns (email, password); raises ValueError with a message for the client
+    """
+    if not isinstance(data, dict):
+        raise ValueError("Expected a JSON object with email and password")
+    email, password = data.get('email'), data.get('password')
+    if not isinstance(email, str) or not email.strip() or not isinstance(password, str) or not password:
+        raise ValueError("Invalid fields")
+    if len(email) > FIELD_MAX_LENGTH:
+        raise ValueError(f"email must be at most {FIELD_MAX_LENGTH} characters")
+    return email, password
+
+
 @bp.route('/register', methods=['POST'])
 def create_user():
-    data = request.get_json()  # get user data
-    user_model = UserDTO.to_model(data)  # Parse and validate DTO
-
-    if user_model is None:
-        return {"error": "No User"}
+    try:
+        user_model = parse_registration(request.get_json(silent=True))  # get user data
+    except ValueError as e:
+        return {'error': str(e)}, 400
     # Hash password
-    user_model.password = hash_password(user_model.password)
+    user_model.password = run_password_task(hash_password, user_model.password, bcrypt_rounds())
     # Attempt to save model to database
     result = UserDAO.create_user(user_model)  # returns status and resource in dic
 
     created_user = result.get('resource')
     status = result['status']
-    access_token = create_access_token(identity=created_user['id'])
+    if created_user is None:
+        if 'error' in result:
+            return {'error': 'Failed to create user'}, 500
+        return {'error': status}, 409
+
+    access_token = create_user_access_token(created_user)
+    refresh_token = create_user_refresh_token(created_user['id'])
 
     # user_profile = UserDTO.from_model(created_user)
-    safe_to_return = auth_user_profile(access_token, created_user)
+    safe_to_return = auth_user_profile(access_token, created_user, refresh_token)
 
 
     # format response
-    if app.config['JWT_TOKEN_LOCATION'] == ['cookies']:
+    if current_app.config.get('JWT_TOKEN_LOCATION') == ['cookies']:
         response = make_response(jsonify(safe_to_return), 201)
         set_access_cookies(response, access_token)  # include access_token as cookie
+        set_refresh_cookies(response, refresh_token)
     else:
         response = make_response(jsonify(safe_to_return), 201)
 
@@ -88,31 +280,86 @@ def login_user():
     """
     Login using email password
     """
-    data = request.get_json()
-
     # Make sure fields are there
-    required_fields = ['email', 'password']
-    for field in required_fields:
-        if field not in data.keys():
-            return {'error': "Invalid fields"}, 400
+    try:
+        email, password = parse_login(request.get_json(silent=True))
+    except ValueError as e:
+        return {'error': str(e)}, 400
+
+    # Throttled attempts stop here, before any query or bcrypt work
+    # (remote_addr is the caller's behind TRUSTED_PROXY_HOPS proxies, see create_app)
+    throttle = get_login_throttle(current_app.config)
+    attempt = throttle.reserve(email, request.remote_addr)
 
     # Continue after checks
-    user = UserDAO.get_user_by_credentials(data['email'], data['password'])
+    try:
+        user = UserDAO.get_user_by_credentials(email, password)
+    except Exception:
+        throttle.release(attempt)  # not a failed login
+        raise
 
     if user:
-        access_token = create_access_token(identity=user.id)
+        throttle.record_success(email, attempt)
         user_dto_response = UserDTO.from_model(user)
+        access_token = create_user_access_token(user_dto_response)
+        refresh_token = create_user_refresh_token(user_dto_response['id'])
 
-        auth_user = auth_user_profile(access_token, user_dto_response)
+        auth_user = auth_user_profile(access_token, user_dto_response, refresh_token)
         # Use if just want logged in confirmation
         response = make_response(jsonify(auth_user), 200)
 
-        if app.config['JWT_TOKEN_LOCATION'] == ['cookies']:
+        if current_app.config.get('JWT_TOKEN_LOCATION') == ['cookies']:
             set_access_cookies(response, access_token)  # Set the JWT as a cookie in the response
+            set_refresh_cookies(response, refresh_token)
         return response
     return {'error': 'Invalid credentials'}, 401
 
 
+@bp.route('/refresh', methods=['POST'])
+@jwt_required(refresh=True)
+def refresh_session():
+    """
+    Exchanges a refresh token for a new access token and the session's next
+    refresh token. There is no password check, and no DB read unless
+    access tokens carry profile claims: the token's signature and the
+    revocation store decide. Each refresh token works once; presenting a
+    spent one revokes its whole session.
+    """
+    current_user_id = get_jwt_identity()
+    family = get_refresh_tokens(current_app.config).rotate(get_jwt(), current_user_id)
+
+    user_dto_response = {'id': current_user_id}
+    if current_app.config.get('JWT_PROFILE_CLAIMS'):
+        user = UserDAO.get_user_by_id(current_user_id)  # through the user cache
+        if user is None:
+            return jsonify(error='User not found'), 404
+        user_dto_response = UserDTO.from_model(user)
+    access_token = create_user_access_token(user_dto_response)
+    refresh_token = create_user_refresh_token(current_user_id, family)
+
+    response = make_response(jsonify(auth_token=access_token, refresh_token=refresh_token), 200)
+    if current_app.config.get('JWT_TOKEN_LOCATION') == ['cookies']:
+        set_access_cookies(response, access_token)
+        set_refresh_cookies(response, refresh_token)
+    return response
+
+
+@bp.route('/jwks.json', methods=['GET'])
+def jwks():
+    """
+    The public keys that verify this service's tokens, as a JWK set, so other
+    services can check tokens themselves. Cacheable for JWKS_MAX_AGE seconds
+    and revalidated by ETag; 404 while tokens are signed with JWT_SECRET_KEY.
+    """
+    ring = get_key_ring(current_app.config)
+    if ring is None:
+        return jsonify(error='Tokens are not signed with a published key'), 404
+    response = current_app.response_class(ring.jwks_body, mimetype='application/json')
+    response.headers['Cache-Control'] = f"public, max-age={ring.max_age}"
+    response.set_etag(ring.etag)
+    return response.make_conditional(request)
+
+
 # Google OAUTH
 @bp.route('/login/google')
 def google_login():
@@ -129,7 +376,7 @@ def google_login():
     Response: Redirects to Google's OAuth 2.0 server for user authentication.
     """
     redirect_uri = url_for('user-endpoints.google_authorize', _external=True)
-    return oauth.google.authorize_redirect(redirect_uri)
+    return google_oauth_client().authorize_redirect(redirect_uri)
 
 
 @bp.route('/login/google/authorize')
@@ -151,29 +398,190 @@ def google_authorize():
     # user = UserDAO.get_or_create_user_by_google_info(userinfo)
     # access_token = create_access_token(identity=user.id)  # Generate JWT token for the user
     # return jsonify(access_token=access_token)
-    oauth.google.authorize_access_token()  # Exchange authorization code for access token
-    userinfo = oauth.google.get('userinfo').json()  # Retrieve user information
+    from authlib.jose.errors import JoseError
+    google = google_oauth_client()
+    # Exchange authorization code for tokens; the ID token is verified locally
+    try:
+        token = google.authorize_access_token(claims_options=GOOGLE_ID_TOKEN_CLAIMS)
+    except (JoseError, ValueError) as e:  # ValueError: signed with a key not (yet) in the cache
+        current_app.logger.warning(f"Google ID token rejected: {e}")
+        return jsonify(error='Authentication failed'), 401
+    userinfo = token.get('userinfo')  # The ID token's claims
+    if userinfo is None:
+        userinfo = google.get('userinfo').json()  # No ID token in the response
+    if not google_email_verified(userinfo):
+        current_app.logger.warning("Google sign-in refused: email not verified")
+        return jsonify(error='Google account email is not verified'), 403
     user = UserDAO.get_or_create_user_by_google_info(userinfo)
 
     # Check if user is successfully retrieved or created
     if user:
-        access_token = create_access_token(identity=user.id)
         user_dto_response = UserDTO.from_model(user)
+        access_token = create_user_access_token(user_dto_response)
+        refresh_token = create_user_refresh_token(user_dto_response['id'])
         # Use if just want logged in confirmation
         response = make_response(jsonify(logged_in_as=user_dto_response['username'],
                                          first_name=user_dto_response['first_name'],
                                          last_name=user_dto_response['last_name'],
                                          email=user_dto_response['email'],
                                          auth_type=user_dto_response['auth_type'],
-                                         auth_token=access_token), 200)
+                                         auth_token=access_token,
+                                         refresh_token=refresh_token), 200)
 
-        if app.config['JWT_TOKEN_LOCATION'] == ['cookies']:
+        if current_app.config.get('JWT_TOKEN_LOCATION') == ['cookies']:
             set_access_cookies(response, access_token)  # Set the JWT as a cookie in the response
+            set_refresh_cookies(response, refresh_token)
         return response
 
     return jsonify(error='Authentication failed'), 401
 
 
+# Service-to-service
+BATCH_LOOKUP_MAX = 500  # ids + emails per request, unless BATCH_LOOKUP_MAX is configured
+# users.id is a SERIAL (INTEGER) column
+USER_ID_MAX = 2 ** 31 - 1
+
+
+def service_token_valid(config, token):
+    """
+    True if `token` is one of the configured SERVICE_TOKENS (constant-time compare).
+    """
+    if not token:
+        return False
+    return any(hmac.compare_digest(token.encode(), known.encode()) for known in config.get('SERVICE_TOKENS') or ())
+
+
+def service_required(fn):
+    """
+    Like @jwt_required(), for calls from other services: requires an
+    X-Service-Token header matching one of SERVICE_TOKENS.
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not service_token_valid(current_app.config, request.headers.get('X-Service-Token')):
+            return {'error': 'Invalid service token'}, 401
+        return fn(*args, **kwargs)
+    return wrapper
+
+
+def parse_batch_lookup(data, limit):
+    """
+    Validates a batch lookup body {"ids": [...], "emails": [...]}.
+
+    Returns (ids, emails); raises ValueError with a message for the client
+    """
+    if not isinstance(data, dict):
+        raise ValueError("Expected a JSON object with ids and/or emails")
+    ids, emails = data.get('ids') or [], data.get('emails') or []
+    if not isinstance(ids, list) or not isinstance(emails, list):
+        raise ValueError("ids and emails must be lists")
+    if not ids and not emails:
+        raise ValueError("Nothing to look up")
+    if len(ids) + len(emails) > limit:
+        raise ValueError(f"At most {limit} ids and emails per request")
+    if not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+        raise ValueError("ids must be integers")
+    if not all(1 <= i <= USER_ID_MAX for i in ids):
+        raise ValueError(f"ids must be between 1 and {USER_ID_MAX}")
+    if not all(isinstance(e, str) for e in emails):
+        raise ValueError("emails must be strings")
+    return ids, emails
+
+
+def batch_lookup_body(rows):
+    """
+    Yields the response in chunks: field names once, then one array per
+    user, e.g. {"fields":["id",...],"users":[[1,"al",...],...]}.
+    """
+    compact = functools.partial(json.dumps, separators=(',', ':'))
+    yield '{"fields":' + compact(PROFILE_COLUMNS) + ',"users":['
+    for i, row in enumerate(rows):
+        yield (',' if i else '') + compact(row)
+    yield ']}'
+
+
+@bp.route('/batch', methods=['POST'])
+@service_required
+def get_users_batch():
+    """
+    Resolves up to BATCH_LOOKUP_MAX user ids and/or emails to public
+    profiles in one query. Users that do not exist are left out.
+
+    Route: /batch
+    Method: POST, with an X-Service-Token header
+    Payload: {"ids": [1, 2], "emails": ["a@example.com"]}
+    """
+    try:
+        ids, emails = parse_batch_lookup(request.get_json(silent=True),
+                                         current_app.config.get('BATCH_LOOKUP_MAX', BATCH_LOOKUP_MAX))
+    except ValueError as e:
+        return {'error': str(e)}, 400
+
+    rows = UserDAO.get_users_by_ids(ids, emails)
+    return Response(batch_lookup_body(rows), 200, mimetype='application/json')
+
+
+LIST_PAGE_MAX = 200  # users per page, unless LIST_PAGE_MAX is configured
+
+
+def parse_list_query(args, max_limit):
+    """
+    Validates listing parameters: after (id cursor), limit, q (prefix of
+    username or email) and fields (comma-separated PROFILE_COLUMNS).
+
+    Returns keyword arguments for UserDAO.list_users; raises ValueError
+    """
+    try:
+        after = int(args.get('after', 0))
+        limit = int(args.get('limit', 50))
+    except ValueError:
+        raise ValueError("after and limit must be integers")
+    if not 0 <= after <= USER_ID_MAX:
+        raise ValueError(f"after must be between 0 and {USER_ID_MAX}")
+    if not 1 <= limit <= max_limit:
+        raise ValueError(f"limit must be between 1 and {max_limit}")
+
+    fields = ['id']
+    for field in (args.get('fields') or ','.join(PROFILE_COLUMNS)).split(','):
+        field = field.strip()
+        if field not in PROFILE_COLUMNS:
+            raise ValueError(f"Unknown field '{field}'")
+        if field not in fields:
+            fields.append(field)
+    return {'after': after, 'limit': limit, 'prefix': args.get('q') or None, 'fields': tuple(fields)}
+
+
+def list_users_body(fields, rows, next_after):
+    """
+    Yields a page in the batch lookup's compact form, plus the cursor for
+    the next page: {"fields":[...],"users":[[...],...],"next":123}.
+    """
+    compact = functools.partial(json.dumps, separators=(',', ':'))
+    yield '{"fields":' + compact(fields) + ',"users":['
+    for i, row in enumerate(rows):
+        yield (',' if i else '') + compact(row)
+    yield '],"next":' + compact(next_after) + '}'
+
+
+@bp.route('/list', methods=['GET'])
+@service_required
+def list_users():
+    """
+    Lists users by id, a page at a time, optionally filtered by a username
+    or email prefix. Pass the response's "next" as ?after= for the next page.
+
+    Route: /list?after=0&limit=50&q=ann&fields=id,username,email
+    Method: GET, with an X-Service-Token header
+    """
+    try:
+        options = parse_list_query(request.args, current_app.config.get('LIST_PAGE_MAX', LIST_PAGE_MAX))
+    except ValueError as e:
+        return {'error': str(e)}, 400
+
+    rows, next_after = UserDAO.list_users(**options)
+    return Response(list_users_body(options['fields'], rows, next_after), 200, mimetype='application/json')
+
+
 @bp.route('/', methods=['GET'])
 @jwt_required()
 def get_user():
@@ -183,6 +591,20 @@ def get_user():
     """
 
     current_user_id = get_jwt_identity()  # decodes token
+
+    # Tokens with profile claims answer from the verified token unless the
+    # profile changed since it was issued
+    claims = get_jwt()
+    if 'profile' in claims and not get_profile_versions(current_app.config).is_stale(current_user_id, claims.get('pv')):
+        profile = claims['profile']
+        return jsonify(username=profile['username'],
+                       first_name=profile['first_name'],
+                       last_name=profile['last_name'],
+                       email=profile['email'],
+                       auth_type=profile['auth_type'],
+                       id=profile['id']
+                       ), 200
+
     user = UserDAO.get_user_by_id(current_user_id)  # user is a dict
 
     if user:
@@ -199,6 +621,22 @@ def get_user():
     return jsonify(error='User not found'), 404
 
 
+def parse_user_patch(data):
+    """
+    Validates an account update body: only UPDATABLE_COLUMNS, each a
+    non-blank string that fits its column.
+
+    Returns the patch; raises ValueError with a message for the client
+    """
+    if not isinstance(data, dict):
+        raise ValueError("Expected a JSON object of fields to update")
+    for field, value in data.items():
+        if field not in UPDATABLE_COLUMNS:
+            raise ValueError("Invalid input")
+        check_user_field(field, value)
+    return dict(data)
+
+
 @bp.route('/update', methods=['PUT'])
 @jwt_required()
 def update_user():
@@ -207,37 +645,19 @@ def update_user():
 
     Returns the user info after updated
     """
-    data = request.get_json()  # user inputed updates
-    allowed_fields = ['username', 'first_name', 'last_name', 'password']
-
-    for field in data.keys():
-        if field not in allowed_fields:
-            return {'error': "Invalid input"}, 400
+    try:
+        patch = parse_user_patch(request.get_json(silent=True))  # only the fields the user sent are written
+    except ValueError as e:
+        return {'error': str(e)}, 400
 
     current_user_id = get_jwt_identity()  # get id of user
-    user_current = UserDAO.get_user_by_id(current_user_id)  # user model currently
-    user_dto_response = UserDTO.from_model(user_current)  # convert to dict
-    original = user_dto_response.copy()  # save incase needed for failure to update
-
-    # Update
-    for key, value in data.items():
-        if key == 'password':
-            user_dto_response[key] = hash_password(value)
-        else:
-            user_dto_response[key] = value
-
-    user_updated_bool = UserDAO.update_user(current_user_id, user_dto_response)  # update user
-    if user_updated_bool:
-        response = jsonify(username=user_dto_response['username'],
-                           first_name=user_dto_response['first_name'],
-                           last_name=user_dto_response['last_name'],
-                           email=user_dto_response['email'],
-                           auth_type=user_dto_response['auth_type'],
-                           id=user_dto_response['id']
-                           )
-        return response, 200
+    if 'password' in patch:
+        patch['password'] = run_password_task(hash_password, patch['password'], bcrypt_rounds())
 
-    return jsonify(error=f"Failed to update {original['username']}'s account"), 404
+    user_updated = UserDAO.update_user(current_user_id, patch)  # one UPDATE ... RETURNING
+    if user_updated is None:
+        return jsonify(error='User not found'), 404
+    return jsonify(user_profile(UserDTO.from_model(user_updated))), 200
 
 
 @bp.route('/delete', methods=['DELETE'])
@@ -250,13 +670,9 @@ def delete_user():
     Return message states username and email
     """
     current_user_id = get_jwt_identity()
-    current_user_obj = UserDAO.get_user_by_id(current_user_id)
-    if not current_user_obj:
+    deleted_user = UserDAO.delete_user(current_user_id)  # one DELETE ... RETURNING
+    if deleted_user is None:
         return {'error': 'User does not exist'}, 404
 
-    UserDAO.delete_user(current_user_id)
     return {
-        'message': f'Account for {current_user_obj.username} with email {current_user_obj.email} deleted successfully'}, 200
-
-
-app.register_blueprint(bp)
+        'message': f'Account for {deleted_user.username} with email {deleted_user.email} deleted successfully'}, 200
@@ -1,21 +1,30 @@
-from flask_sqlalchemy import SQLAlchemy
-from dataclasses import dataclass
+class UserRecord:
+    """
+    One row of the users table as plain attributes. __slots__ keeps it small
+    and there is no ORM instrumentation; columns a query did not select are
+    None.
+    """
+    __slots__ = ('id', 'username', 'email', 'first_name', 'last_name', 'password', 'auth_type',
+                 'oath_token', 'profile_version')
 
-db = SQLAlchemy()
+    def __init__(self, id=None, username=None, email=None, first_name=None, last_name=None, password=None,
+                 auth_type='local', oath_token=None, profile_version=None):
+        self.id = id
+        self.username = username
+        self.email = email
+        self.first_name = first_name
+        self.last_name = last_name
+        self.password = password  # Password can be None (SSO users, or not selected)
+        self.auth_type = auth_type
+        self.oath_token = oath_token
+        self.profile_version = profile_version  # Bumped on every profile update
 
-
-@dataclass
-class User(db.Model):
-    __tablename__ = 'user'
-
-    id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(100), nullable=False)
-    email = db.Column(db.String(255), nullable=False)  # Assuming email is a string
-    first_name = db.Column(db.String(100), nullable=False)   # Increased length for first_name
-    last_name = db.Column(db.String(100), nullable=False)   # Increased length for last_name
-    password = db.Column(db.String(100), nullable=True) # Password can be nullable
-    auth_type = db.Column(db.String(50), nullable=False, default='local')  # New field for authentication type
-    oath_token = db.Column(db.String(100), nullable=True) # Oath token can also be nullable
+    @classmethod
+    def from_row(cls, row):
+        """
+        Builds a record from a SQLAlchemy Row (or any mapping of column names).
+        """
+        return cls(**(row._mapping if hasattr(row, '_mapping') else row))
 
     def __repr__(self):
-        return f"<User {self.id}: {self.username}>"
\ No newline at end of file
+        return f"<User {self.id}: {self.username}>"
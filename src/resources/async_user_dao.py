@@ -0,0 +1,337 @@
+# src/resources/async_user_dao.py
+
+import asyncio
+import logging
+
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from resources.email_filter import REBUILD_BATCH, get_known_emails
+from resources.user_cache import get_profile_versions, get_user_cache
+# asyncpg prepares statements itself and caches them per connection, so the
+# shared queries run as plain text here (Query.text)
+from resources.user_dao import (
+    COUNT_USERS, CREATE_USER, DELETE_USER, EMAIL_FILTER_HORIZON, EMAILS_AFTER_ID, EMAILS_SINCE_XID,
+    GET_ACCOUNT_BY_ID, GET_LOGIN_BY_EMAIL, GET_PROFILES_BY_IDS, PROFILE_COLUMNS, REHASH_PASSWORD,
+    UPSERT_SSO_USER, UserWriteFailed, like_prefix, list_users_query, revoke_sessions, sso_user_data,
+    update_user_statement,
+)
+from user.connectors import CloudSQLConnector, load_connector_class
+from user.db import POOL_DEFAULTS, TimedAsyncQueuePool
+from util import metrics
+from util.password_pool import PasswordPoolSaturated, get_password_pool, run_password_task_async
+from util.utils import DEFAULT_ROUNDS, check_password, dummy_hash, hash_password, needs_rehash
+
+logger = logging.getLogger()
+
+
+class AsyncDatabase:
+    """
+    Async engine (asyncpg) and connector for one event loop. Created on
+    application startup and disposed on shutdown.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.connector = None
+        self.engine = None
+
+    async def start(self):
+        connector_class = load_connector_class(self.config.get('DB_CONNECTOR', CloudSQLConnector.name))
+        if connector_class is CloudSQLConnector:
+            self.connector = connector_class(self.config, loop=asyncio.get_running_loop())
+        else:
+            self.connector = connector_class(self.config)
+
+        setting = lambda key: self.config.get(key, POOL_DEFAULTS[key])
+        self.engine = create_async_engine(
+            "postgresql+asyncpg://",
+            async_creator=self.connector.connect_async,
+            poolclass=TimedAsyncQueuePool,
+            pool_size=setting('DB_POOL_SIZE'),
+            max_overflow=setting('DB_MAX_OVERFLOW'),
+            pool_timeout=setting('DB_POOL_TIMEOUT'),
+            pool_recycle=setting('DB_POOL_RECYCLE'),
+            pool_pre_ping=setting('DB_POOL_PRE_PING'),
+        )
+        metrics.instrument_engine(self.engine.sync_engine)
+        logger.info("Created async DB pool")
+
+    async def stop(self):
+        if self.engine is not None:
+            await self.engine.dispose()
+        if self.connector is not None:
+            await self.connector.close_async()
+        logger.info("Async DB pool closed.")
+
+
+class AsyncUserDAO:
+    """
+    asyncio counterpart of UserDAO. Rows are returned as dicts.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self.config = database.config
+        self._background = set()  # keeps fire-and-forget tasks referenced
+
+    async def get_user_by_id(self, user_id):
+        """
+        Retrieve a single user's profile by their ID, through the user cache.
+        """
+        cache = get_user_cache(self.config)
+        row = cache.lookup(user_id)
+        if row is None:
+            row = await self.load_user_profile(user_id)
+            cache.store(user_id, row)
+        return row
+
+    async def load_user_profile(self, user_id):
+        async with self.database.engine.connect() as connection:
+            row = (await connection.execute(GET_ACCOUNT_BY_ID.text, {'id': user_id})).fetchone()
+        return row._asdict() if row is not None else None
+
+    async def get_users_by_ids(self, ids=(), emails=()):
+        """
+        Resolves many users at once by id and/or email, like UserDAO.get_users_by_ids.
+        """
+        params = {'ids': list(ids), 'emails': [email.lower() for email in emails]}
+        async with self.database.engine.connect() as connection:
+            return [tuple(row) for row in await connection.execute(GET_PROFILES_BY_IDS.text, params)]
+
+    async def list_users(self, after=0, limit=50, prefix=None, fields=PROFILE_COLUMNS):
+        """
+        One keyset page of users, like UserDAO.list_users.
+        """
+        query = list_users_query(fields, bool(prefix))
+        params = {'after': after, 'limit': limit + 1, 'prefix': like_prefix(prefix) if prefix else None}
+        async with self.database.engine.connect() as connection:
+            rows = [tuple(row) for row in await connection.execute(query.text, params)]
+        if len(rows) > limit:
+            return rows[:limit], rows[limit - 1][0]
+        return rows, None
+
+    async def read_emails_after(self, connection, after):
+        """
+        Yields (id, email) for every user with an id above `after`, in id order.
+        """
+        while True:
+            rows = (await connection.execute(
+                EMAILS_AFTER_ID.text, {'after': after, 'limit': REBUILD_BATCH})).fetchall()
+            for row in rows:
+                yield row
+            if len(rows) < REBUILD_BATCH:
+                return
+            after = rows[-1][0]
+
+    async def read_emails_since(self, connection, horizon):
+        """
+        Yields (id, email) for every user inserted at or above `horizon`,
+        like user_dao.read_emails_since.
+        """
+        after = 0
+        while True:
+            rows = (await connection.execute(
+                EMAILS_SINCE_XID.text, {'horizon': str(horizon), 'after': after, 'limit': REBUILD_BATCH})).fetchall()
+            for row in rows:
+                yield row
+            if len(rows) < REBUILD_BATCH:
+                return
+            after = rows[-1][0]
+
+    async def read_horizon(self, connection):
+        """
+        The known-email filter's sync horizon, like user_dao.read_horizon.
+        """
+        return int((await connection.execute(EMAIL_FILTER_HORIZON.text)).scalar())
+
+    async def rebuild_email_filter(self, known):
+        """
+        Builds a new known-email filter from the users table and swaps it in,
+        like user_dao.rebuild_email_filter.
+        """
+        bloom, horizon = None, None
+        try:
+            async with self.database.engine.connect() as connection:
+                horizon = await self.read_horizon(connection)
+                bloom = known.new_filter((await connection.execute(COUNT_USERS.text)).scalar())
+                async for _, email in self.read_emails_after(connection, 0):
+                    bloom.add(email.lower())
+            logger.info(f"Known-email filter rebuilt: {bloom.stats()}")
+        except Exception as e:
+            logger.warning(f"Known-email filter rebuild failed: {e}")
+            bloom = None
+        finally:
+            known.finish_rebuild(bloom, horizon)
+
+    async def refresh_email_filter(self, wait=False):
+        """
+        Rebuilds the known-email filter if it is due, awaited with `wait`,
+        else as a background task.
+        """
+        known = get_known_emails(self.config)
+        if known is None or not known.begin_rebuild():
+            return
+        if wait:
+            await self.rebuild_email_filter(known)
+            return
+        task = asyncio.get_running_loop().create_task(self.rebuild_email_filter(known))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def email_may_exist(self, email):
+        """
+        False only if `email` is certainly not registered, like user_dao.email_may_exist.
+        """
+        known = get_known_emails(self.config)
+        if known is None:
+            return True
+        await self.refresh_email_filter()
+        if known.might_exist(email):
+            metrics.count_lookup('email_filter', 'maybe')
+            return True
+        since = known.begin_sync()
+        if since is None:
+            metrics.count_lookup('email_filter', 'unsynced')
+            return True
+        try:
+            async with self.database.engine.connect() as connection:
+                horizon = await self.read_horizon(connection)
+                known.finish_sync([row async for row in self.read_emails_since(connection, since)], horizon)
+        except Exception as e:
+            logger.warning(f"Known-email filter sync failed: {e}")
+            return True
+        if known.might_exist(email):
+            metrics.count_lookup('email_filter', 'maybe')
+            return True
+        metrics.count_lookup('email_filter', 'absent')
+        known.skip()
+        return False
+
+    async def create_user(self, user_data):
+        """
+        Creates user from a dict of columns (password already hashed).
+
+        Returns dict (status and resource) like UserDAO.create_user
+        """
+        try:
+            async with self.database.engine.connect() as connection:
+                row = (await connection.execute(CREATE_USER.text, user_data)).fetchone()
+                await connection.commit()
+        except Exception as e:
+            return {'error': str(e), 'resource': None, 'status': 500}
+
+        if row is None:
+            return {'status': 'User already exists', 'resource': None}
+        result_dict = row._asdict()
+        known = get_known_emails(self.config)
+        if known is not None:
+            known.add(result_dict['email'])
+        return {'status': f"Success. Created user with id = {result_dict['id']}", 'resource': result_dict}
+
+    async def update_user(self, user_id, patch):
+        """
+        Apply a partial update (password already hashed) in one statement.
+
+        Returns the updated row as a dict, or None if the user does not
+        exist. Raises UserWriteFailed like UserDAO.update_user
+        """
+        query, params = update_user_statement(user_id, patch)
+        try:
+            async with self.database.engine.connect() as connection:
+                row = (await connection.execute(query.text, params)).fetchone()
+                await connection.commit()
+        except Exception as e:
+            logger.error(f"Updating user {user_id} failed: {e}")
+            raise UserWriteFailed("Failed to update account") from e
+        if row is None:
+            return None
+        if patch:
+            get_user_cache(self.config).invalidate(user_id)
+            get_profile_versions(self.config).record(user_id, row.profile_version)
+        if 'password' in patch:
+            revoke_sessions(self.config, user_id)  # sign out other sessions
+        return row._asdict()
+
+    async def delete_user(self, user_id):
+        """
+        Delete a user from the database.
+
+        Returns the deleted user's username and email, or None if the user
+        did not exist. Raises UserWriteFailed like UserDAO.delete_user
+        """
+        try:
+            async with self.database.engine.connect() as connection:
+                row = (await connection.execute(DELETE_USER.text, {'id': user_id})).fetchone()
+                await connection.commit()
+        except Exception as e:
+            logger.error(f"Deleting user {user_id} failed: {e}")
+            raise UserWriteFailed("Failed to delete account") from e
+        if row is None:
+            return None
+        get_user_cache(self.config).invalidate(user_id)
+        get_profile_versions(self.config).record_deleted(user_id)
+        revoke_sessions(self.config, user_id)
+        return row._asdict()
+
+    async def get_user_by_credentials(self, email, password):
+        """
+        Retrieve a user by their email and password.
+
+        Returns None or the user's row without its password
+        """
+        user = None
+        # Emails the known-email filter rules out skip the query
+        if await self.email_may_exist(email):
+            async with self.database.engine.connect() as connection:
+                row = (await connection.execute(GET_LOGIN_BY_EMAIL.text, {'email': email})).fetchone()
+            user = row._asdict() if row is not None else None
+
+        rounds = self.config.get('BCRYPT_ROUNDS', DEFAULT_ROUNDS)
+        if not (user and user['password']):
+            # Unknown email or SSO account: same bcrypt cost as a real check
+            await run_password_task_async(self.config, check_password, password, dummy_hash(rounds))
+            return None
+        if await run_password_task_async(self.config, check_password, password, user['password']):
+            if needs_rehash(user['password'], rounds):
+                self.rehash_password_in_background(user['id'], password, user['password'], rounds)
+            user['password'] = None # To avoid sending back password
+            return user
+        return None
+
+    def rehash_password_in_background(self, user_id, password, old_hash, rounds):
+        """
+        Re-hashes a verified password with the configured work factor and
+        stores it without delaying the response.
+        """
+
+        async def rehash():
+            try:
+                future = get_password_pool(self.config).submit(hash_password, password, rounds)
+            except PasswordPoolSaturated:
+                logger.info(f"Password pool busy, deferring rehash for user {user_id}")
+                return
+            try:
+                new_hash = await asyncio.wrap_future(future)
+                async with self.database.engine.connect() as connection:
+                    await connection.execute(REHASH_PASSWORD.text, {'id': user_id, 'new_hash': new_hash, 'old_hash': old_hash})
+                    await connection.commit()
+            except Exception as e:
+                logger.error(f"Failed to rehash password for user {user_id}: {e}")
+
+        task = asyncio.get_running_loop().create_task(rehash())
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def get_or_create_user_by_google_info(self, google_info):
+        """
+        Retrieves a user by their Google information. If the user does not exist,
+        creates a new SSO user with the provided Google information, in one
+        upsert (see user_dao.UPSERT_SSO_USER).
+        """
+        async with self.database.engine.connect() as connection:
+            row = (await connection.execute(UPSERT_SSO_USER.text, sso_user_data(google_info))).fetchone()
+            await connection.commit()
+        known = get_known_emails(self.config)
+        if known is not None:
+            known.add(row.email)
+        return row._asdict()
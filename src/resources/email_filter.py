@@ -0,0 +1,220 @@
+# email_filter.py
+import hashlib
+import math
+import os
+import threading
+import time
+
+EMAIL_FILTER_DEFAULTS = {
+    # Keep an in-process filter of known emails so logins for emails that do
+    # not exist skip the database
+    'EMAIL_FILTER_ENABLED': True,
+    # Target false-positive rate at the filter's capacity
+    'EMAIL_FILTER_ERROR_RATE': 0.001,
+    # Seconds between syncs with the users table triggered by a miss; other
+    # misses in between are checked against the database
+    'EMAIL_FILTER_SYNC_INTERVAL': 1,
+    # Seconds between full rebuilds, which drop deleted users' emails
+    'EMAIL_FILTER_REBUILD_INTERVAL': 3600,
+}
+
+# Rows read per query while rebuilding
+REBUILD_BATCH = 50000
+# Room for growth between rebuilds, and a floor for small tables
+CAPACITY_HEADROOM = 1.25
+MIN_CAPACITY = 10000
+
+
+class BloomFilter:
+    """
+    Bloom filter of strings: `item in bloom` is False only for items never
+    added. Sized for `capacity` items at `error_rate` false positives.
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0  # distinct items added, approximately
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        new = False
+        for position in self._positions(item):
+            mask = 1 << (position & 7)
+            if not self.bits[position >> 3] & mask:
+                self.bits[position >> 3] |= mask
+                new = True
+        if new:
+            self.count += 1
+
+    def __contains__(self, item):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    def false_positive_rate(self):
+        """
+        Chance that an item never added tests positive, from the bits set.
+        """
+        filled = int.from_bytes(self.bits, 'little').bit_count() / self.size
+        return filled ** self.hashes
+
+    def stats(self):
+        return {
+            'items': self.count,
+            'capacity': self.capacity,
+            'hashes': self.hashes,
+            'memory_bytes': len(self.bits),
+            'false_positive_rate': round(self.false_positive_rate(), 6),
+        }
+
+
+class KnownEmails:
+    """
+    The emails in the users table as a Bloom filter, lower-cased. A miss
+    only means the email is not registered right after a sync: the DAO
+    syncs on a miss (at most once per `sync_interval`) and checks other
+    misses against the database. Deleted users stay in the filter until the
+    next rebuild; that only costs them a database lookup.
+
+    Syncs read the rows inserted by transactions at or above the horizon,
+    the xmin of the snapshot taken before the previous read: every
+    transaction below it had finished, so its rows were read then. Ids
+    cannot serve, since they are drawn before commit and a long import
+    commits low ids after others have committed higher ones.
+
+    The DAOs run the queries; this class keeps the state. Until the first
+    rebuild finishes every email may exist.
+    """
+
+    def __init__(self, error_rate, sync_interval, rebuild_interval):
+        self.error_rate = error_rate
+        self.sync_interval = sync_interval
+        self.rebuild_interval = rebuild_interval
+        self.bloom = None
+        self.horizon = None
+        self.built_at = None
+        self.synced_at = 0.0
+        self._lock = threading.Lock()
+        self._rebuilding = False
+        self.skipped = 0
+        self.syncs = 0
+
+    def might_exist(self, email):
+        bloom = self.bloom
+        return bloom is None or email.lower() in bloom
+
+    def skip(self):
+        """
+        Counts a lookup the filter answered without the database.
+        """
+        with self._lock:
+            self.skipped += 1
+
+    def add(self, email):
+        """
+        Adds an email this worker registered. Leaves the horizon alone:
+        other workers' transactions may still be open.
+        """
+        bloom = self.bloom
+        if bloom is not None:
+            with self._lock:
+                bloom.add(email.lower())
+
+    def begin_sync(self):
+        """
+        Returns the horizon to sync rows from, or None if the last sync was
+        under `sync_interval` ago (or there is nothing to sync into yet);
+        the miss then needs the database.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self.bloom is None or now - self.synced_at < self.sync_interval:
+                return None
+            self.synced_at = now
+            self.syncs += 1
+            return self.horizon
+
+    def finish_sync(self, rows, horizon):
+        """
+        Adds (id, email) rows read after begin_sync(), from transactions at
+        or above the old horizon; `horizon` was read before them.
+        """
+        with self._lock:
+            for user_id, email in rows:
+                self.bloom.add(email.lower())
+            if horizon > self.horizon:
+                self.horizon = horizon
+
+    def begin_rebuild(self):
+        """
+        True if a rebuild is due and this caller should run it.
+        """
+        with self._lock:
+            due = self.built_at is None or time.monotonic() - self.built_at >= self.rebuild_interval
+            if not due or self._rebuilding:
+                return False
+            self._rebuilding = True
+            return True
+
+    def new_filter(self, row_count):
+        return BloomFilter(max(MIN_CAPACITY, math.ceil(row_count * CAPACITY_HEADROOM)), self.error_rate)
+
+    def finish_rebuild(self, bloom, horizon):
+        """
+        Swaps in a filter built from the whole table (None if it failed),
+        with the horizon read before the table was.
+        """
+        with self._lock:
+            self._rebuilding = False
+            if bloom is None:
+                return
+            self.bloom = bloom
+            # Rows committed while the table was being read are picked up by
+            # the next sync, which may run straight away
+            self.horizon = horizon
+            self.built_at = time.monotonic()
+            self.synced_at = 0.0
+
+    def stats(self):
+        bloom = self.bloom
+        with self._lock:
+            stats = {
+                'ready': bloom is not None,
+                'horizon': self.horizon,
+                'skipped_lookups': self.skipped,
+                'syncs': self.syncs,
+                'age_seconds': round(time.monotonic() - self.built_at, 1) if self.built_at is not None else None,
+            }
+        if bloom is not None:
+            stats.update(bloom.stats())
+        return stats
+
+
+_known = None
+_known_pid = None
+_known_lock = threading.Lock()
+
+
+def get_known_emails(config):
+    """
+    Returns the process-wide known-email filter, or None if it is disabled.
+    """
+    global _known, _known_pid
+    if not config.get('EMAIL_FILTER_ENABLED', EMAIL_FILTER_DEFAULTS['EMAIL_FILTER_ENABLED']):
+        return None
+    if _known is None or _known_pid != os.getpid():
+        with _known_lock:
+            if _known is None or _known_pid != os.getpid():
+                setting = lambda key: config.get(key, EMAIL_FILTER_DEFAULTS[key])
+                _known = KnownEmails(setting('EMAIL_FILTER_ERROR_RATE'), setting('EMAIL_FILTER_SYNC_INTERVAL'),
+                                     setting('EMAIL_FILTER_REBUILD_INTERVAL'))
+                _known_pid = os.getpid()
+    return _known
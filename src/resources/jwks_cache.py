@@ -0,0 +1,203 @@
+# jwks_cache.py
+import asyncio
+import email.utils
+import logging
+import os
+import re
+import threading
+import time
+
+import requests
+
+logger = logging.getLogger()
+
+JWKS_DEFAULTS = {
+    # Seconds to keep the signing keys when the response has no max-age
+    'GOOGLE_JWKS_DEFAULT_TTL': 3600,
+    # Refresh in the background this many seconds before the keys expire
+    'GOOGLE_JWKS_REFRESH_MARGIN': 300,
+    # Least seconds between fetches caused by a token signed with an unknown key
+    'GOOGLE_JWKS_MIN_REFETCH_INTERVAL': 10,
+    # Seconds to wait for the key endpoint
+    'GOOGLE_JWKS_TIMEOUT': 5,
+}
+
+# Retry delay after a failed background refresh, doubling up to the maximum
+RETRY_MIN = 5
+RETRY_MAX = 300
+
+_MAX_AGE = re.compile(r'max-age=(\d+)')
+
+
+def response_ttl(headers, default):
+    """
+    Seconds a JWKS response may be cached: Cache-Control max-age less Age,
+    else until Expires, else `default`.
+    """
+    match = _MAX_AGE.search(headers.get('Cache-Control', ''))
+    if match:
+        return max(0, int(match.group(1)) - int(headers.get('Age', 0) or 0))
+    if headers.get('Expires'):
+        try:
+            return max(0, email.utils.parsedate_to_datetime(headers['Expires']).timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+    return default
+
+
+class JWKSCache:
+    """
+    An issuer's signing keys (a JWK set), kept for as long as the issuer's
+    cache headers allow and refreshed in the background before they expire.
+    Tokens are verified against the cached keys with no request; only a key
+    id the cache has not seen (a rotation that got ahead of the refresh)
+    fetches the set again, at most once per `min_refetch_interval`. When a
+    fetch fails the previous keys stay in use.
+    """
+
+    def __init__(self, uri, default_ttl, refresh_margin, min_refetch_interval, timeout, fetch=None):
+        self.uri = uri
+        self.default_ttl = default_ttl
+        self.refresh_margin = refresh_margin
+        self.min_refetch_interval = min_refetch_interval
+        self.timeout = timeout
+        self._fetch = fetch or self._http_fetch
+        self.jwk_set = None
+        self.expires_at = 0.0
+        self.refresh_at = 0.0
+        self.fetched_at = None
+        self.attempted_at = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.fetches = 0
+        self.failures = 0
+
+    def _http_fetch(self):
+        response = requests.get(self.uri, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json(), response_ttl(response.headers, self.default_ttl)
+
+    def refresh(self):
+        """
+        Fetches the key set now; False (keeping the old keys) if that fails.
+        """
+        with self._lock:
+            self.attempted_at = time.monotonic()
+        try:
+            jwk_set, ttl = self._fetch()
+            if not jwk_set.get('keys'):
+                raise ValueError("no keys in JWK set")
+        except Exception as e:
+            with self._lock:
+                self.failures += 1
+            logger.warning(f"JWKS fetch from {self.uri} failed: {e}")
+            return False
+        with self._lock:
+            self.jwk_set = jwk_set
+            self.fetched_at = time.monotonic()
+            self.expires_at = self.fetched_at + ttl
+            # Short-lived sets are refreshed halfway through instead
+            self.refresh_at = self.fetched_at + max(ttl - self.refresh_margin, ttl / 2)
+            self.fetches += 1
+        return True
+
+    def cached(self, force=False):
+        """
+        The key set if it can be used without a fetch, else None. `force`
+        asks for fresh keys, because a token names a key id not in the set.
+        """
+        with self._lock:
+            if self.jwk_set is None:
+                return None
+            now = time.monotonic()
+            if (force or now >= self.expires_at) and now - self.attempted_at >= self.min_refetch_interval:
+                return None
+            return self.jwk_set
+
+    def key_set(self, force=False):
+        """
+        The key set, fetched first if there is none, it expired (and the
+        background refresh did not replace it) or `force` is set.
+        """
+        jwk_set = self.cached(force)
+        if jwk_set is None:
+            self.refresh()
+            jwk_set = self.jwk_set
+            if jwk_set is None:
+                raise RuntimeError(f"No signing keys available from {self.uri}")
+        return jwk_set
+
+    async def key_set_async(self, force=False):
+        """
+        key_set() for the event loop; a fetch runs on a worker thread.
+        """
+        return self.cached(force) or await asyncio.to_thread(self.key_set, force)
+
+    def _next_refresh_in(self, retry):
+        if retry:
+            return retry
+        with self._lock:
+            if self.jwk_set is None:
+                return 0
+            return max(1.0, self.refresh_at - time.monotonic())
+
+    def _run(self):
+        retry = 0
+        while not self._stop.wait(self._next_refresh_in(retry)):
+            if self.refresh():
+                retry = 0
+            else:
+                retry = min(RETRY_MAX, max(RETRY_MIN, retry * 2))
+
+    def start(self):
+        """
+        Starts the background refresher (once); the first fetch happens on
+        its thread, so startup does not wait for the issuer.
+        """
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='jwks-refresh', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            return {
+                'uri': self.uri,
+                'keys': [key.get('kid') for key in (self.jwk_set or {}).get('keys', ())],
+                'age_seconds': round(now - self.fetched_at, 1) if self.fetched_at is not None else None,
+                'expires_in_seconds': round(self.expires_at - now, 1) if self.fetched_at is not None else None,
+                'fetches': self.fetches,
+                'failures': self.failures,
+            }
+
+
+_caches = {}
+_caches_pid = None
+_caches_lock = threading.Lock()
+
+
+def get_jwks_cache(config, uri):
+    """
+    Returns the process-wide key cache for `uri`, creating it from `config`
+    and starting its refresher on first use.
+    """
+    global _caches, _caches_pid
+    cache = _caches.get(uri) if _caches_pid == os.getpid() else None
+    if cache is None:
+        with _caches_lock:
+            if _caches_pid != os.getpid():
+                _caches, _caches_pid = {}, os.getpid()
+            cache = _caches.get(uri)
+            if cache is None:
+                setting = lambda key: config.get(key, JWKS_DEFAULTS[key])
+                cache = _caches[uri] = JWKSCache(
+                    uri, setting('GOOGLE_JWKS_DEFAULT_TTL'), setting('GOOGLE_JWKS_REFRESH_MARGIN'),
+                    setting('GOOGLE_JWKS_MIN_REFETCH_INTERVAL'), setting('GOOGLE_JWKS_TIMEOUT'))
+                cache.start()
+    return cache
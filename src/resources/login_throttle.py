@@ -0,0 +1,251 @@
+# login_throttle.py
+import logging
+import math
+import os
+import threading
+import time
+
+from cachetools import TTLCache
+
+from resources.user_cache import shared_client
+
+logger = logging.getLogger()
+
+LOGIN_THROTTLE_DEFAULTS = {
+    # 'memory' (per process), 'shared' (LOGIN_THROTTLE_URL) or 'none'
+    'LOGIN_THROTTLE_BACKEND': 'memory',
+    # Same forms as USER_CACHE_URL; defaults to USER_CACHE_URL
+    'LOGIN_THROTTLE_URL': None,
+    # Length of the sliding window in seconds
+    'LOGIN_THROTTLE_WINDOW': 300,
+    # Failed logins allowed per email within a window
+    'LOGIN_MAX_FAILURES_PER_EMAIL': 5,
+    # Failed logins allowed per client address within a window
+    'LOGIN_MAX_FAILURES_PER_CLIENT': 50,
+    # Counters kept by the in-process backend; least recently used go first
+    'LOGIN_THROTTLE_MAXSIZE': 100000,
+}
+
+
+class LoginThrottled(Exception):
+    """
+    Raised before a login is checked when its email or client has failed
+    too often recently.
+    """
+
+    def __init__(self, retry_after):
+        super().__init__("Too many failed logins")
+        self.retry_after = retry_after
+
+
+class InProcessCounters:
+    """
+    Per-process counters that expire `ttl` seconds after they were created.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self._counts = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._counts.get(key, 0)
+
+    def incr(self, key):
+        with self._lock:
+            count = self._counts[key] = self._counts.get(key, 0) + 1
+            return count
+
+    def decr(self, key):
+        with self._lock:
+            if key in self._counts:
+                self._counts[key] -= 1
+
+    def delete(self, key):
+        with self._lock:
+            self._counts.pop(key, None)
+
+
+class SharedCounters:
+    """
+    Counters shared by all workers through a Redis-compatible client
+    (get, incr, decr, expire, delete).
+    """
+
+    def __init__(self, client, ttl, prefix='login:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        return int(raw) if raw is not None else 0
+
+    def incr(self, key):
+        count = self.client.incr(self.prefix + key)
+        if count == 1:
+            self.client.expire(self.prefix + key, self.ttl)
+        return count
+
+    def decr(self, key):
+        self.client.decr(self.prefix + key)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+
+class SlidingWindow:
+    """
+    Sliding-window counter: the current fixed window's count plus the
+    previous window's, weighted by how much of it still overlaps the last
+    `window` seconds. Two counters per key, whatever the traffic.
+    """
+
+    def __init__(self, counters, limit, window):
+        self.counters = counters
+        self.limit = limit
+        self.window = window
+
+    def _keys(self, key, now):
+        index = int(now // self.window)
+        return f"{key}:{index}", f"{key}:{index - 1}", now / self.window - index
+
+    def retry_after(self, key, now=None):
+        """
+        Seconds until `key` can take another attempt; 0 if it can now.
+        """
+        now = time.time() if now is None else now
+        current_key, previous_key, elapsed = self._keys(key, now)
+        current = self.counters.get(current_key)
+        if current >= self.limit:
+            # Blocked until this window becomes the previous one and its
+            # weight falls enough for one more attempt
+            free_at = 1 + max(0.0, 1 - (self.limit - 1) / current)
+        else:
+            previous = self.counters.get(previous_key)
+            if previous * (1 - elapsed) + current + 1 <= self.limit:
+                return 0
+            # The previous window's weight falls until one more attempt fits
+            free_at = 1 - (self.limit - current - 1) / previous
+        return max(1, math.ceil((free_at - elapsed) * self.window))
+
+    def acquire(self, key, now=None):
+        """
+        Counts an attempt for `key` with one atomic increment. Returns the
+        counter it went into and 0, or, if it took `key` over the limit,
+        takes it back and returns None and the seconds to wait.
+        """
+        now = time.time() if now is None else now
+        current_key, previous_key, elapsed = self._keys(key, now)
+        current = self.counters.incr(current_key)
+        if self.counters.get(previous_key) * (1 - elapsed) + current <= self.limit:
+            return current_key, 0
+        self.counters.decr(current_key)
+        return None, max(1, self.retry_after(key, now))
+
+    def reset(self, key, now=None):
+        current_key, previous_key, _ = self._keys(key, time.time() if now is None else now)
+        self.counters.delete(current_key)
+        self.counters.delete(previous_key)
+
+
+class LoginThrottle:
+    """
+    Failed-login limits per email and per client address. `reserve` runs
+    before the user is looked up, so throttled attempts cost no query and
+    no bcrypt work. It counts the attempt as a failure up front, so
+    concurrent attempts cannot all pass before any failure is recorded; a
+    successful login gives it back. Backend failures let logins through.
+    """
+
+    def __init__(self, per_email, per_client):
+        self.per_email = per_email
+        self.per_client = per_client
+        self._lock = threading.Lock()
+        self.throttled = 0
+
+    def reserve(self, email, client):
+        """
+        Counts a login attempt against `email` and `client`, or raises
+        LoginThrottled if either is over its limit. Returns the reservation
+        for release() and record_success(); a failed login keeps it.
+        """
+        if self.per_email is None:
+            return []
+        taken, wait = [], 0
+        try:
+            for window, key in ((self.per_email, 'email:' + str(email).lower()),
+                                (self.per_client, 'client:' + str(client))):
+                counter_key, wait = window.acquire(key)
+                if wait:
+                    break
+                taken.append((window, counter_key))
+        except Exception as e:
+            logger.warning(f"Login throttle failed: {e}")
+            self.release(taken)
+            return []
+        if wait:
+            self.release(taken)
+            with self._lock:
+                self.throttled += 1
+            raise LoginThrottled(wait)
+        return taken
+
+    def release(self, reservation):
+        """
+        Takes back a reserved attempt that was not a failed login.
+        """
+        for window, counter_key in reservation:
+            try:
+                window.counters.decr(counter_key)
+            except Exception as e:
+                logger.warning(f"Login throttle write failed: {e}")
+
+    def record_success(self, email, reservation):
+        """
+        Releases the attempt and clears the email's failures; the client's stay.
+        """
+        if self.per_email is None:
+            return
+        self.release(reservation)
+        try:
+            self.per_email.reset('email:' + str(email).lower())
+        except Exception as e:
+            logger.warning(f"Login throttle write failed: {e}")
+
+
+_throttle = None
+_throttle_pid = None
+_throttle_lock = threading.Lock()
+
+
+def build_login_throttle(config):
+    setting = lambda key: config.get(key, LOGIN_THROTTLE_DEFAULTS[key])
+    kind = setting('LOGIN_THROTTLE_BACKEND')
+    window = setting('LOGIN_THROTTLE_WINDOW')
+    if kind == 'none':
+        return LoginThrottle(None, None)
+    if kind == 'memory':
+        counters = InProcessCounters(setting('LOGIN_THROTTLE_MAXSIZE'), 2 * window)
+    elif kind == 'shared':
+        url = setting('LOGIN_THROTTLE_URL') or config.get('USER_CACHE_URL')
+        counters = SharedCounters(shared_client(url), 2 * window)
+    else:
+        raise ValueError(f"Unknown LOGIN_THROTTLE_BACKEND '{kind}'")
+    return LoginThrottle(
+        SlidingWindow(counters, setting('LOGIN_MAX_FAILURES_PER_EMAIL'), window),
+        SlidingWindow(counters, setting('LOGIN_MAX_FAILURES_PER_CLIENT'), window),
+    )
+
+
+def get_login_throttle(config):
+    """
+    Returns the process-wide login throttle, creating it from `config` on first use.
+    """
+    global _throttle, _throttle_pid
+    if _throttle is None or _throttle_pid != os.getpid():
+        with _throttle_lock:
+            if _throttle is None or _throttle_pid != os.getpid():
+                _throttle = build_login_throttle(config)
+                _throttle_pid = os.getpid()
+    return _throttle
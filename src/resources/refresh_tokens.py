@@ -0,0 +1,166 @@
+# refresh_tokens.py
+import logging
+import os
+import threading
+import time
+import uuid
+
+from resources.user_cache import ExpiringStore, require_shared_state, shared_client
+
+logger = logging.getLogger()
+
+REFRESH_TOKEN_DEFAULTS = {
+    # 'memory' (per process) or 'shared' (REFRESH_TOKEN_URL)
+    'REFRESH_TOKEN_BACKEND': 'memory',
+    # Same forms as USER_CACHE_URL; defaults to USER_CACHE_URL
+    'REFRESH_TOKEN_URL': None,
+    # Spent tokens the in-process backend can hold; refreshes are refused
+    # (fail closed) while it is full. Revocations are always kept.
+    'REFRESH_TOKEN_MAXSIZE': 100000,
+}
+
+
+class RefreshTokenRejected(Exception):
+    """
+    Raised when a refresh token cannot be exchanged: already spent, its
+    session was revoked, or the revocation store could not be read.
+    """
+
+
+class SharedStore:
+    """
+    Entries shared by all workers through a Redis-compatible client (get,
+    set with ex= and nx=). The server must not evict keys before they
+    expire (Redis maxmemory-policy noeviction).
+    """
+
+    def __init__(self, client, prefix='refresh:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        return float(raw) if raw is not None else None
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, value, ex=max(1, int(ttl)))
+
+    def add(self, key, value, ttl):
+        return bool(self.client.set(self.prefix + key, value, ex=max(1, int(ttl)), nx=True))
+
+
+class RefreshTokens:
+    """
+    Rotation state for refresh tokens. Every login starts a session (a
+    token family, the `fam` claim, started at `fat`); each refresh spends
+    its token and issues the next one in the same family. The store holds
+    only revocations:
+    - spent token ids, until the token would have expired;
+    - families revoked because a spent token came back, which means it
+      was copied;
+    - per user, when their sessions were last revoked (password change or
+      deletion); families started before then are refused.
+    """
+
+    def __init__(self, store, lifetime):
+        self.store = store
+        self.lifetime = lifetime
+        self._lock = threading.Lock()
+        self.rotated = 0
+        self.reused = 0
+
+    @staticmethod
+    def new_family():
+        """
+        Claims for the first refresh token of a new session.
+        """
+        return {'fam': uuid.uuid4().hex, 'fat': time.time()}
+
+    def rotate(self, claims, user_id):
+        """
+        Spends the refresh token with decoded `claims`, returning the claims
+        for its successor. Raises RefreshTokenRejected.
+        """
+        family, started = claims.get('fam'), claims.get('fat')
+        if family is None or started is None:
+            raise RefreshTokenRejected("Not a session refresh token")
+        try:
+            if self.store.get('family:' + family) is not None:
+                raise RefreshTokenRejected("Session revoked")
+            revoked_before = self.store.get(f"user:{user_id}")
+            if revoked_before is not None and started < revoked_before:
+                raise RefreshTokenRejected("Session revoked")
+            first_use = self.store.add('jti:' + claims['jti'], 1, max(1, claims['exp'] - time.time()))
+            if not first_use:
+                # Someone holds a copy of this session's tokens; end it for both
+                self.store.set('family:' + family, 1, self.lifetime)
+        except RefreshTokenRejected:
+            raise
+        except Exception as e:
+            logger.warning(f"Refresh token store failed: {e}")
+            raise RefreshTokenRejected("Cannot refresh now")
+        with self._lock:
+            if first_use:
+                self.rotated += 1
+            else:
+                self.reused += 1
+        if not first_use:
+            logger.warning(f"Refresh token reused; revoked session {family} of user {user_id}")
+            raise RefreshTokenRejected("Refresh token reused")
+        return {'fam': family, 'fat': started}
+
+    def revoke_user(self, user_id):
+        """
+        Ends every session of `user_id` started before now.
+        """
+        try:
+            self.store.set(f"user:{user_id}", time.time(), self.lifetime)
+        except Exception as e:
+            logger.error(f"Failed to revoke refresh tokens of user {user_id}: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {'rotated': self.rotated, 'reused': self.reused}
+
+
+_tokens = None
+_tokens_pid = None
+_tokens_lock = threading.Lock()
+
+
+def refresh_lifetime(config):
+    """
+    JWT_REFRESH_TOKEN_EXPIRES in seconds (Flask-JWT-Extended's default is 30 days).
+    """
+    expires = config.get('JWT_REFRESH_TOKEN_EXPIRES')
+    if hasattr(expires, 'total_seconds'):
+        return int(expires.total_seconds())
+    return int(expires or 30 * 24 * 3600)
+
+
+def build_refresh_tokens(config):
+    setting = lambda key: config.get(key, REFRESH_TOKEN_DEFAULTS[key])
+    kind = setting('REFRESH_TOKEN_BACKEND')
+    url = setting('REFRESH_TOKEN_URL') or config.get('USER_CACHE_URL')
+    lifetime = refresh_lifetime(config)
+    if kind not in ('memory', 'shared'):
+        raise ValueError(f"Unknown REFRESH_TOKEN_BACKEND '{kind}'")
+    require_shared_state(config, 'Refresh token reuse detection', 'REFRESH_TOKEN_BACKEND', kind, url)
+    if kind == 'memory':
+        store = ExpiringStore(lifetime, maxsize=setting('REFRESH_TOKEN_MAXSIZE'))
+    else:
+        store = SharedStore(shared_client(url))
+    return RefreshTokens(store, lifetime)
+
+
+def get_refresh_tokens(config):
+    """
+    Returns the process-wide refresh token state, creating it from `config` on first use.
+    """
+    global _tokens, _tokens_pid
+    if _tokens is None or _tokens_pid != os.getpid():
+        with _tokens_lock:
+            if _tokens is None or _tokens_pid != os.getpid():
+                _tokens = build_refresh_tokens(config)
+                _tokens_pid = os.getpid()
+    return _tokens
@@ -0,0 +1,171 @@
+# signing_keys.py
+import base64
+import hashlib
+import json
+import os
+import threading
+
+import click
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
+from flask import current_app
+from flask_jwt_extended.default_callbacks import default_decode_key_callback, default_encode_key_callback
+from jwt import InvalidTokenError
+from jwt.algorithms import OKPAlgorithm, RSAAlgorithm
+
+SIGNING_KEY_DEFAULTS = {
+    # Private keys (PEM text or paths to PEM files); the first signs, all verify
+    # and are published. Empty: tokens are signed with JWT_SECRET_KEY (HS256).
+    'JWT_SIGNING_KEYS': [],
+    # Cache-Control max-age of the published key set, in seconds
+    'JWKS_MAX_AGE': 3600,
+}
+
+# JWS algorithm for each supported key type
+KEY_ALGORITHMS = {rsa.RSAPrivateKey: 'RS256', ed25519.Ed25519PrivateKey: 'EdDSA'}
+
+
+def key_algorithm(private_key):
+    for key_type, algorithm in KEY_ALGORITHMS.items():
+        if isinstance(private_key, key_type):
+            return algorithm
+    raise ValueError(f"Unsupported signing key type {type(private_key).__name__}; use RSA or Ed25519")
+
+
+def load_private_key(source):
+    """
+    A private key from PEM text or the path of a PEM file.
+    """
+    if isinstance(source, str) and '-----BEGIN' not in source:
+        with open(source, 'rb') as f:
+            source = f.read()
+    if isinstance(source, str):
+        source = source.encode('ascii')
+    return serialization.load_pem_private_key(source, password=None)
+
+
+def public_jwk(public_key, algorithm):
+    """
+    The public JWK of a key, its kid being the RFC 7638 thumbprint.
+    """
+    to_jwk = RSAAlgorithm.to_jwk if algorithm == 'RS256' else OKPAlgorithm.to_jwk
+    jwk = to_jwk(public_key, as_dict=True)
+    required = {name: jwk[name] for name in ('crv', 'e', 'kty', 'n', 'x') if name in jwk}
+    digest = hashlib.sha256(json.dumps(required, sort_keys=True, separators=(',', ':')).encode('utf-8')).digest()
+    kid = base64.urlsafe_b64encode(digest).rstrip(b'=').decode('ascii')
+    return dict(jwk, kid=kid, alg=algorithm, use='sig')
+
+
+class KeyRing:
+    """
+    Asymmetric keys for the service's JWTs. Tokens are signed with the first
+    key and name it in their `kid` header; any key on the ring verifies
+    the tokens it signed. The public halves are published as a JWK set, so
+    other services verify tokens themselves instead of asking this one.
+
+    Rotation is a config change, one step per deploy:
+    1. add the new key second, so it is published before anything uses it;
+    2. after JWKS_MAX_AGE, move it first, so it signs;
+    3. once tokens signed with the old key have expired (the refresh token
+       lifetime), remove the old key.
+    """
+
+    def __init__(self, private_keys, algorithm, max_age):
+        if not private_keys:
+            raise ValueError("JWT_SIGNING_KEYS is empty")
+        self.algorithm = algorithm
+        self.max_age = max_age
+        self._verify = {}
+        jwks = []
+        for private_key in private_keys:
+            jwk = public_jwk(private_key.public_key(), key_algorithm(private_key))
+            self._verify[jwk['kid']] = (private_key.public_key(), jwk['alg'])
+            jwks.append(jwk)
+        self.signing_key = private_keys[0]
+        self.signing_kid = jwks[0]['kid']
+        if jwks[0]['alg'] != algorithm:
+            raise ValueError(f"JWT_ALGORITHM is '{algorithm}' but the first signing key is for {jwks[0]['alg']}")
+        # Served as is: the set only changes with the config
+        self.jwks_body = json.dumps({'keys': jwks}, separators=(',', ':')).encode('utf-8')
+        self.etag = hashlib.sha256(self.jwks_body).hexdigest()[:32]
+
+    def verification_key(self, header):
+        """
+        The public key for a token's header. Raises InvalidTokenError for a
+        key that is not on the ring, or an algorithm other than the key's.
+        """
+        kid = header.get('kid')
+        if kid not in self._verify:
+            raise InvalidTokenError("Token signed with an unknown key")
+        public_key, algorithm = self._verify[kid]
+        if header.get('alg') != algorithm:
+            raise InvalidTokenError(f"Key {kid} only verifies {algorithm} tokens")
+        return public_key
+
+
+_rings = {}
+_rings_lock = threading.Lock()
+
+
+def get_key_ring(config):
+    """
+    The key ring for `config`'s JWT_SIGNING_KEYS, loaded once; None when
+    tokens are signed with JWT_SECRET_KEY.
+    """
+    setting = lambda key: config.get(key, SIGNING_KEY_DEFAULTS[key])
+    sources = setting('JWT_SIGNING_KEYS')
+    if not sources:
+        return None
+    cache_key = (tuple(sources), config.get('JWT_ALGORITHM'), setting('JWKS_MAX_AGE'))
+    ring = _rings.get(cache_key)
+    if ring is None:
+        with _rings_lock:
+            ring = _rings.get(cache_key)
+            if ring is None:
+                ring = _rings[cache_key] = KeyRing([load_private_key(source) for source in sources],
+                                                   config.get('JWT_ALGORITHM'), setting('JWKS_MAX_AGE'))
+    return ring
+
+
+def init_jwt_keys(jwt):
+    """
+    Has `jwt` (a JWTManager) sign and verify with the app's key ring when
+    JWT_SIGNING_KEYS is set, and with JWT_SECRET_KEY as before otherwise.
+    """
+
+    @jwt.encode_key_loader
+    def encode_key(identity):
+        ring = get_key_ring(current_app.config)
+        return ring.signing_key if ring else default_encode_key_callback(identity)
+
+    @jwt.decode_key_loader
+    def decode_key(header, payload):
+        ring = get_key_ring(current_app.config)
+        return ring.verification_key(header) if ring else default_decode_key_callback(header, payload)
+
+    @jwt.additional_headers_loader
+    def key_id_header(identity):
+        ring = get_key_ring(current_app.config)
+        return {'kid': ring.signing_kid} if ring else {}
+
+
+@click.command('generate-jwt-key')
+@click.argument('output', type=click.Path(dir_okay=False, writable=True))
+@click.option('--algorithm', type=click.Choice(['RS256', 'EdDSA']), default='EdDSA', show_default=True)
+@click.option('--bits', default=3072, show_default=True, help='RSA key size.')
+def generate_jwt_key_command(output, algorithm, bits):
+    """Write a new JWT signing key to OUTPUT, readable by its owner only."""
+    if algorithm == 'RS256':
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=bits)
+    else:
+        private_key = ed25519.Ed25519PrivateKey.generate()
+    pem = private_key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                    serialization.NoEncryption())
+    try:
+        fd = os.open(output, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        raise click.ClickException(f"{output} exists; not overwriting a key")
+    with os.fdopen(fd, 'wb') as f:
+        f.write(pem)
+    kid = public_jwk(private_key.public_key(), algorithm)['kid']
+    click.echo(f"Wrote {algorithm} key {kid} to {output}; add it to JWT_SIGNING_KEYS (second, until published)")
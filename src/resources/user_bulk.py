@@ -0,0 +1,371 @@
+# src/resources/user_bulk.py
+"""
+`flask users import` / `flask users export`: bulk loading and dumping of
+users as CSV or JSON Lines, streamed through Postgres COPY in fixed-size
+batches so memory use does not grow with the file.
+"""
+import csv
+import io
+import itertools
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+import sqlalchemy
+from flask import current_app
+from flask.cli import AppGroup
+
+from resources.user_cache import get_profile_versions, get_user_cache
+from resources.user_dao import revoke_sessions
+from user.db import DatabaseManager
+from util.password_pool import bcrypt_rounds
+from util.utils import hash_password
+
+logger = logging.getLogger()
+
+IMPORT_COLUMNS = ['username', 'email', 'first_name', 'last_name', 'password', 'auth_type']
+EXPORT_COLUMNS = ['id', 'username', 'email', 'first_name', 'last_name', 'auth_type']
+REQUIRED_FIELDS = ['username', 'email', 'first_name', 'last_name']
+AUTH_TYPES = ('local', 'sso')
+MAX_FIELD_LENGTH = 255
+
+CONFLICT_POLICIES = {
+    # Keep the existing user, drop the incoming row
+    'skip': "ON CONFLICT ((lower(email))) DO NOTHING",
+    # Overwrite the profile; the password only if the row carries one
+    'update': """
+        ON CONFLICT ((lower(email))) DO UPDATE SET
+            username = EXCLUDED.username,
+            first_name = EXCLUDED.first_name,
+            last_name = EXCLUDED.last_name,
+            password = COALESCE(EXCLUDED.password, users.password),
+            auth_type = EXCLUDED.auth_type,
+            profile_version = users.profile_version + 1
+    """,
+    # Abort on the first existing email
+    'error': "",
+}
+
+STAGING_TABLE = """
+    CREATE TEMP TABLE IF NOT EXISTS users_import (
+        line BIGINT,
+        username TEXT,
+        email TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        password TEXT,
+        auth_type TEXT
+    ) ON COMMIT DELETE ROWS;
+"""
+
+
+def file_format(file, requested):
+    if requested:
+        return requested
+    name = getattr(file, 'name', '') or ''
+    return 'jsonl' if name.endswith(('.jsonl', '.ndjson')) else 'csv'
+
+
+def read_rows(file, fmt):
+    """
+    Yields (line number, dict) for each record of a CSV (with a header row)
+    or JSON Lines file.
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(file)
+        for row in reader:
+            yield reader.line_num, row
+    else:
+        for number, line in enumerate(file, start=1):
+            if line.strip():
+                yield number, json.loads(line)
+
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+def validate(row):
+    """
+    Returns the row's import columns, or raises ValueError.
+
+    A `password_hash` field (as written by `users export --with-password-hash`)
+    is stored as is; a `password` field is hashed.
+    """
+    missing = [field for field in REQUIRED_FIELDS if not row.get(field)]
+    if missing:
+        raise ValueError(f"missing {', '.join(missing)}")
+    record = {field: str(row[field]).strip() for field in REQUIRED_FIELDS}
+    record['auth_type'] = row.get('auth_type') or 'local'
+    if record['auth_type'] not in AUTH_TYPES:
+        raise ValueError(f"unknown auth_type '{record['auth_type']}'")
+    for field, value in record.items():
+        if len(value) > MAX_FIELD_LENGTH:
+            raise ValueError(f"{field} longer than {MAX_FIELD_LENGTH} characters")
+
+    password_hash = row.get('password_hash')
+    if password_hash:
+        if not password_hash.startswith('$2'):
+            raise ValueError("password_hash is not a bcrypt hash")
+        record['password'] = password_hash
+    else:
+        record['password'] = str(row['password']) if row.get('password') else None
+        record['hash'] = record['password'] is not None
+    return record
+
+
+def copy_in(connection, statement, buffer):
+    """
+    Runs `COPY ... FROM STDIN` with the rows in a text `buffer`, on the
+    connection's DBAPI driver.
+    """
+    driver = connection.dialect.driver
+    cursor = connection.connection.cursor()
+    if driver == 'pg8000':
+        cursor.execute(statement, stream=buffer)
+    elif driver == 'psycopg2':
+        cursor.copy_expert(statement, buffer)
+    else:
+        with cursor.copy(statement) as copy:
+            while data := buffer.read(65536):
+                copy.write(data)
+
+
+def copy_out(connection, statement, buffer):
+    """
+    Runs `COPY ... TO STDOUT` into a text `buffer`, on the connection's DBAPI driver.
+    """
+    driver = connection.dialect.driver
+    cursor = connection.connection.cursor()
+    if driver == 'pg8000':
+        cursor.execute(statement, stream=buffer)
+    elif driver == 'psycopg2':
+        cursor.copy_expert(statement, buffer)
+    else:
+        with cursor.copy(statement) as copy:
+            for data in copy:
+                buffer.write(bytes(data).decode())
+
+
+class ImportStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.read = 0
+        self.inserted = 0
+        self.updated = 0
+        self.skipped = 0
+        self.rejected = 0
+
+    def line(self):
+        elapsed = time.perf_counter() - self.started
+        rate = self.read / elapsed if elapsed else 0.0
+        return (f"{self.read} rows: {self.inserted} inserted, {self.updated} updated, "
+                f"{self.skipped} skipped, {self.rejected} rejected "
+                f"({rate:.0f} rows/s, {elapsed:.1f}s)")
+
+
+class UserImporter:
+    """
+    Loads batches of validated rows: passwords are hashed on a thread pool
+    (bcrypt releases the GIL) while the previous batch is copied into a
+    staging table and merged into users with the chosen conflict policy.
+    """
+
+    def __init__(self, engine, on_conflict='skip', rounds=None, workers=None):
+        self.engine = engine
+        self.on_conflict = on_conflict
+        self.rounds = rounds
+        self.executor = ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1,
+                                           thread_name_prefix='import-hash')
+        self.stats = ImportStats()
+        # Rows sharing an email within a batch: the first one wins, unless
+        # the policy is to fail on duplicates. New ids follow file order.
+        distinct = "" if on_conflict == 'error' else "DISTINCT ON (lower(email))"
+        order = "" if on_conflict == 'error' else "ORDER BY lower(email), line"
+        self.merge = sqlalchemy.text(f"""
+            WITH merged AS (
+                INSERT INTO users (username, email, first_name, last_name, password, auth_type)
+                SELECT username, email, first_name, last_name, password, auth_type
+                FROM (SELECT {distinct} * FROM users_import {order}) AS incoming
+                ORDER BY line
+                {CONFLICT_POLICIES[on_conflict]}
+                RETURNING id, profile_version, (xmax = 0) AS inserted,
+                    -- The row's password was written by this import (salted hashes are unique)
+                    EXISTS (SELECT FROM users_import WHERE users_import.password = users.password) AS password_set
+            )
+            SELECT id, profile_version, inserted, password_set FROM merged;
+        """)
+
+    def prepare(self, numbered_rows):
+        """
+        Validates a batch and starts hashing its passwords. Returns the
+        records and their pending hashes.
+        """
+        records = []
+        for number, row in numbered_rows:
+            self.stats.read += 1
+            try:
+                record = validate(row)
+            except (ValueError, TypeError, AttributeError) as e:
+                self.stats.rejected += 1
+                logger.warning(f"Skipping line {number}: {e}")
+                continue
+            record['line'] = number
+            records.append(record)
+        pending = [
+            (record, self.executor.submit(hash_password, record['password'], self.rounds))
+            for record in records if record.pop('hash', False)
+        ]
+        return records, pending
+
+    def load(self, records, pending):
+        """
+        Waits for a batch's hashes, then copies and merges it in one transaction.
+        """
+        for record, future in pending:
+            record['password'] = future.result()
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for record in records:
+            writer.writerow([record['line']] + [record[column] for column in IMPORT_COLUMNS])
+        buffer.seek(0)
+
+        with self.engine.connect() as connection:
+            with connection.begin():
+                connection.execute(sqlalchemy.text(STAGING_TABLE))
+                copy_in(connection, f"COPY users_import (line, {', '.join(IMPORT_COLUMNS)}) "
+                                    "FROM STDIN WITH (FORMAT csv)", buffer)
+                merged = connection.execute(self.merge).fetchall()
+
+        inserted = sum(1 for row in merged if row.inserted)
+        self.stats.inserted += inserted
+        self.stats.updated += len(merged) - inserted
+        self.stats.skipped += len(records) - len(merged)
+
+        # As for an update through the API: shared caches must not keep
+        # serving the overwritten profiles, and a new password signs out
+        for row in merged:
+            if not row.inserted:
+                get_user_cache(current_app.config).invalidate(row.id)
+                get_profile_versions(current_app.config).record(row.id, row.profile_version)
+                if row.password_set:
+                    revoke_sessions(current_app.config, row.id)
+
+    def run(self, numbered_rows, batch_size, progress=None):
+        """
+        Imports all rows, hashing one batch ahead of the one being written.
+        """
+        try:
+            previous = None
+            for batch in batches(numbered_rows, batch_size):
+                current = self.prepare(batch)
+                if previous is not None:
+                    self.load(*previous)
+                    if progress:
+                        progress(self.stats)
+                previous = current
+            if previous is not None:
+                self.load(*previous)
+                if progress:
+                    progress(self.stats)
+        finally:
+            self.executor.shutdown(cancel_futures=True)
+        return self.stats
+
+
+def export_users(engine, file, fmt, batch_size, with_password_hash=False, progress=None):
+    """
+    Writes every user, ordered by id, from one consistent snapshot. Each
+    batch is a COPY of the next `batch_size` ids. Returns the row count.
+    """
+    columns = EXPORT_COLUMNS + (['password AS password_hash'] if with_password_hash else [])
+    header = EXPORT_COLUMNS + (['password_hash'] if with_password_hash else [])
+    writer = csv.writer(file) if fmt == 'csv' else None
+    if writer:
+        writer.writerow(header)
+
+    exported = 0
+    last_id = 0
+    with engine.connect().execution_options(isolation_level='REPEATABLE READ') as connection:
+        with connection.begin():
+            # Starts the snapshot before the first raw COPY
+            connection.execute(sqlalchemy.text("SELECT 1;"))
+            while True:
+                buffer = io.StringIO()
+                copy_out(connection, f"""
+                    COPY (SELECT {', '.join(columns)} FROM users
+                          WHERE id > {int(last_id)} ORDER BY id LIMIT {int(batch_size)})
+                    TO STDOUT WITH (FORMAT csv)
+                """, buffer)
+                buffer.seek(0)
+                rows = list(csv.reader(buffer))
+                if not rows:
+                    break
+                for row in rows:
+                    if writer:
+                        writer.writerow(row)
+                    else:
+                        record = dict(zip(header, row), id=int(row[0]))
+                        file.write(json.dumps(record) + '\n')
+                exported += len(rows)
+                last_id = int(rows[-1][0])
+                if progress:
+                    progress(exported)
+    return exported
+
+
+users_cli = AppGroup('users', help='Bulk user import and export.')
+
+
+@users_cli.command('import')
+@click.argument('source', type=click.File('r', encoding='utf8'))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']),
+              help='Input format (default: from the file extension, else csv).')
+@click.option('--on-conflict', type=click.Choice(list(CONFLICT_POLICIES)), default='skip', show_default=True,
+              help='What to do with rows whose email already exists.')
+@click.option('--batch-size', default=5000, show_default=True, help='Rows per COPY and transaction.')
+@click.option('--workers', type=int, help='Password hashing threads (default: CPU count).')
+@click.option('--rounds', type=int, help='bcrypt work factor for imported passwords (default: BCRYPT_ROUNDS).')
+@click.option('--local/--cloud', default=True, help='Database to load into (default: local).')
+def import_users_command(source, fmt, on_conflict, batch_size, workers, rounds, local):
+    """Load users from a CSV (with header) or JSON Lines file ('-' for stdin).
+
+    Fields: username, email, first_name, last_name, and optionally
+    auth_type and either password (hashed on import) or password_hash.
+    """
+    engine = DatabaseManager().connect_with_connector(is_local=local)
+    importer = UserImporter(engine, on_conflict=on_conflict, rounds=rounds or bcrypt_rounds(), workers=workers)
+    try:
+        stats = importer.run(read_rows(source, file_format(source, fmt)), batch_size,
+                             progress=lambda s: click.echo(s.line(), err=True))
+    except sqlalchemy.exc.IntegrityError as e:
+        # pg8000 reports the server's error fields as a dict
+        detail = e.orig.args[0] if e.orig.args else e.orig
+        if isinstance(detail, dict):
+            detail = f"{detail.get('M')}. {detail.get('D', '')}"
+        raise click.ClickException(f"Import stopped after {importer.stats.inserted} new rows: {detail}")
+    click.echo(f"Done. {stats.line()}", err=True)
+
+
+@users_cli.command('export')
+@click.argument('target', type=click.File('w', encoding='utf8'), default='-')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']),
+              help='Output format (default: from the file extension, else csv).')
+@click.option('--batch-size', default=5000, show_default=True, help='Rows per COPY.')
+@click.option('--with-password-hash', is_flag=True, help='Include bcrypt hashes, for moving users between databases.')
+@click.option('--local/--cloud', default=True, help='Database to read from (default: local).')
+def export_users_command(target, fmt, batch_size, with_password_hash, local):
+    """Write all users as CSV or JSON Lines ('-' for stdout)."""
+    engine = DatabaseManager().connect_with_connector(is_local=local)
+    started = time.perf_counter()
+    exported = export_users(engine, target, file_format(target, fmt), batch_size, with_password_hash,
+                            progress=lambda n: click.echo(f"{n} rows exported", err=True))
+    elapsed = time.perf_counter() - started
+    click.echo(f"Done. {exported} rows in {elapsed:.1f}s ({exported / elapsed if elapsed else 0:.0f} rows/s)",
+               err=True)
@@ -0,0 +1,444 @@
+# user_cache.py
+import heapq
+import importlib
+import itertools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from cachetools import TTLCache
+
+from util import metrics
+
+logger = logging.getLogger()
+
+USER_CACHE_DEFAULTS = {
+    # 'memory' (per process), 'shared' (USER_CACHE_URL) or 'none'
+    'USER_CACHE_BACKEND': 'memory',
+    # Seconds an entry may be served before it is reloaded
+    'USER_CACHE_TTL': 60,
+    # Entries kept by the in-process backend; least recently used go first
+    'USER_CACHE_MAXSIZE': 10000,
+    # 'redis://host:6379/0', 'local://' (in-process stand-in) or 'module:factory'
+    'USER_CACHE_URL': None,
+    # Seconds after an update or delete during which loads do not cache the row
+    'USER_CACHE_INVALIDATION_HOLD': 5,
+}
+
+
+class InProcessBackend:
+    """
+    Per-process TTL + LRU cache. Other workers only see writes after TTL.
+    A held key stores the time its hold ends instead of a row.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._cache.get(key)
+        return value if isinstance(value, dict) else None
+
+    def set(self, key, value):
+        with self._lock:
+            self._cache[key] = value
+
+    def add(self, key, value):
+        """
+        Sets `key` unless it holds a value or is held; True if it was set.
+        """
+        with self._lock:
+            current = self._cache.get(key)
+            if isinstance(current, dict) or (current is not None and current > time.monotonic()):
+                return False
+            self._cache[key] = value
+            return True
+
+    def hold(self, key, seconds):
+        """
+        Replaces `key` with a marker that keeps add() out for `seconds`.
+        """
+        with self._lock:
+            self._cache[key] = time.monotonic() + seconds
+
+    def delete(self, key):
+        with self._lock:
+            self._cache.pop(key, None)
+
+
+class StoreFull(Exception):
+    """
+    Raised by ExpiringStore.add when every slot holds a live entry.
+    """
+
+
+class ExpiringStore:
+    """
+    Per-process entries that are kept until they expire and never evicted
+    before: for revocation state, where dropping an entry early would let a
+    revoked token through. add() refuses new keys once `maxsize` live
+    entries are held, so callers can fail closed; set() always stores.
+    """
+
+    def __init__(self, ttl, maxsize=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = {}
+        self._expiries = []  # heap of (expires_at, n, key)
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def _purge(self, now):
+        while self._expiries and self._expiries[0][0] <= now:
+            _, _, key = heapq.heappop(self._expiries)
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] <= now:
+                del self._entries[key]
+
+    def _store(self, key, value, ttl, now):
+        expires = now + (ttl or self.ttl)
+        self._entries[key] = (value, expires)
+        heapq.heappush(self._expiries, (expires, next(self._counter), key))
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                return None
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            now = time.monotonic()
+            self._purge(now)
+            self._store(key, value, ttl, now)
+
+    def add(self, key, value, ttl=None):
+        """
+        Sets `key` only if it is not set; True if it was set.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._purge(now)
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > now:
+                return False
+            if self.maxsize is not None and len(self._entries) >= self.maxsize:
+                raise StoreFull(f"{len(self._entries)} live entries")
+            self._store(key, value, ttl, now)
+            return True
+
+
+class SharedBackend:
+    """
+    Cache shared by all workers through a Redis-compatible client
+    (get, set with ex= and nx=, delete). Values are stored as JSON; a held
+    key holds JSON null.
+    """
+
+    def __init__(self, client, ttl, prefix='user:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + str(key))
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key, value):
+        self.client.set(self.prefix + str(key), json.dumps(value), ex=self.ttl)
+
+    def add(self, key, value):
+        return bool(self.client.set(self.prefix + str(key), json.dumps(value), ex=self.ttl, nx=True))
+
+    def hold(self, key, seconds):
+        self.client.set(self.prefix + str(key), 'null', ex=max(1, int(seconds)))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + str(key))
+
+
+class LocalClient:
+    """
+    In-process stand-in for a Redis client, for tests and benchmarks.
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value, expires = self._data.get(key, (None, None))
+            if expires is not None and expires <= time.monotonic():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value, ex=None, nx=False):
+        with self._lock:
+            if nx and self._data.get(key, (None, None))[0] is not None:
+                _, expires = self._data[key]
+                if expires is None or expires > time.monotonic():
+                    return None
+            self._data[key] = (value, time.monotonic() + ex if ex else None)
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            return int(self._data.pop(key, None) is not None)
+
+    def incr(self, key):
+        with self._lock:
+            value, expires = self._data.get(key, (0, None))
+            if expires is not None and expires <= time.monotonic():
+                value, expires = 0, None
+            value = int(value) + 1
+            self._data[key] = (value, expires)
+            return value
+
+    def decr(self, key):
+        with self._lock:
+            value, expires = self._data.get(key, (0, None))
+            if expires is not None and expires <= time.monotonic():
+                value, expires = 0, None
+            value = int(value) - 1
+            self._data[key] = (value, expires)
+            return value
+
+    def expire(self, key, seconds):
+        with self._lock:
+            if key not in self._data:
+                return False
+            self._data[key] = (self._data[key][0], time.monotonic() + seconds)
+            return True
+
+
+def worker_count(config):
+    """
+    Processes serving the app: SERVER_WORKERS from the config or the
+    environment (gunicorn.conf.py exports its worker count), else
+    WEB_CONCURRENCY or `uvicorn --workers`, else 1.
+    """
+    workers = config.get('SERVER_WORKERS') or os.getenv('SERVER_WORKERS') or os.getenv('WEB_CONCURRENCY')
+    if not workers and sys.argv and 'uvicorn' in sys.argv[0]:  # uvicorn or python -m uvicorn
+        # uvicorn's workers are spawned with its command line as sys.argv
+        for i, arg in enumerate(sys.argv):
+            if arg == '--workers' and i + 1 < len(sys.argv):
+                workers = sys.argv[i + 1]
+            elif arg.startswith('--workers='):
+                workers = arg.split('=', 1)[1]
+    return int(workers or 1)
+
+
+def require_shared_state(config, feature, setting, kind, url):
+    """
+    Refuses security state kept per process (`kind` 'memory', or the
+    'local://' client) when several workers serve the app, since each would
+    only enforce what it saw itself. ALLOW_PER_WORKER_STATE=1 in the
+    environment lifts this, for benchmarks and tests only.
+    """
+    per_process = kind == 'memory' or url == 'local://'
+    workers = worker_count(config)
+    if per_process and workers > 1 and os.getenv('ALLOW_PER_WORKER_STATE') != '1':
+        raise ValueError(f"{feature} needs state shared by all {workers} workers: set {setting} = 'shared' "
+                         f"with a redis:// URL (the redis package is in requirements.txt), or run one worker")
+
+
+def shared_client(url):
+    """
+    Builds the client for USER_CACHE_URL.
+    """
+    if url == 'local://':
+        return LocalClient()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        import redis
+        return redis.Redis.from_url(url)
+    module_name, factory_name = url.split(':', 1)
+    return getattr(importlib.import_module(module_name), factory_name)()
+
+
+class UserCache:
+    """
+    Read-through cache of user rows keyed by id.
+
+    A load that read the row before an update could otherwise cache the old
+    row after the update invalidated it. So invalidate() holds the key for
+    `invalidation_hold` seconds, and loads only cache a row when the key is
+    neither set nor held (an atomic SET NX on Redis).
+    """
+
+    def __init__(self, backend, invalidation_hold=5):
+        self.backend = backend
+        self.invalidation_hold = invalidation_hold
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_load(self, user_id, loader):
+        """
+        Returns the cached row for `user_id`, or calls `loader()` and caches a
+        non-None result. Backend failures fall through to the loader.
+        """
+        row = self.lookup(user_id)
+        if row is None:
+            row = loader()
+            self.store(user_id, row)
+        return row
+
+    def lookup(self, user_id):
+        """
+        Returns the cached row or None, counting the hit or miss.
+        """
+        if self.backend is None:
+            return None
+        try:
+            row = self.backend.get(user_id)
+        except Exception as e:
+            logger.warning(f"User cache read failed: {e}")
+            row = None
+        with self._lock:
+            if row is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        metrics.count_lookup('user', 'hit' if row is not None else 'miss')
+        return row
+
+    def store(self, user_id, row):
+        if self.backend is None or row is None:
+            return
+        try:
+            self.backend.add(user_id, row)
+        except Exception as e:
+            logger.warning(f"User cache write failed: {e}")
+
+    def invalidate(self, user_id):
+        """
+        Drops the cached row after a committed write. A backend failure is
+        logged rather than failing the write; the row then expires with TTL.
+        """
+        if self.backend is None:
+            return
+        try:
+            self.backend.hold(user_id, self.invalidation_hold)
+        except Exception as e:
+            logger.error(f"User cache invalidation failed for user {user_id}: {e}")
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+class ProfileVersions:
+    """
+    Short revocation list for tokens carrying profile claims: the latest
+    profile version of users changed or deleted within a token's lifetime.
+    Users without an entry have not changed since any live token was issued.
+    """
+    DELETED = -1
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def record(self, user_id, version):
+        self._set(user_id, version)
+
+    def record_deleted(self, user_id):
+        self._set(user_id, self.DELETED)
+
+    def _set(self, user_id, version):
+        # Called after the write committed; a backend failure must not undo that
+        try:
+            self.backend.set(user_id, version)
+        except Exception as e:
+            logger.error(f"Profile version write failed for user {user_id}: {e}")
+
+    def is_stale(self, user_id, token_version):
+        """
+        True if the user changed or was deleted after the token was issued.
+        """
+        try:
+            latest = self.backend.get(user_id)
+        except Exception as e:
+            logger.warning(f"Profile version read failed: {e}")
+            return True
+        if latest is None:
+            return False
+        return latest == self.DELETED or token_version is None or latest > token_version
+
+
+_cache = None
+_cache_pid = None
+_versions = None
+_cache_lock = threading.Lock()
+
+
+def build_user_cache(config):
+    setting = lambda key: config.get(key, USER_CACHE_DEFAULTS[key])
+    kind = setting('USER_CACHE_BACKEND')
+    if kind == 'none':
+        return UserCache(None)
+    hold = setting('USER_CACHE_INVALIDATION_HOLD')
+    if kind == 'memory':
+        return UserCache(InProcessBackend(setting('USER_CACHE_MAXSIZE'), setting('USER_CACHE_TTL')), hold)
+    if kind == 'shared':
+        return UserCache(SharedBackend(shared_client(setting('USER_CACHE_URL')), setting('USER_CACHE_TTL')), hold)
+    raise ValueError(f"Unknown USER_CACHE_BACKEND '{kind}'")
+
+
+def build_profile_versions(config):
+    """
+    Shared when the user cache is, else per process, with entries kept (never
+    evicted) as long as an access token lives. With JWT_PROFILE_CLAIMS on,
+    a per-process list is refused when several workers serve the app.
+    """
+    setting = lambda key: config.get(key, USER_CACHE_DEFAULTS[key])
+    expires = config.get('JWT_ACCESS_TOKEN_EXPIRES')
+    ttl = int(expires.total_seconds()) if hasattr(expires, 'total_seconds') else int(expires or 900)
+    shared = setting('USER_CACHE_BACKEND') == 'shared'
+    if config.get('JWT_PROFILE_CLAIMS'):
+        require_shared_state(config, 'Profile claims', 'USER_CACHE_BACKEND', 'shared' if shared else 'memory',
+                             setting('USER_CACHE_URL'))
+    if shared:
+        backend = SharedBackend(shared_client(setting('USER_CACHE_URL')), ttl, prefix='user-version:')
+    else:
+        backend = ExpiringStore(ttl)
+    return ProfileVersions(backend)
+
+
+def get_user_cache(config):
+    """
+    Returns the process-wide user cache, creating it from `config` on first use.
+    """
+    if _cache is None or _cache_pid != os.getpid():
+        _build(config)
+    return _cache
+
+
+def get_profile_versions(config):
+    """
+    Returns the process-wide profile version list, creating it on first use.
+    """
+    if _versions is None or _cache_pid != os.getpid():
+        _build(config)
+    return _versions
+
+
+def _build(config):
+    global _cache, _versions, _cache_pid
+    with _cache_lock:
+        if _cache is None or _cache_pid != os.getpid():
+            _cache = build_user_cache(config)
+            _versions = build_profile_versions(config)
+            _cache_pid = os.getpid()
@@ -1,82 +1,340 @@
 # src/resources/user_dao.py
 
-from model.user import User
-from flask_sqlalchemy import SQLAlchemy
+from model.user import UserRecord
+import functools
 import logging
-from util.utils import check_password
-import sqlalchemy
-from sqlalchemy import text
+import threading
+from flask import current_app
+from util.utils import check_password, dummy_hash, hash_password, needs_rehash
+from util import metrics
+from util.password_pool import PasswordPoolSaturated, bcrypt_rounds, get_password_pool, run_password_task
 from resources.user_dto import UserDTO
-from user.db import DatabaseManager
+from resources.email_filter import REBUILD_BATCH, get_known_emails
+from resources.refresh_tokens import get_refresh_tokens
+from resources.user_cache import get_profile_versions, get_user_cache
+from user.db import DatabaseManager, Query
 
 
 
 manager = DatabaseManager()
 logger = logging.getLogger()
 
+# The profile fields other services may see (see endpoints.user_profile)
+PROFILE_COLUMNS = ('id', 'username', 'first_name', 'last_name', 'email', 'auth_type')
+# What the service needs to know about a user: safe to cache
+ACCOUNT_COLUMNS = PROFILE_COLUMNS + ('profile_version',)
+# Only the login path reads the password hash
+LOGIN_COLUMNS = ACCOUNT_COLUMNS + ('password',)
+# What a user may change about their own account (see endpoints.update_user)
+UPDATABLE_COLUMNS = ('username', 'first_name', 'last_name', 'password')
+
+
+class UserWriteFailed(Exception):
+    """
+    Raised when the database rejects or fails a change to an account. The
+    cause is logged; the message is safe to show the client.
+    """
+
+
+def like_prefix(prefix):
+    """
+    LIKE pattern matching values that start with `prefix` (lower-cased, wildcards escaped).
+    """
+    escaped = prefix.lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return escaped + '%'
+
+
+# Built once; with DB_PREPARED_STATEMENTS each pooled connection also
+# prepares them once (see user.db.Query)
+GET_LOGIN_BY_EMAIL = Query(f"SELECT {', '.join(LOGIN_COLUMNS)} FROM users WHERE lower(email) = lower(:email);")
+# The password hash is left out so it never lands in a cache
+GET_ACCOUNT_BY_ID = Query(f"SELECT {', '.join(ACCOUNT_COLUMNS)} FROM users WHERE id = :id;")
+GET_PROFILES_BY_IDS = Query(f"""
+    SELECT {', '.join(PROFILE_COLUMNS)} FROM users
+    WHERE id = ANY(CAST(:ids AS INTEGER[]))
+       OR lower(email) = ANY(CAST(:emails AS TEXT[]))
+    ORDER BY id;
+""")
+# Insert and existence check in one round trip: the unique index on
+# lower(email) turns a duplicate into an empty RETURNING instead of a race
+CREATE_USER = Query(f"""
+    INSERT INTO users (username, email, first_name, last_name, password,  auth_type)
+    VALUES (:username, :email, :first_name, :last_name, :password, :auth_type)
+    ON CONFLICT ((lower(email))) DO NOTHING
+    RETURNING {', '.join(ACCOUNT_COLUMNS)};
+""")
+# One statement per change: the deleted row's name and email come back with it
+DELETE_USER = Query("DELETE FROM users WHERE id = :id RETURNING username, email;")
+# Only replaces the hash that was verified, never a concurrent password change
+REHASH_PASSWORD = Query("UPDATE users SET password = :new_hash WHERE id = :id AND password = :old_hash;")
+# Whole-table reads for the known-email filter (resources.email_filter)
+COUNT_USERS = Query("SELECT count(*) FROM users;")
+EMAILS_AFTER_ID = Query("SELECT id, email FROM users WHERE id > :after ORDER BY id LIMIT :limit;")
+# Every transaction below this has finished, so its rows are visible from
+# now on (migration 0005)
+EMAIL_FILTER_HORIZON = Query("SELECT CAST(pg_snapshot_xmin(pg_current_snapshot()) AS text);")
+EMAILS_SINCE_XID = Query("""
+    SELECT id, email FROM users
+    WHERE created_xid >= CAST(CAST(:horizon AS text) AS xid8) AND id > :after
+    ORDER BY id
+    LIMIT :limit;
+""")
+# SSO get-or-create in one round trip. The no-op DO UPDATE makes RETURNING
+# give back an existing account too, and two concurrent first logins end up
+# with the same row
+UPSERT_SSO_USER = Query(f"""
+    INSERT INTO users (username, email, first_name, last_name, auth_type)
+    VALUES (:email, :email, :first_name, :last_name, 'sso')
+    ON CONFLICT ((lower(email))) DO UPDATE SET email = users.email
+    RETURNING {', '.join(ACCOUNT_COLUMNS)};
+""")
+
+
+def sso_user_data(google_info):
+    """
+    UPSERT_SSO_USER parameters from Google's ID token claims (or userinfo).
+    """
+    return {
+        'email': google_info['email'],
+        'first_name': google_info.get('given_name', ''),
+        'last_name': google_info.get('family_name', ''),
+    }
+
+
+@functools.lru_cache(maxsize=16)
+def update_user_query(columns):
+    """
+    UPDATE of only `columns` (a tuple from UPDATABLE_COLUMNS) that bumps
+    profile_version and returns the new row; with no columns, just the row.
+    """
+    if not columns:
+        return GET_ACCOUNT_BY_ID
+    assignments = ''.join(f"{column} = :{column}, " for column in columns)
+    return Query(f"""
+        UPDATE users SET {assignments}profile_version = profile_version + 1
+        WHERE id = :id
+        RETURNING {', '.join(ACCOUNT_COLUMNS)};
+    """)
+
+
+def revoke_sessions(config, user_id):
+    """
+    Signs `user_id` out everywhere after a committed change. Failures are
+    logged: the change has happened, so the request still succeeds.
+    """
+    try:
+        get_refresh_tokens(config).revoke_user(user_id)
+    except Exception as e:
+        logger.error(f"Revoking the sessions of user {user_id} failed: {e}")
+
+
+def update_user_statement(user_id, patch):
+    """
+    The query and parameters that apply a partial update to one user.
+    Raises ValueError for fields outside UPDATABLE_COLUMNS.
+    """
+    unknown = set(patch) - set(UPDATABLE_COLUMNS)
+    if unknown:
+        raise ValueError(f"Cannot update {', '.join(sorted(unknown))}")
+    columns = tuple(column for column in UPDATABLE_COLUMNS if column in patch)
+    return update_user_query(columns), dict(patch, id=user_id)
+
+
+@functools.lru_cache(maxsize=128)
+def list_users_query(fields, search):
+    """
+    Keyset page of users after an id, optionally limited to usernames or
+    emails starting with :prefix. `fields` must come from PROFILE_COLUMNS.
+    """
+    where = "id > :after"
+    if search:
+        where += " AND (lower(username) LIKE :prefix OR lower(email) LIKE :prefix)"
+    return Query(f"""
+        SELECT {', '.join(fields)} FROM users
+        WHERE {where}
+        ORDER BY id
+        LIMIT :limit;
+    """)
+
+
+def read_emails_after(connection, after):
+    """
+    Yields (id, email) for every user with an id above `after`, in id order.
+    """
+    while True:
+        rows = EMAILS_AFTER_ID.execute(connection, {'after': after, 'limit': REBUILD_BATCH}).fetchall()
+        yield from rows
+        if len(rows) < REBUILD_BATCH:
+            return
+        after = rows[-1][0]
+
+
+def read_emails_since(connection, horizon):
+    """
+    Yields (id, email) for every user inserted by a transaction at or above
+    `horizon`, in id order.
+    """
+    after = 0
+    while True:
+        rows = EMAILS_SINCE_XID.execute(
+            connection, {'horizon': str(horizon), 'after': after, 'limit': REBUILD_BATCH}).fetchall()
+        yield from rows
+        if len(rows) < REBUILD_BATCH:
+            return
+        after = rows[-1][0]
+
+
+def read_horizon(connection):
+    """
+    The xid below which every transaction has finished. Read before the
+    rows it covers.
+    """
+    return int(EMAIL_FILTER_HORIZON.execute(connection).scalar())
+
+
+def rebuild_email_filter(known):
+    """
+    Builds a new known-email filter from the users table and swaps it in.
+    Failures keep the current filter.
+    """
+    bloom, horizon = None, None
+    try:
+        engine = manager.connect_with_connector(is_local=False)
+        with engine.connect() as connection:
+            horizon = read_horizon(connection)
+            bloom = known.new_filter(COUNT_USERS.execute(connection).scalar())
+            for _, email in read_emails_after(connection, 0):
+                bloom.add(email.lower())
+        logger.info(f"Known-email filter rebuilt: {bloom.stats()}")
+    except Exception as e:
+        logger.warning(f"Known-email filter rebuild failed: {e}")
+        bloom = None
+    finally:
+        known.finish_rebuild(bloom, horizon)
+
+
+def refresh_email_filter(wait=False):
+    """
+    Rebuilds the known-email filter if it is due: in the calling thread with
+    `wait`, else in a background thread.
+    """
+    known = get_known_emails(current_app.config)
+    if known is None or not known.begin_rebuild():
+        return
+    if wait:
+        rebuild_email_filter(known)
+        return
+    app = current_app._get_current_object()
+
+    def rebuild():
+        with app.app_context():
+            rebuild_email_filter(known)
+
+    threading.Thread(target=rebuild, name='email-filter', daemon=True).start()
+
+
+def email_may_exist(email):
+    """
+    False only if `email` is certainly not registered: a filter miss is
+    trusted right after a sync, and otherwise left to the database.
+    """
+    known = get_known_emails(current_app.config)
+    if known is None:
+        return True
+    refresh_email_filter()
+    if known.might_exist(email):
+        metrics.count_lookup('email_filter', 'maybe')
+        return True
+    since = known.begin_sync()
+    if since is None:
+        # Synced too recently to know about users created since
+        metrics.count_lookup('email_filter', 'unsynced')
+        return True
+    # Users created by other workers since the last sync
+    try:
+        engine = manager.connect_with_connector(is_local=False)
+        with engine.connect() as connection:
+            horizon = read_horizon(connection)
+            known.finish_sync(list(read_emails_since(connection, since)), horizon)
+    except Exception as e:
+        logger.warning(f"Known-email filter sync failed: {e}")
+        return True
+    if known.might_exist(email):
+        metrics.count_lookup('email_filter', 'maybe')
+        return True
+    metrics.count_lookup('email_filter', 'absent')
+    known.skip()
+    return False
 
-db = SQLAlchemy()
 
-def get_user_by_email(email):
-    engine = manager.connect_with_connector(is_local=False)
-    
-    query = sqlalchemy.text("SELECT * FROM users WHERE email = :email;")
-    with engine.connect() as connection:
-        # result = connection.execute(query, {'email': email}).fetchall()
+class UserDAO:
 
-        row = connection.execute(query, {'email': email}).fetchone()
-        # return(str(type(row)))
-        # Convert RowProxy to a dictionary
-        if row is not None:
-            user = row._asdict()
-        else:
-            user = None
-    # return result 
-    return user
+    @staticmethod
+    def get_user_by_id(user_id):
+        """
+        Retrieve a single user by their ID, through the user cache.
 
+        Returns a UserRecord without its password hash
+        """
+        user = get_user_cache(current_app.config).get_or_load(
+            user_id, lambda: UserDAO.load_user_profile(user_id))
 
-    # return result > 0  # Returns True if user exists, False otherwise
+        if user is None:
+            return None  # No user found with the given ID
 
-class UserDAO:
+        return UserRecord(**user)
 
     @staticmethod
-    def get_user_by_id(user_id):
+    def load_user_profile(user_id):
         """
-        Retrieve a single user by their ID.
+        Reads a user's profile columns from the database, bypassing the cache.
 
-        Returns a user instance
+        Returns a dict, or None if there is no such user
+        """
+        engine = manager.connect_with_connector(is_local=False)
+
+        with engine.connect() as connection:
+            row = GET_ACCOUNT_BY_ID.execute(connection, {'id': user_id}).fetchone()
+
+        # Convert RowProxy to a dictionary
+        return row._asdict() if row is not None else None
+
+    @staticmethod
+    def get_users_by_ids(ids=(), emails=()):
+        """
+        Resolves many users at once by id and/or email (case-insensitive),
+        in one query on the primary key and lower(email) indexes.
+
+        Returns a list of PROFILE_COLUMNS tuples ordered by id; unknown ids
+        and emails are left out
         """
-        
         engine = manager.connect_with_connector(is_local=False)
-        
 
-        query = sqlalchemy.text("SELECT * FROM users WHERE id = :id;")
+        params = {'ids': list(ids), 'emails': [email.lower() for email in emails]}
         with engine.connect() as connection:
-            row = connection.execute(query, {'id': user_id}).fetchone()
+            return [tuple(row) for row in GET_PROFILES_BY_IDS.execute(connection, params)]
 
-            # return(str(type(row)))
-            # Convert RowProxy to a dictionary
-            if row is not None:
-                user = row._asdict()
-            else:
-                user = None
+    @staticmethod
+    def list_users(after=0, limit=50, prefix=None, fields=PROFILE_COLUMNS):
+        """
+        One page of users ordered by id, starting after the id `after`.
+        With `prefix`, only users whose username or email starts with it.
+        `fields` is a subset of PROFILE_COLUMNS and must start with 'id'.
 
-        if row is None:
-            return None  # No user found with the given ID
+        Returns (rows as tuples of `fields`, id to pass as `after` for the
+        next page or None on the last page)
+        """
+        engine = manager.connect_with_connector(is_local=False)
 
-        # Assuming the User class has a constructor that accepts keyword arguments
-        # corresponding to its attributes
-        return User(
-            id=user['id'],
-            username=user['username'],
-            email=user['email'],
-            first_name=user['first_name'],
-            last_name=user['last_name'],
-            password=user['password'],
-            auth_type=user['auth_type']
-        )
+        query = list_users_query(fields, bool(prefix))
+        # One extra row tells whether there is a next page
+        params = {'after': after, 'limit': limit + 1, 'prefix': like_prefix(prefix) if prefix else None}
+        with engine.connect() as connection:
+            rows = [tuple(row) for row in query.execute(connection, params)]
+        if len(rows) > limit:
+            return rows[:limit], rows[limit - 1][0]
+        return rows, None
 
-    
     @staticmethod
     def create_user(user):
 
@@ -91,163 +349,143 @@ class UserDAO:
         engine = manager.connect_with_connector(is_local=False)
         
 
-        # SQL query to insert a new user and return the created record
-        query = sqlalchemy.text("""
-            INSERT INTO users (username, email, first_name, last_name, password,  auth_type) 
-            VALUES (:username, :email, :first_name, :last_name, :password, :auth_type)
-            RETURNING *;
-        """)
-  
         user_data = UserDTO.from_model(user)
-        # check if user exists
-        result_dict = get_user_by_email(user_data['email'])
-        exist_bool = (result_dict is not None)
-        if exist_bool:
-            return {'status': 'User already exists', 'resource':result_dict}
-
-        # If user doesn't exist
         try:
             with engine.connect() as connection:
-                row = connection.execute(query, user_data).fetchone()
-                # row = connection.execute(query, {'id': user_id}).fetchone()
-                if row is not None:
-                    result_dict = row._asdict()
-                else:
-                    result = None
+                row = CREATE_USER.execute(connection, user_data).fetchone()
                 connection.commit()  # Commit the transaction
-                return {'status': f"Success. Created user with id = {result_dict['id']}", 'resource': result_dict}
         except Exception as e:
-            # If an error occurs, rollback the transaction
-            if connection:
-                connection.rollback()
+            # Leaving the block without a commit rolls the transaction back
             return {'error': str(e), 'resource': None, 'status': 500}
-        finally:
-            if engine:
-                engine.dispose()  # Properly close the connection
 
-    @staticmethod
+        if row is None:
+            return {'status': 'User already exists', 'resource': None}
+        result_dict = row._asdict()
+        known = get_known_emails(current_app.config)
+        if known is not None:
+            known.add(result_dict['email'])
+        return {'status': f"Success. Created user with id = {result_dict['id']}", 'resource': result_dict}
 
-    def update_user(user_id, user_data):
+    @staticmethod
+    def update_user(user_id, patch):
         """
-        Update an existing user's details.
+        Apply a partial update (fields from UPDATABLE_COLUMNS, password
+        already hashed) in one statement.
+
+        Returns the updated UserRecord, or None if the user does not exist.
+        Raises UserWriteFailed if the database fails
         """
+        query, params = update_user_statement(user_id, patch)
         engine = manager.connect_with_connector(is_local=False)
-        
-
-        query = sqlalchemy.text(f"""
-            UPDATE users SET 
-            username = :username, 
-            first_name = :first_name,
-            last_name = :last_name, 
-            password = :password
-            WHERE id = :id;
-        """)
         try:
             with engine.connect() as connection:
-                connection.execute(query, user_data)
+                row = query.execute(connection, params).fetchone()
                 connection.commit()
-                return True
         except Exception as e:
-            # If an error occurs, rollback the transaction
-            if connection:
-                connection.rollback()
-            return {'error': str(e)}
-        finally:
-            if engine:
-                engine.dispose()  # Properly close the connection
-
+            # Leaving the block without a commit rolls the transaction back
+            logger.error(f"Updating user {user_id} failed: {e}")
+            raise UserWriteFailed("Failed to update account") from e
+        if row is None:
+            return None
+        if patch:
+            get_user_cache(current_app.config).invalidate(user_id)
+            get_profile_versions(current_app.config).record(user_id, row.profile_version)
+        if 'password' in patch:
+            revoke_sessions(current_app.config, user_id)  # sign out other sessions
+        return UserRecord.from_row(row)
 
     @staticmethod
     def delete_user(user_id):
         """
         Delete a user from the database.
+
+        Returns a UserRecord with the deleted user's username and email, or
+        None if the user did not exist. Raises UserWriteFailed if the
+        database fails
         """
         engine = manager.connect_with_connector(is_local=False)
-        
-
-        query = sqlalchemy.text("DELETE FROM users WHERE id = :id;")
         try:
             with engine.connect() as connection:
-                connection.execute(query, {'id': user_id})
-                connection.commit() #ensure
-                return True
+                row = DELETE_USER.execute(connection, {'id': user_id}).fetchone()
+                connection.commit()
         except Exception as e:
-            # If an error occurs, rollback the transaction
-            if connection:
-                connection.rollback()
-            return {'error': str(e)}
-        finally:
-            if engine:
-                engine.dispose()
-        
-    
+            logger.error(f"Deleting user {user_id} failed: {e}")
+            raise UserWriteFailed("Failed to delete account") from e
+        if row is None:
+            return None
+        get_user_cache(current_app.config).invalidate(user_id)
+        get_profile_versions(current_app.config).record_deleted(user_id)
+        revoke_sessions(current_app.config, user_id)
+        return UserRecord.from_row(row)
+
     @staticmethod
     def get_user_by_credentials(email, password):
         """
         Retrieve a user by their email and password.
 
-        Returns as None or as a user model
+        Returns None or a UserRecord without its password hash
         """
         engine = manager.connect_with_connector(is_local=False)
-        
+        user = None
 
-        query = sqlalchemy.text("SELECT * FROM users WHERE email = :email;")
-        with engine.connect() as connection:
-            row = connection.execute(query, {'email': email}).fetchone()
-            # return(str(type(row)))
-            # Convert RowProxy to a dictionary
-            if row is not None:
-                user = row._asdict()
-            else:
-                user = None
-
-            # return list(user.keys())
-            if user and check_password(password, user['password']):
-                user['password'] = None # To avoid sending back password
-                return User(
-                    id=user['id'],
-                    username=user['username'],
-                    email=user['email'],
-                    first_name=user['first_name'],
-                    last_name=user['last_name'],
-                    password=user['password'],
-                    auth_type=user['auth_type']
-                )
+        # Emails the known-email filter rules out skip the query
+        if email_may_exist(email):
+            with engine.connect() as connection:
+                row = GET_LOGIN_BY_EMAIL.execute(connection, {'email': email}).fetchone()
+            user = UserRecord.from_row(row) if row is not None else None
+
+        # Verify after the connection is back in the pool; bcrypt is slow
+        if not (user and user.password):
+            # Unknown email or SSO account: same bcrypt cost, so the response
+            # time does not tell which emails exist
+            run_password_task(check_password, password, dummy_hash(bcrypt_rounds()))
+            return None
+        if run_password_task(check_password, password, user.password):
+            rounds = bcrypt_rounds()
+            if needs_rehash(user.password, rounds):
+                UserDAO.rehash_password_in_background(engine, user.id, password, user.password, rounds)
+            user.password = None # To avoid sending back password
+            return user
         return None
     
 
     @staticmethod
-    def get_or_create_user_by_google_info(google_info):
+    def rehash_password_in_background(engine, user_id, password, old_hash, rounds):
         """
-        Retrieves a user by their Google information. If the user does not exist,
-        creates a new user in the database with the provided Google information.
+        Re-hashes a verified password with the configured work factor and
+        stores it, off the request thread. Skipped if the password pool is
+        busy; the next login will try again.
         """
-        database_manager = DatabaseManager()
-        engine = database_manager.connect_with_connector(is_local=False)
+        def rehash():
+            new_hash = hash_password(password, rounds)
+            with engine.connect() as connection:
+                REHASH_PASSWORD.execute(connection, {'id': user_id, 'new_hash': new_hash, 'old_hash': old_hash})
+                connection.commit()
+
+        def log_failure(future):
+            if not future.cancelled() and future.exception() is not None:
+                logger.error(f"Failed to rehash password for user {user_id}: {future.exception()}")
 
-        query_find_user = sqlalchemy.text("SELECT * FROM users WHERE email = :email;")
-        user_data = {'email': google_info['email']}
+        try:
+            get_password_pool(current_app.config).submit(rehash).add_done_callback(log_failure)
+        except PasswordPoolSaturated:
+            logger.info(f"Password pool busy, deferring rehash for user {user_id}")
+
+    @staticmethod
+    def get_or_create_user_by_google_info(google_info):
+        """
+        Retrieves a user by their Google information. If the user does not exist,
+        creates a new SSO user with the provided Google information.
 
+        Returns the UserRecord, existing or new, from one upsert
+        """
+        engine = manager.connect_with_connector(is_local=False)
+        user_data = sso_user_data(google_info)
         with engine.connect() as connection:
-            user = connection.execute(query_find_user, user_data).fetchone()
-            
-            if user:
-                return user
-                # return {key: user[key] for key in user.keys()}
-            
-            query_create_user = sqlalchemy.text("""
-                INSERT INTO users (username, email, name, oath_token, auth_type) 
-                VALUES (:email, :email, :name, :oath_token, 'sso');
-            """)
-            
-            new_user_data = {
-                'email': google_info['email'],
-                'name': google_info.get('name', ''),
-                'oath_token': google_info.get('oauth_token', '')
-            }
-            
-            connection.execute(query_create_user, new_user_data)
-            new_user = connection.execute(query_find_user, {'email': google_info['email']}).fetchone()
+            row = UPSERT_SSO_USER.execute(connection, user_data).fetchone()
             connection.commit()
-            return new_user if new_user else None
+        known = get_known_emails(current_app.config)
+        if known is not None:
+            known.add(row.email)
+        return UserRecord.from_row(row)
 
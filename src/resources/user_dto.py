@@ -1,12 +1,11 @@
 # user_dto.py
-from model.user import User
-# user_dto.py
+from model.user import UserRecord
 
 class UserDTO:
     @staticmethod
     def from_model(user):
         """
-        Transforms a User model instance into a DTO format.
+        Transforms a UserRecord into a DTO format.
         """
         try:
             return {
@@ -16,40 +15,24 @@ class UserDTO:
                 'first_name': user.first_name,
                 'last_name': user.last_name,
                 'password': user.password,
-                'auth_type':user.auth_type
-                # Exclude password, oath_token, and auth_type for security
-            }
-        except:
-            return None
-    @staticmethod
-    def from_model_update(user):
-        """
-        Transforms a User model instance into a DTO format.
-        """
-        try:
-            return {
-                'username': user.username,
-                'first_name': user.first_name,
-                'last_name': user.last_name,
-                'password': user.password,
+                'auth_type':user.auth_type,
+                'profile_version': user.profile_version
                 # Exclude password, oath_token, and auth_type for security
             }
         except:
             return None
-        
     @staticmethod
     def to_model(data):
         """
-        Returns model if value, otherwise returns None
+        Returns a UserRecord if valid, otherwise returns None
         """
-        # Assuming a User class and a password hashing function exist
         try:
             if 'username' not in data or 'email' not in data or 'first_name' not in data or 'last_name' not in data:
                 raise ValueError("Missing mandatory user fields")
 
             password = data.get('password')
 
-            return User(
+            return UserRecord(
                 id=data.get('id'),
                 username=data['username'],
                 email=data['email'],
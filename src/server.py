@@ -1,12 +1,16 @@
-from user import create_app
-from controller import endpoints
+import os
 
-from dotenv import load_dotenv
-load_dotenv()
+from user import create_app
+from controller.endpoints import google_oauth_client, service_required
+from resources.email_filter import get_known_emails
+from resources.signing_keys import get_key_ring
+from resources.user_dao import manager, refresh_email_filter
+from util.metrics import metrics_payload
+from util.password_pool import bcrypt_rounds
+from util.utils import dummy_hash
 
-# App instance
+# App instance; create_app() registers the API blueprint
 app = create_app()
-app.register_blueprint(endpoints.bp)
 
 
 
@@ -15,5 +19,74 @@ def home():
     return {'home': 'Please go to a specific endpoint'}
 
 
+@app.route('/ready', methods=['GET'])
+def ready():
+    """
+    Readiness probe: 200 once this worker's DB pool is warm, else 503.
+    A cold worker tries to warm up on each probe. Open to anyone, so it
+    reports nothing else; pool details are on /pool.
+    """
+    if not manager.is_warm():
+        try:
+            manager.warm_pool(is_local=False)
+        except Exception as e:
+            app.logger.error(f"DB pool warm-up failed: {e}")
+            return {'ready': False}, 503
+    return {'ready': True}, 200
+
+
+def warm_worker():
+    """
+    Creates this worker's DB pool, its Google OAuth client (which starts
+    fetching Google's signing keys) if Google sign-in is configured, the
+    dummy hash for unknown-email logins and the known-email filter, before
+    the first request. Called by the gunicorn post_worker_init hook;
+    failures leave /ready at 503, except a bad JWT signing key, which stops
+    the worker (create_app already checked the refresh token store and the
+    profile version list).
+    """
+    get_key_ring(app.config)
+    if os.getenv('GOOGLE_CLIENT_ID'):
+        google_oauth_client(app)
+    with app.app_context():
+        dummy_hash(bcrypt_rounds())
+        try:
+            manager.warm_pool(is_local=False)
+        except Exception as e:
+            app.logger.error(f"DB pool warm-up failed: {e}")
+        refresh_email_filter(wait=True)
+
+
+@app.route('/pool', methods=['GET'])
+@service_required
+def pool_status():
+    """
+    Occupancy of this worker's DB pool and time spent waiting on checkouts.
+    """
+    return manager.pool_status()
+
+
+@app.route('/metrics', methods=['GET'])
+@service_required
+def metrics():
+    """
+    Prometheus metrics: per-endpoint latency and phase histograms, cache lookups.
+    """
+    payload, content_type = metrics_payload()
+    return payload, 200, {'Content-Type': content_type}
+
+
+@app.route('/email-filter', methods=['GET'])
+@service_required
+def email_filter_status():
+    """
+    Size, memory and estimated false-positive rate of this worker's
+    known-email filter.
+    """
+    known = get_known_emails(app.config)
+    return known.stats() if known is not None else {'enabled': False}
+
+
 if __name__ == '__main__':
+    # Development server only; production runs under gunicorn (gunicorn.conf.py)
     app.run(debug=False, host='0.0.0.0', port=9090)
@@ -6,7 +6,6 @@ from flask_cors import CORS
 
 from dotenv import load_dotenv
 load_dotenv()
-from flask_jwt_extended import JWTManager
 from datetime import timedelta
 
 logger = logging.getLogger()
@@ -20,14 +19,31 @@ def create_app(test_config=None) -> Flask:
     )
     app.config['JWT_SECRET_KEY'] = os.getenv('JWT_SECRET_KEY')
     app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(hours=4)
+    # Sessions are renewed through /api/user/refresh; see resources.refresh_tokens
+    app.config['JWT_REFRESH_TOKEN_EXPIRES'] = timedelta(days=30)
 
     # Use cookies rather than header
     # app.config['JWT_TOKEN_LOCATION'] = ['cookies']
     # app.config['JWT_COOKIE_SECURE'] = True  # Use True in production for HTTPS
     # app.config['JWT_COOKIE_CSRF_PROTECT'] = True  # CSRF protection
-    jwt = JWTManager(app)
+    from util.metrics import TimedJWTManager
+    jwt = TimedJWTManager(app)
+    # RS256/EdDSA signing with published keys once JWT_SIGNING_KEYS is set
+    from resources.signing_keys import generate_jwt_key_command, init_jwt_keys
+    init_jwt_keys(jwt)
     CORS(app)
 
+    from user.db import DatabaseManager
+    DatabaseManager().init_app(app)
+    from util.password_pool import calibrate_bcrypt_command
+    app.cli.add_command(calibrate_bcrypt_command)
+    from resources.user_bulk import users_cli
+    app.cli.add_command(users_cli)
+    app.cli.add_command(generate_jwt_key_command)
+
+    from controller.endpoints import bp
+    app.register_blueprint(bp)
+
     try:
         os.makedirs(app.instance_path)
     except OSError:
@@ -37,5 +53,18 @@ def create_app(test_config=None) -> Flask:
         app.config.from_pyfile('.env.py')
     else:
         app.config.from_mapping(test_config)
-        
+
+    # Behind proxies, trust that many X-Forwarded-For entries for
+    # request.remote_addr (the login throttle's client key)
+    if app.config.get('TRUSTED_PROXY_HOPS'):
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXY_HOPS'])
+
+    # Built now so a per-worker store with several workers stops the app
+    # (either server) before it serves, not on a write that already committed
+    from resources.refresh_tokens import get_refresh_tokens
+    from resources.user_cache import get_profile_versions
+    get_refresh_tokens(app.config)
+    get_profile_versions(app.config)
+
     return app
\ No newline at end of file
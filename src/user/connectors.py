@@ -0,0 +1,236 @@
+import atexit
+import importlib
+import logging
+import os
+import threading
+import time
+
+import pg8000
+
+logger = logging.getLogger()
+
+
+class ConnectStats:
+    """
+    Time spent opening new DB connections. The first connect of a process is
+    kept apart ("cold") since it pays certificate fetching and key exchange.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.cold_ms = None
+            self.count = 0
+            self.total = 0.0
+            self.max = 0.0
+
+    def record(self, seconds):
+        with self._lock:
+            if self.cold_ms is None:
+                self.cold_ms = round(seconds * 1000, 3)
+                return
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'cold_ms': self.cold_ms,
+                'steady_count': self.count,
+                'steady_avg_ms': round(self.total * 1000 / self.count, 3) if self.count else 0.0,
+                'steady_max_ms': round(self.max * 1000, 3),
+            }
+
+
+connect_stats = ConnectStats()
+
+
+class LocalConnector:
+    """
+    Plain connections to a Postgres reachable from this host, with the
+    DB_DRIVER driver (pg8000 by default, or psycopg2 / psycopg).
+
+    Also serves as the stand-in for Cloud SQL in tests and benchmarks
+    (DB_CONNECTOR = 'local'), and reaches Cloud SQL through the Cloud SQL
+    Auth Proxy when another driver than pg8000 is wanted.
+    """
+    name = 'local'
+
+    def __init__(self, config):
+        self.driver = config.get("DB_DRIVER", 'pg8000')
+        self.kwargs = {
+            'user': config["LOCAL_DB_USER"],  # e.g. 'my-db-user'
+            'password': config["LOCAL_DB_PASS"],  # e.g. 'my-db-password'
+            'database': config["LOCAL_DB_NAME"],  # e.g. 'my-database'
+        }
+        if config.get("LOCAL_DB_UNIX_SOCK"):
+            self.kwargs['unix_sock'] = config["LOCAL_DB_UNIX_SOCK"]
+        else:
+            self.kwargs['host'] = config.get("LOCAL_DB_HOST", 'localhost')
+            self.kwargs['port'] = int(config.get("LOCAL_DB_PORT", 5432))
+
+    def connect(self):
+        if self.driver == 'pg8000':
+            return pg8000.connect(**self.kwargs)
+        if self.driver == 'psycopg2':
+            import psycopg2
+            return psycopg2.connect(dbname=self.kwargs['database'], **self.libpq_kwargs())
+        if self.driver == 'psycopg':
+            import psycopg
+            return psycopg.connect(dbname=self.kwargs['database'], **self.libpq_kwargs())
+        raise ValueError(f"Unknown DB_DRIVER '{self.driver}'")
+
+    def libpq_kwargs(self):
+        """
+        user, password, host and port in the form libpq-based drivers
+        (psycopg, asyncpg) take them.
+        """
+        kwargs = {key: self.kwargs[key] for key in ('user', 'password')}
+        if 'unix_sock' in self.kwargs:
+            # These take the socket's directory and derive the file from the port
+            directory, name = os.path.split(self.kwargs['unix_sock'])
+            kwargs.update(host=directory, port=int(name.rsplit('.', 1)[-1]))
+        else:
+            kwargs.update(host=self.kwargs['host'], port=self.kwargs['port'])
+        return kwargs
+
+    async def connect_async(self):
+        """
+        asyncpg connection to the same database, for the ASGI service.
+        """
+        import asyncpg
+
+        return await asyncpg.connect(database=self.kwargs['database'], **self.libpq_kwargs())
+
+    def close(self):
+        pass
+
+    async def close_async(self):
+        pass
+
+
+class CloudSQLConnector:
+    """
+    Connections to a Cloud SQL instance through the Cloud SQL Python Connector.
+
+    The underlying Connector caches the instance certificate and ephemeral key
+    and refreshes them in the background (or on demand with
+    CLOUD_SQL_REFRESH_STRATEGY = 'lazy', better suited to CPU-throttled hosts).
+    """
+    name = 'cloud-sql'
+
+    def __init__(self, config, loop=None):
+        if config.get("DB_DRIVER", 'pg8000') != 'pg8000':
+            raise ValueError("The Cloud SQL connector only supports pg8000 (sync) and asyncpg; "
+                             "use DB_CONNECTOR = 'local' through the Cloud SQL Auth Proxy for other drivers")
+        from google.cloud.sql.connector import Connector, IPTypes
+
+        # Note: Saving credentials in environment variables is convenient, but not
+        # secure - consider a more secure solution such as
+        # Cloud Secret Manager (https://cloud.google.com/secret-manager) to help
+        # keep secrets safe.
+        self.instance_connection_name = config[
+            "INSTANCE_CONNECTION_NAME"
+        ]  # e.g. 'project:region:instance'
+        self.kwargs = {
+            'user': config["DB_USER"],  # e.g. 'my-db-user'
+            'password': config["DB_PASS"],  # e.g. 'my-db-password'
+            'db': config["DB_NAME"],  # e.g. 'my-database'
+            'ip_type': IPTypes.PRIVATE if config.get("PRIVATE_IP") else IPTypes.PUBLIC,
+        }
+
+        connector_kwargs = {}
+        if config.get("CLOUD_SQL_REFRESH_STRATEGY"):
+            connector_kwargs['refresh_strategy'] = config["CLOUD_SQL_REFRESH_STRATEGY"]
+        if loop is not None:
+            # Bound to the caller's event loop, for connect_async
+            connector_kwargs['loop'] = loop
+        self.connector = Connector(**connector_kwargs)
+
+    def connect(self) -> pg8000.dbapi.Connection:
+        return self.connector.connect(self.instance_connection_name, "pg8000", **self.kwargs)
+
+    async def connect_async(self):
+        return await self.connector.connect_async(self.instance_connection_name, "asyncpg", **self.kwargs)
+
+    def close(self):
+        self.connector.close()
+
+    async def close_async(self):
+        await self.connector.close_async()
+
+
+CONNECTORS = {
+    LocalConnector.name: LocalConnector,
+    CloudSQLConnector.name: CloudSQLConnector,
+}
+
+
+def load_connector_class(name):
+    """
+    Resolves a registered connector name or a 'module:Class' import path.
+    """
+    if name in CONNECTORS:
+        return CONNECTORS[name]
+    if ':' not in name:
+        raise ValueError(f"Unknown DB_CONNECTOR '{name}'")
+    module_name, class_name = name.split(':', 1)
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+# One connector per process; rebuilt in forked children because the Cloud SQL
+# Connector's refresh thread and event loop do not survive a fork.
+_connector = None
+_connector_pid = None
+_connector_lock = threading.Lock()
+
+
+def get_connector(config):
+    """
+    Returns the process-wide connector, creating it from `config` on first use.
+    """
+    global _connector, _connector_pid
+    if _connector is not None and _connector_pid == os.getpid():
+        return _connector
+
+    with _connector_lock:
+        if _connector is None or _connector_pid != os.getpid():
+            connector_class = load_connector_class(config.get('DB_CONNECTOR', CloudSQLConnector.name))
+            _connector = connector_class(config)
+            _connector_pid = os.getpid()
+            connect_stats.reset()
+            logger.info(f"Created {getattr(connector_class, 'name', connector_class.__name__)} "
+                        f"connector in process {_connector_pid}")
+    return _connector
+
+
+def timed_connect(connector):
+    """
+    Returns a pool `creator` that opens connections through `connector`
+    and records how long each one took.
+    """
+    def getconn():
+        start = time.perf_counter()
+        conn = connector.connect()
+        connect_stats.record(time.perf_counter() - start)
+        return conn
+    return getconn
+
+
+def close_connector():
+    """
+    Shutdown hook: stops the connector's refresh machinery, if any.
+    """
+    global _connector
+    with _connector_lock:
+        if _connector is not None and _connector_pid == os.getpid():
+            _connector.close()
+            logger.info("DB connector closed.")
+        _connector = None
+
+
+atexit.register(close_connector)
@@ -1,13 +1,273 @@
+import itertools
 import os
 import logging
-import psycopg2, pprint
-from flask import g, current_app
-from flask.cli import with_appcontext
+import re
+import threading
+import time
+from flask import current_app
 import click
-from google.cloud.sql.connector import Connector, IPTypes
-import pg8000
 
 import sqlalchemy
+from sqlalchemy.engine.result import IteratorResult, SimpleResultMetaData
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+from user.connectors import LocalConnector, close_connector, connect_stats, get_connector, timed_connect
+from util import metrics
+
+
+# Pool tuning, overridable from the app config (e.g. instance/.env.py)
+POOL_DEFAULTS = {
+    # Pool size is the maximum number of permanent connections to keep.
+    'DB_POOL_SIZE': 5,
+    # Temporarily exceeds the set pool_size if no connections are available.
+    'DB_MAX_OVERFLOW': 2,
+    # Maximum number of seconds to wait when retrieving a connection from the pool.
+    'DB_POOL_TIMEOUT': 30,
+    # Maximum number of seconds a connection can persist before being re-established.
+    'DB_POOL_RECYCLE': 1800,
+    # Test connections with a lightweight ping on checkout, dropping stale ones.
+    'DB_POOL_PRE_PING': True,
+    # DBAPI driver: 'pg8000', 'psycopg2' or 'psycopg' (3.x). Cloud SQL
+    # connections are always pg8000.
+    'DB_DRIVER': 'pg8000',
+    # Prepare DAO queries server-side once per pooled connection. Turn off
+    # behind a transaction-pooling proxy such as PgBouncer.
+    'DB_PREPARED_STATEMENTS': True,
+}
+
+DRIVERS = ('pg8000', 'psycopg2', 'psycopg')
+
+
+class CheckoutStats:
+    """
+    Running totals of the time callers spent waiting for a pooled connection.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.count = 0
+            self.timeouts = 0
+            self.total_wait = 0.0
+            self.max_wait = 0.0
+
+    def record(self, seconds, timed_out=False):
+        with self._lock:
+            self.count += 1
+            self.total_wait += seconds
+            self.max_wait = max(self.max_wait, seconds)
+            if timed_out:
+                self.timeouts += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'checkouts': self.count,
+                'timeouts': self.timeouts,
+                'total_wait_ms': round(self.total_wait * 1000, 3),
+                'avg_wait_ms': round(self.total_wait * 1000 / self.count, 3) if self.count else 0.0,
+                'max_wait_ms': round(self.max_wait * 1000, 3),
+            }
+
+
+checkout_stats = CheckoutStats()
+
+
+class TimedCheckout:
+    """
+    Pool mixin that records how long each checkout waited for a connection,
+    in checkout_stats and in the current request's 'pool_wait' phase.
+    """
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except sqlalchemy.exc.TimeoutError:
+            checkout_stats.record(time.perf_counter() - start, timed_out=True)
+            metrics.record('pool_wait', time.perf_counter() - start)
+            raise
+        checkout_stats.record(time.perf_counter() - start)
+        metrics.record('pool_wait', time.perf_counter() - start)
+        return conn
+
+
+class TimedQueuePool(TimedCheckout, QueuePool):
+    pass
+
+
+class TimedAsyncQueuePool(TimedCheckout, AsyncAdaptedQueuePool):
+    pass
+
+
+class Query:
+    """
+    A SQL statement built once at import time. Execute it with
+    `QUERY.execute(connection, params)`; `QUERY.text` is the plain
+    TextClause for callers that do not need prepared statements.
+
+    On engines built with prepared statements, each pooled connection
+    prepares the statement on first use and afterwards only binds and
+    executes it, by the driver's own means:
+    - pg8000: a named protocol-level prepared statement, on legacy
+      connections only (pg8000.dbapi ones run the plain statement)
+    - psycopg2: PREPARE / EXECUTE (psycopg2 binds parameters client-side)
+    - psycopg: the driver's prepared statement cache (prepare_threshold)
+    """
+    _numbers = itertools.count()
+    _bind = re.compile(r"(?<![:\w\\]):(\w+)(?!:)")
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.text = sqlalchemy.text(sql)
+        self.name = f"user_query_{next(Query._numbers)}"
+        self.params = list(dict.fromkeys(self._bind.findall(sql)))
+        positions = {name: f"${i}" for i, name in enumerate(self.params, start=1)}
+        self._prepare_sql = f"PREPARE {self.name} AS " + self._bind.sub(lambda m: positions[m.group(1)], sql)
+        self._execute_text = sqlalchemy.text(
+            f"EXECUTE {self.name}" + (f"({', '.join(':' + p for p in self.params)})" if self.params else ""))
+
+    def execute(self, connection, params=None):
+        """
+        Runs the statement on a SQLAlchemy connection and returns a Result.
+        """
+        params = params or {}
+        if not connection.get_execution_options().get('prepared_statements'):
+            return connection.execute(self.text, params)
+        driver = connection.dialect.driver
+        if driver == 'pg8000':
+            return self._execute_pg8000(connection, params)
+        if driver == 'psycopg2':
+            prepared = connection.connection.info.setdefault('prepared_statements', set())
+            if self.name not in prepared:
+                connection.exec_driver_sql(self._prepare_sql)
+                prepared.add(self.name)
+            return connection.execute(self._execute_text, params)
+        return connection.execute(self.text, params)
+
+    def _execute_pg8000(self, connection, params):
+        if not hasattr(connection.connection.dbapi_connection, 'prepare'):
+            # Only pg8000's legacy connection (pg8000.connect) can prepare;
+            # the Cloud SQL connector hands out pg8000.dbapi connections
+            return connection.execute(self.text, params)
+        if not connection.in_transaction():
+            # The statement bypasses SQLAlchemy's execute(), which would
+            # otherwise begin the transaction that commit() ends
+            connection.begin()
+        prepared = connection.connection.info.setdefault('prepared_statements', {})
+        # Bypasses the cursor events metrics.instrument_engine() times
+        start = time.perf_counter()
+        statement = prepared.get(self.name)
+        if statement is None:
+            statement = prepared[self.name] = connection.connection.dbapi_connection.prepare(self.sql)
+        rows = statement.run(**{name: params[name] for name in self.params})
+        metrics.record_round_trip(time.perf_counter() - start)
+        columns = [column['name'] for column in statement.row_desc or ()]
+        return IteratorResult(SimpleResultMetaData(columns), iter(rows))
+
+
+def build_engine(config, getconn, **kwargs) -> sqlalchemy.engine.base.Engine:
+    """
+    Creates a pooled engine for connections from `getconn`, with the pool,
+    driver and statement settings in `config`.
+    """
+    setting = lambda key: config.get(key, POOL_DEFAULTS[key])
+    driver = setting('DB_DRIVER')
+    if driver not in DRIVERS:
+        raise ValueError(f"Unknown DB_DRIVER '{driver}'")
+    prepared = bool(setting('DB_PREPARED_STATEMENTS'))
+    engine = sqlalchemy.create_engine(
+        f"postgresql+{driver}://",
+        creator=getconn,
+        pool_size=setting('DB_POOL_SIZE'),
+        max_overflow=setting('DB_MAX_OVERFLOW'),
+        pool_timeout=setting('DB_POOL_TIMEOUT'),
+        pool_recycle=setting('DB_POOL_RECYCLE'),
+        pool_pre_ping=setting('DB_POOL_PRE_PING'),
+        execution_options={'prepared_statements': prepared},
+        **kwargs,
+    )
+    if driver == 'psycopg':
+        @sqlalchemy.event.listens_for(engine, 'connect')
+        def set_prepare_threshold(dbapi_connection, connection_record):
+            # Prepare on first execution, or never
+            dbapi_connection.prepare_threshold = 0 if prepared else None
+    metrics.instrument_engine(engine)
+    return engine
+
+
+# Migrations live in user/migrations as NNNN_description.sql and are applied
+# in order; schema_migrations records which ones a database already has.
+MIGRATIONS_DIR = 'migrations'
+MIGRATION_LOCK_KEY = 7219431
+
+
+def available_migrations(root_path):
+    """
+    Returns (version, path) pairs for every migration file, in order.
+    """
+    directory = os.path.join(root_path, MIGRATIONS_DIR)
+    return [
+        (name[:-len('.sql')], os.path.join(directory, name))
+        for name in sorted(os.listdir(directory))
+        if name.endswith('.sql')
+    ]
+
+
+def split_sql(script):
+    """
+    Splits a SQL script into statements on semicolons, ignoring those inside
+    single-quoted strings and -- comments. Dollar quoting is not supported.
+    """
+    statements, current = [], []
+    in_string = in_comment = False
+    for char in script:
+        if in_comment:
+            if char == '\n':
+                in_comment = False
+                current.append(char)
+            continue
+        if char == "'":
+            in_string = not in_string
+        elif not in_string and char == '-' and current and current[-1] == '-':
+            current.pop()
+            in_comment = True
+            continue
+        elif not in_string and char == ';':
+            statements.append(''.join(current))
+            current = []
+            continue
+        current.append(char)
+    statements.append(''.join(current))
+    return [statement.strip() for statement in statements if statement.strip()]
+
+
+# Engines are process-wide: built once per worker on first use and reused by
+# every request. They are keyed by kind ('local' or 'cloud').
+_engines = {}
+_engines_pid = os.getpid()
+_engines_lock = threading.Lock()
+_warm_pids = set()
+
+
+def _forget_engines():
+    """
+    Drop engines inherited from a parent process without closing its sockets.
+    """
+    global _engines_pid
+    for engine in _engines.values():
+        engine.dispose(close=False)
+    _engines.clear()
+    checkout_stats.reset()
+    connect_stats.reset()
+    _engines_pid = os.getpid()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_engines)
 
 
 class DatabaseManager:
@@ -19,117 +279,145 @@ class DatabaseManager:
             return self.connect_with_local()
         return self.connect_with_cloud()
 
+    def _get_engine(self, kind, getconn) -> sqlalchemy.engine.base.Engine:
+        """
+        Returns the process-wide engine for `kind`, creating it on first use.
+        """
+        if _engines_pid != os.getpid():  # forked without the at-fork hook
+            _forget_engines()
+        engine = _engines.get(kind)
+        if engine is not None:
+            return engine
+
+        with _engines_lock:
+            engine = _engines.get(kind)
+            if engine is None:
+                engine = build_engine(current_app.config, getconn, poolclass=TimedQueuePool)
+                _engines[kind] = engine
+                self.logger.info(f"Created {kind} DB pool in process {os.getpid()}")
+        return engine
+
     def connect_with_local(self) -> sqlalchemy.engine.base.Engine:
         """
-            Initializes a connection pool for the LOCAL database.
-        """
-        db_user = current_app.config["LOCAL_DB_USER"]  # e.g. 'my-db-user'
-        db_pass = current_app.config["LOCAL_DB_PASS"]  # e.g. 'my-db-password'
-        db_name = current_app.config["LOCAL_DB_NAME"]  # e.g. 'my-database'
-
-        def getconn() -> pg8000.dbapi.Connection:
-            conn: pg8000.dbapi.Connection = pg8000.connect(
-                user=db_user,
-                password=db_pass,
-                database=db_name,
-            )
-            return conn
-
-        if 'pool' not in g:
-            g.pool = sqlalchemy.create_engine(
-                "postgresql+pg8000://",
-                creator=getconn,
-                pool_size=5,
-                max_overflow=2,
-                pool_timeout=30,
-                pool_recycle=1800,
-            )
-            self.logger.info(f"Connected to DB")
-        return g.pool
+            Returns the connection pool for the LOCAL database.
+        """
+        if 'local' in _engines and _engines_pid == os.getpid():
+            return _engines['local']
+        return self._get_engine('local', timed_connect(LocalConnector(current_app.config)))
 
     def connect_with_cloud(self) -> sqlalchemy.engine.base.Engine:
         """
-        Initializes a connection pool for a Cloud SQL instance of Postgres.
-        Uses the Cloud SQL Python Connector package.
-        """
-        # Note: Saving credentials in environment variables is convenient, but not
-        # secure - consider a more secure solution such as
-        # Cloud Secret Manager (https://cloud.google.com/secret-manager) to help
-        # keep secrets safe.
-        instance_connection_name = current_app.config[
-            "INSTANCE_CONNECTION_NAME"
-        ]  # e.g. 'project:region:instance'
-        db_user = current_app.config["DB_USER"]  # e.g. 'my-db-user'
-        db_pass = current_app.config["DB_PASS"]  # e.g. 'my-db-password'
-        db_name = current_app.config["DB_NAME"]  # e.g. 'my-database'
-
-        ip_type = IPTypes.PRIVATE if current_app.config.get("PRIVATE_IP") else IPTypes.PUBLIC
-
-        # initialize Cloud SQL Python Connector object
-        connector = Connector()
-
-        def getconn() -> pg8000.dbapi.Connection:
-            conn: pg8000.dbapi.Connection = connector.connect(
-                instance_connection_name,
-                "pg8000",
-                user=db_user,
-                password=db_pass,
-                db=db_name,
-                ip_type=ip_type,
-            )
-            return conn
+        Returns the connection pool for a Cloud SQL instance of Postgres.
 
+        Connections come from the process-wide connector (DB_CONNECTOR, default
+        'cloud-sql'), so certificates and keys are fetched once per worker.
+        """
         # The Cloud SQL Python Connector can be used with SQLAlchemy
         # using the 'creator' argument to 'create_engine'
-        if 'pool' not in g:
-            g.pool = sqlalchemy.create_engine(
-                "postgresql+pg8000://",
-                creator=getconn,
-                # [START_EXCLUDE]
-                # Pool size is the maximum number of permanent connections to keep.
-                pool_size=5,
-                # Temporarily exceeds the set pool_size if no connections are available.
-                max_overflow=2,
-                # The total number of concurrent connections for your application will be
-                # a total of pool_size and max_overflow.
-                # 'pool_timeout' is the maximum number of seconds to wait when retrieving a
-                # new connection from the pool. After the specified amount of time, an
-                # exception will be thrown.
-                pool_timeout=30,  # 30 seconds
-                # 'pool_recycle' is the maximum number of seconds a connection can persist.
-                # Connections that live longer than the specified amount of time will be
-                # re-established
-                pool_recycle=1800,  # 30 minutes
-                # [END_EXCLUDE]
-            )
-            self.logger.info(f"Connected to DB")
-        return g.pool
+        if 'cloud' in _engines and _engines_pid == os.getpid():
+            return _engines['cloud']
+        return self._get_engine('cloud', timed_connect(get_connector(current_app.config)))
 
-    def close_db(self, e=None):
-        db = g.pop('pool', None)
+    def warm_pool(self, is_local=False, size=None):
+        """
+        Opens `size` connections (default DB_POOL_SIZE) and returns them to
+        the pool, so the first requests do not pay for connecting.
+        """
+        engine = self.connect_with_connector(is_local=is_local)
+        size = size or current_app.config.get('DB_POOL_SIZE', POOL_DEFAULTS['DB_POOL_SIZE'])
+        connections = []
+        try:
+            for _ in range(size):
+                connections.append(engine.connect())
+        finally:
+            for connection in connections:
+                connection.close()
+        _warm_pids.add(os.getpid())
+        self.logger.info(f"Warmed DB pool with {size} connections in process {os.getpid()}")
+
+    def is_warm(self):
+        """
+        True once this process has warmed its pool.
+        """
+        return os.getpid() in _warm_pids
+
+    def pool_status(self):
+        """
+        Returns occupancy of each process-wide pool and checkout wait totals.
+        """
+        pools = {}
+        for kind, engine in list(_engines.items()):
+            pool = engine.pool
+            pools[kind] = {
+                'size': pool.size(),
+                'checked_in': pool.checkedin(),
+                'checked_out': pool.checkedout(),
+                'overflow': pool.overflow(),
+            }
+        return {
+            'pid': os.getpid(),
+            'pools': pools,
+            'checkout_wait': checkout_stats.snapshot(),
+            'connect': connect_stats.snapshot(),
+        }
 
-        if db is not None:
-            db.dispose()
+    def close_db(self, e=None):
+        """
+        Disposes the process-wide pools. Only for shutdown and CLI commands;
+        requests must leave the pool open for the next caller.
+        """
+        with _engines_lock:
+            for engine in _engines.values():
+                engine.dispose()
+            _engines.clear()
+        close_connector()
         self.logger.info("DB Connection Closed.")
 
-    def init_db(self):
-        pool = self.connect_with_connector()
-        with current_app.open_resource('schema.sql') as f:
-            sql_statement = f.read().decode('utf8').split(';')
-            with pool.connect() as cursor:
-                transaction = cursor.begin()
-                for command in sql_statement:
-                    cursor.execute(sqlalchemy.text(command + ";"))
-                transaction.commit()
-        self.close_db()
+    def applied_migrations(self, connection):
+        connection.execute(sqlalchemy.text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            " version VARCHAR(255) PRIMARY KEY,"
+            " applied_at TIMESTAMPTZ NOT NULL DEFAULT now());"
+        ))
+        rows = connection.execute(sqlalchemy.text("SELECT version FROM schema_migrations;"))
+        return {row.version for row in rows}
 
-    @click.command('init-db')
-    @with_appcontext
-    def init_db_command(self):
-        """Clear existing data and create new tables."""
-        self.init_db()
-        click.echo('Initialized the database.')
+    def migrate(self, is_local=True):
+        """
+        Applies pending migrations in version order, each in its own
+        transaction. Returns the versions applied.
+        """
+        pool = self.connect_with_connector(is_local=is_local)
+        applied_now = []
+        for version, path in available_migrations(current_app.root_path):
+            with pool.connect() as connection:
+                # Serialise concurrent migrators (e.g. several workers starting)
+                connection.execute(sqlalchemy.text("SELECT pg_advisory_xact_lock(:key);"),
+                                   {'key': MIGRATION_LOCK_KEY})
+                if version in self.applied_migrations(connection):
+                    connection.commit()
+                    continue
+                with open(path, encoding='utf8') as f:
+                    for command in split_sql(f.read()):
+                        connection.execute(sqlalchemy.text(command))
+                connection.execute(sqlalchemy.text("INSERT INTO schema_migrations (version) VALUES (:version);"),
+                                   {'version': version})
+                connection.commit()
+            self.logger.info(f"Applied migration {version}")
+            applied_now.append(version)
+        return applied_now
+
+    def init_db(self, is_local=True):
+        applied = self.migrate(is_local=is_local)
+        self.close_db()
+        return applied
 
     def init_app(self, app):
-        app.teardown_appcontext(self.close_db)
-        app.cli.add_command(self.init_db_command)
\ No newline at end of file
+        @app.cli.command('init-db')
+        @click.option('--local/--cloud', default=True, help='Database to migrate (default: local).')
+        def init_db_command(local):
+            """Create or upgrade tables by applying pending migrations."""
+            applied = self.init_db(is_local=local)
+            for version in applied:
+                click.echo(f'Applied {version}')
+            click.echo('Initialized the database.' if applied else 'Database is up to date.')
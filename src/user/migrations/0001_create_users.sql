@@ -0,0 +1,12 @@
+-- Baseline schema. IF NOT EXISTS lets databases created by the old
+-- init-db (schema.sql) adopt migrations without losing data.
+CREATE TABLE IF NOT EXISTS users (
+  id SERIAL PRIMARY KEY,
+  username VARCHAR(255) NOT NULL,
+  email VARCHAR(255) NOT NULL UNIQUE,
+  first_name VARCHAR(255) NOT NULL,
+  last_name VARCHAR(255) NOT NULL,
+  password VARCHAR(255),
+  auth_type VARCHAR(255) NOT NULL DEFAULT 'local'
+    CONSTRAINT auth_type_check CHECK (auth_type IN ('local', 'sso'))
+);
@@ -0,0 +1,9 @@
+-- Login, registration and SSO all look users up by email; make that an
+-- index scan and enforce uniqueness regardless of case.
+CREATE UNIQUE INDEX IF NOT EXISTS users_email_lower_key ON users (lower(email));
+ALTER TABLE users DROP CONSTRAINT IF EXISTS users_email_key;
+
+CREATE INDEX IF NOT EXISTS users_username_idx ON users (username);
+
+-- Declared by model.user.UserRecord (oath_token)
+ALTER TABLE users ADD COLUMN IF NOT EXISTS oath_token VARCHAR(255);
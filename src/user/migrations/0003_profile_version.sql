@@ -0,0 +1,3 @@
+-- Bumped on every profile change so tokens carrying profile claims can be
+-- recognised as stale.
+ALTER TABLE users ADD COLUMN IF NOT EXISTS profile_version INTEGER NOT NULL DEFAULT 1;
@@ -0,0 +1,4 @@
+-- Prefix search for the user listing (LIKE 'abc%'). The unique index on
+-- lower(email) cannot serve LIKE under a non-C collation; text_pattern_ops can.
+CREATE INDEX IF NOT EXISTS users_username_prefix_idx ON users (lower(username) text_pattern_ops);
+CREATE INDEX IF NOT EXISTS users_email_prefix_idx ON users (lower(email) text_pattern_ops);
@@ -0,0 +1,8 @@
+-- The id of the transaction that inserted each row, so the known-email
+-- filter (resources.email_filter) can sync by commit horizon: every
+-- transaction below a snapshot's xmin has finished. Ids are drawn before
+-- commit, so they cannot tell which rows a sync has already seen. Rows from
+-- before this migration stay NULL; filter rebuilds read every row.
+ALTER TABLE users ADD COLUMN IF NOT EXISTS created_xid xid8;
+ALTER TABLE users ALTER COLUMN created_xid SET DEFAULT pg_current_xact_id();
+CREATE INDEX IF NOT EXISTS users_created_xid_idx ON users (created_xid);
@@ -0,0 +1,164 @@
+"""
+Prometheus metrics for the user service, and the per-request phase timings
+behind them.
+
+Each request gets a set of phase totals (DB statements, pool checkout wait,
+bcrypt, JWT encode/decode) that the code doing the work adds to through
+`record()` or `phase()`. When the request ends, its latency and phase totals
+go to the histograms and, if it was slower than SLOW_REQUEST_SECONDS, to the
+log with the breakdown. Work outside a request (CLI commands, background
+rehashes) is not attributed to any request.
+
+Under gunicorn, set PROMETHEUS_MULTIPROC_DIR to an empty directory so
+/metrics aggregates all workers instead of reporting whichever one answers.
+"""
+import contextlib
+import contextvars
+import logging
+import os
+import time
+
+import sqlalchemy
+from flask_jwt_extended import JWTManager
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess,
+)
+
+logger = logging.getLogger()
+
+METRICS_DEFAULTS = {
+    # Log requests slower than this many seconds with their phase breakdown;
+    # None turns the log off
+    'SLOW_REQUEST_SECONDS': None,
+}
+
+PHASES = ('db', 'pool_wait', 'bcrypt', 'jwt_encode', 'jwt_decode')
+
+REQUEST_SECONDS = Histogram(
+    'user_service_request_seconds', 'Request latency by endpoint',
+    ['endpoint', 'method', 'status'],
+)
+PHASE_SECONDS = Histogram(
+    'user_service_request_phase_seconds', 'Time one request spent in each phase',
+    ['endpoint', 'phase'],
+)
+DB_ROUND_TRIPS = Histogram(
+    'user_service_request_db_round_trips', 'Statements and commits one request sent to the database',
+    ['endpoint'], buckets=(0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20),
+)
+CACHE_LOOKUPS = Counter(
+    'user_service_cache_lookups_total', 'User cache and known-email filter lookups by result',
+    ['cache', 'result'],
+)
+
+_phases = contextvars.ContextVar('request_phases', default=None)
+
+
+def start_request():
+    """
+    Starts phase totals for the current request; returns the token for finish_request().
+    """
+    return _phases.set(dict.fromkeys(PHASES + ('round_trips',), 0))
+
+
+def record(name, seconds):
+    """
+    Adds `seconds` to phase `name` of the current request, if there is one.
+    """
+    phases = _phases.get()
+    if phases is not None:
+        phases[name] += seconds
+
+
+def record_round_trip(seconds=0.0):
+    """
+    Counts a statement or commit of the current request, adding its time to 'db'.
+    """
+    phases = _phases.get()
+    if phases is not None:
+        phases['db'] += seconds
+        phases['round_trips'] += 1
+
+
+@contextlib.contextmanager
+def phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def finish_request(token, endpoint, method, status, seconds, config):
+    """
+    Records a finished request and ends its phase totals.
+    """
+    phases = _phases.get()
+    _phases.reset(token)
+    if phases is None:
+        return
+    round_trips = phases.pop('round_trips')
+    REQUEST_SECONDS.labels(endpoint, method, str(status)).observe(seconds)
+    DB_ROUND_TRIPS.labels(endpoint).observe(round_trips)
+    for name, spent in phases.items():
+        PHASE_SECONDS.labels(endpoint, name).observe(spent)
+
+    slow = config.get('SLOW_REQUEST_SECONDS', METRICS_DEFAULTS['SLOW_REQUEST_SECONDS'])
+    if slow is not None and seconds >= slow:
+        other = seconds - sum(phases.values())
+        breakdown = ' '.join(f"{name}={spent * 1000:.1f}ms" for name, spent in phases.items())
+        logger.warning(f"Slow request {method} {endpoint} {status} {seconds * 1000:.1f}ms: "
+                       f"{breakdown} other={other * 1000:.1f}ms round_trips={round_trips}")
+
+
+def count_lookup(cache, result):
+    CACHE_LOOKUPS.labels(cache, result).inc()
+
+
+def instrument_engine(engine):
+    """
+    Times every statement an engine (sync, or an async engine's
+    sync_engine) runs into the 'db' phase, and counts statements and
+    commits as round trips.
+    """
+    @sqlalchemy.event.listens_for(engine, 'before_cursor_execute')
+    def start_statement(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('statement_start', []).append(time.perf_counter())
+
+    @sqlalchemy.event.listens_for(engine, 'after_cursor_execute')
+    def end_statement(conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get('statement_start')
+        if starts:
+            record_round_trip(time.perf_counter() - starts.pop())
+
+    @sqlalchemy.event.listens_for(engine, 'commit')
+    def count_commit(conn):
+        record_round_trip()
+
+
+class TimedJWTManager(JWTManager):
+    """
+    JWTManager that times token encoding and decoding into the current
+    request's phases. Both servers create and verify tokens through it.
+    """
+
+    def _encode_jwt_from_config(self, *args, **kwargs):
+        with phase('jwt_encode'):
+            return super()._encode_jwt_from_config(*args, **kwargs)
+
+    def _decode_jwt_from_config(self, *args, **kwargs):
+        with phase('jwt_decode'):
+            return super()._decode_jwt_from_config(*args, **kwargs)
+
+
+def metrics_payload():
+    """
+    The Prometheus text exposition and its content type; all workers'
+    metrics when PROMETHEUS_MULTIPROC_DIR is set.
+    """
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,170 @@
+import asyncio
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+import click
+from flask import current_app
+
+from util import metrics
+from util.utils import DEFAULT_ROUNDS, calibrate_rounds
+
+logger = logging.getLogger()
+
+# bcrypt releases the GIL while hashing, so a thread pool is enough to spread
+# password work across cores without blocking other request threads.
+PASSWORD_POOL_DEFAULTS = {
+    # Threads doing bcrypt work; defaults to the number of CPUs.
+    'PASSWORD_WORKERS': None,
+    # Tasks allowed to wait for a free worker before new ones are refused.
+    'PASSWORD_QUEUE_DEPTH': 16,
+    # Seconds a request waits for its result before giving up.
+    'PASSWORD_TIMEOUT': 10,
+    # Value of the Retry-After header sent when the pool is full.
+    'PASSWORD_RETRY_AFTER': 1,
+}
+
+
+class PasswordPoolSaturated(Exception):
+    """
+    Raised when the password pool is full or a task waited too long.
+    """
+
+    def __init__(self, retry_after):
+        super().__init__("Password pool saturated")
+        self.retry_after = retry_after
+
+
+class PasswordPool:
+    """
+    Size-limited executor for password hashing and verification.
+
+    At most `workers + queue_depth` tasks are admitted at once; anything
+    beyond that is refused immediately rather than queued.
+    """
+
+    def __init__(self, workers, queue_depth, timeout, retry_after):
+        self.workers = workers
+        self.capacity = workers + queue_depth
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password')
+        self._slots = threading.BoundedSemaphore(self.capacity)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self.rejected = 0
+
+    def _release(self, future):
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+    def submit(self, fn, *args):
+        """
+        Admits `fn(*args)` or raises PasswordPoolSaturated. Returns a future.
+        """
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise PasswordPoolSaturated(self.retry_after)
+        with self._lock:
+            self._in_flight += 1
+        try:
+            future = self._executor.submit(fn, *args)
+        except Exception:
+            self._release(None)
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    def run(self, fn, *args):
+        """
+        Runs `fn(*args)` on the pool and waits for the result.
+        """
+        future = self.submit(fn, *args)
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise PasswordPoolSaturated(self.retry_after)
+
+    def status(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'capacity': self.capacity,
+                'in_flight': self._in_flight,
+                'rejected': self.rejected,
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+# One pool per process; worker threads do not survive a fork.
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_password_pool(config):
+    """
+    Returns the process-wide password pool, creating it from `config` on first use.
+    """
+    global _pool, _pool_pid
+    if _pool is not None and _pool_pid == os.getpid():
+        return _pool
+
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            setting = lambda key: config.get(key, PASSWORD_POOL_DEFAULTS[key])
+            _pool = PasswordPool(
+                workers=setting('PASSWORD_WORKERS') or os.cpu_count() or 1,
+                queue_depth=setting('PASSWORD_QUEUE_DEPTH'),
+                timeout=setting('PASSWORD_TIMEOUT'),
+                retry_after=setting('PASSWORD_RETRY_AFTER'),
+            )
+            _pool_pid = os.getpid()
+            logger.info(f"Created password pool with {_pool.workers} workers in process {_pool_pid}")
+    return _pool
+
+
+def run_password_task(fn, *args):
+    """
+    Runs a password function (hash_password, check_password) on the pool of
+    the current app. Raises PasswordPoolSaturated when over capacity.
+    """
+    with metrics.phase('bcrypt'):
+        return get_password_pool(current_app.config).run(fn, *args)
+
+
+async def run_password_task_async(config, fn, *args):
+    """
+    asyncio variant of run_password_task: awaits the pool without blocking
+    the event loop.
+    """
+    pool = get_password_pool(config)
+    with metrics.phase('bcrypt'):
+        future = pool.submit(fn, *args)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), pool.timeout)
+        except asyncio.TimeoutError:
+            raise PasswordPoolSaturated(pool.retry_after)
+
+
+def bcrypt_rounds():
+    """
+    Work factor for new hashes in the current app (BCRYPT_ROUNDS).
+    """
+    return current_app.config.get('BCRYPT_ROUNDS', DEFAULT_ROUNDS)
+
+
+@click.command('calibrate-bcrypt')
+@click.option('--target-ms', default=250.0, show_default=True,
+              help='Time budget for one hash on this machine.')
+def calibrate_bcrypt_command(target_ms):
+    """Pick a BCRYPT_ROUNDS value that hashes within a time budget."""
+    rounds, timings = calibrate_rounds(target_ms)
+    for cost, ms in timings.items():
+        click.echo(f"rounds={cost:<3d}{ms:>10.2f} ms/hash")
+    click.echo(f"BCRYPT_ROUNDS = {rounds}")
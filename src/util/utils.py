@@ -1,23 +1,92 @@
+import functools
+import time
+
 import bcrypt
 
-def hash_password(password):
+# bcrypt work factor used when BCRYPT_ROUNDS is not configured
+DEFAULT_ROUNDS = 12
+
+
+def hash_password(password, rounds=DEFAULT_ROUNDS):
     """
     Inputs:
     - password (str)
+    - rounds (int): bcrypt work factor, each step doubles the cost
 
     Returns:
     - (str): hashed pass for storage
     """
-    salt = bcrypt.gensalt()
+    salt = bcrypt.gensalt(rounds=rounds)
     return bcrypt.hashpw(password.encode('utf-8'), salt).decode('utf-8')
 
 def check_password(user_password,hashed_password):
     """
     Inputs:
     - user_password (str): password presented by user for verification
-    - hashed_password (str): hashed pass in table 
+    - hashed_password (str): hashed pass in table
 
     Returns:
     - (bool): True if valid pass
     """
-    return bcrypt.checkpw(user_password.encode('utf-8'), hashed_password.encode('utf-8'))
\ No newline at end of file
+    return bcrypt.checkpw(user_password.encode('utf-8'), hashed_password.encode('utf-8'))
+
+@functools.lru_cache(maxsize=4)
+def dummy_hash(rounds=DEFAULT_ROUNDS):
+    """
+    Inputs:
+    - rounds (int): bcrypt work factor
+
+    Returns:
+    - (str): a hash no real password is checked against; verifying it costs
+      the same as verifying a user's, so unknown emails take as long
+    """
+    return hash_password('no-such-user', rounds)
+
+def hash_rounds(hashed_password):
+    """
+    Inputs:
+    - hashed_password (str): bcrypt hash, e.g. '$2b$12$...'
+
+    Returns:
+    - (int): work factor the hash was made with, None if unrecognised
+    """
+    try:
+        return int(hashed_password.split('$')[2])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+def needs_rehash(hashed_password, rounds):
+    """
+    Inputs:
+    - hashed_password (str): hashed pass in table
+    - rounds (int): work factor currently configured
+
+    Returns:
+    - (bool): True if the hash was made with a different work factor
+    """
+    current = hash_rounds(hashed_password)
+    return current is not None and current != rounds
+
+def calibrate_rounds(target_ms, min_rounds=4, max_rounds=16, samples=3):
+    """
+    Inputs:
+    - target_ms (float): time budget for one hash on this machine
+    - min_rounds, max_rounds (int): bounds of the search
+    - samples (int): hashes timed per work factor
+
+    Returns:
+    - (int, dict): the highest work factor within budget (at least min_rounds)
+      and the measured milliseconds per hash for each factor tried
+    """
+    timings = {}
+    chosen = min_rounds
+    for rounds in range(min_rounds, max_rounds + 1):
+        start = time.perf_counter()
+        for _ in range(samples):
+            hash_password('calibration-password', rounds)
+        elapsed_ms = (time.perf_counter() - start) * 1000 / samples
+        timings[rounds] = round(elapsed_ms, 2)
+        if elapsed_ms > target_ms:
+            break
+        chosen = rounds
+    return chosen, timings
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The app is imported from src/, as the servers run it
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
@@ -0,0 +1,54 @@
+"""
+Query.execute on the connections each connector hands out. Needs the local
+database from src/instance/.env.py; skipped when it cannot be reached.
+"""
+import os
+
+import pg8000.dbapi
+import pytest
+import sqlalchemy
+from flask import Config
+
+from user.connectors import LocalConnector
+from user.db import Query, build_engine
+
+SELECT_ONE = Query("SELECT CAST(:a AS integer) AS a, CAST(:b AS text) AS b")
+
+
+def local_config(**overrides):
+    config = Config(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src', 'instance'))
+    config.from_pyfile('.env.py')
+    config.update(overrides)
+    return config
+
+
+def engine_for(getconn, config):
+    try:
+        getconn().close()
+    except Exception as e:
+        pytest.skip(f"local database unavailable: {e}")
+    return build_engine(config, getconn)
+
+
+@pytest.mark.parametrize('prepared', [True, False])
+def test_execute_on_pg8000_dbapi_connection(prepared):
+    # What the Cloud SQL connector returns for pg8000
+    config = local_config(DB_PREPARED_STATEMENTS=prepared)
+    kwargs = LocalConnector(config).kwargs
+    engine = engine_for(lambda: pg8000.dbapi.connect(**kwargs), config)
+    with engine.connect() as connection:
+        for _ in range(2):
+            row = SELECT_ONE.execute(connection, {'a': 1, 'b': 'x'}).one()
+            assert row._asdict() == {'a': 1, 'b': 'x'}
+    engine.dispose()
+
+
+def test_execute_on_pg8000_legacy_connection():
+    config = local_config(DB_PREPARED_STATEMENTS=True)
+    engine = engine_for(LocalConnector(config).connect, config)
+    with engine.connect() as connection:
+        for _ in range(2):
+            row = SELECT_ONE.execute(connection, {'a': 2, 'b': 'y'}).one()
+            assert row._asdict() == {'a': 2, 'b': 'y'}
+        assert SELECT_ONE.name in connection.connection.info['prepared_statements']
+    engine.dispose()
@@ -0,0 +1,69 @@
+"""
+KnownEmails state: rebuilds, syncs and the horizon they leave.
+"""
+import pytest
+
+from resources.email_filter import KnownEmails
+
+
+@pytest.fixture
+def known():
+    return KnownEmails(0.001, sync_interval=0, rebuild_interval=3600)
+
+
+def rebuild(known, emails, horizon):
+    assert known.begin_rebuild()
+    bloom = known.new_filter(len(emails))
+    for email in emails:
+        bloom.add(email)
+    known.finish_rebuild(bloom, horizon)
+
+
+def test_every_email_may_exist_until_built(known):
+    assert known.might_exist('a@x.com')
+    assert known.begin_sync() is None
+    rebuild(known, ['a@x.com'], 100)
+    assert known.might_exist('A@x.com')
+    assert not known.might_exist('b@x.com')
+
+
+def test_sync_reads_from_the_horizon_and_moves_it(known):
+    rebuild(known, ['a@x.com'], 100)
+    assert known.begin_sync() == 100
+    known.finish_sync([(2, 'B@x.com')], 120)
+    assert known.might_exist('b@x.com')
+    assert known.begin_sync() == 120
+    # A horizon read before an older one finished never moves it back
+    known.finish_sync([], 110)
+    assert known.horizon == 120
+
+
+def test_sync_is_rate_limited():
+    known = KnownEmails(0.001, sync_interval=60, rebuild_interval=3600)
+    rebuild(known, [], 100)
+    assert known.begin_sync() == 100
+    known.finish_sync([], 120)
+    assert known.begin_sync() is None
+    assert known.stats()['syncs'] == 1
+
+
+def test_rebuild_runs_once_until_due(known):
+    assert known.begin_rebuild()
+    assert not known.begin_rebuild()
+    known.finish_rebuild(None, None)
+    # A failed rebuild leaves the filter as it was and may run again
+    assert known.bloom is None
+    rebuild(known, [], 100)
+    assert not known.begin_rebuild()
+
+
+def test_rebuild_replaces_the_filter_and_horizon(known):
+    rebuild(known, ['a@x.com'], 100)
+    known.add('new@x.com')
+    known.finish_sync([], 150)
+    known.built_at -= known.rebuild_interval
+    rebuild(known, ['c@x.com'], 140)
+    assert not known.might_exist('a@x.com')
+    # Rows from transactions at or above 140 are read again by the next sync
+    assert known.horizon == 140
+    assert known.begin_sync() == 140
@@ -0,0 +1,69 @@
+"""
+The known-email filter against concurrent writers. Needs the local database
+from src/instance/.env.py, migrated (flask init-db); skipped when it cannot
+be reached.
+"""
+import pg8000.dbapi
+import pytest
+
+from resources import email_filter, user_dao
+from user import create_app
+from user.connectors import LocalConnector
+
+INSERT_USERS = """
+    INSERT INTO users (username, email, first_name, last_name, auth_type, password)
+    SELECT 'test-' || %s || n, %s || n || '@x.com', 'a', 'b', 'local', 'x'
+    FROM generate_series(1, 150) AS n;
+"""
+
+
+@pytest.fixture
+def app():
+    app = create_app()
+    app.config['EMAIL_FILTER_SYNC_INTERVAL'] = 0
+    email_filter._known = None
+    yield app
+    email_filter._known = None
+
+
+@pytest.fixture
+def connect(app):
+    kwargs = LocalConnector(app.config).kwargs
+    try:
+        pg8000.dbapi.connect(**kwargs).close()
+    except Exception as e:
+        pytest.skip(f"local database unavailable: {e}")
+    connections = []
+
+    def connect():
+        connections.append(pg8000.dbapi.connect(**kwargs))
+        return connections[-1]
+
+    yield connect
+    for connection in connections:
+        connection.rollback()
+    cleanup = connect()
+    cleanup.cursor().execute("DELETE FROM users WHERE email LIKE 'importa%' OR email LIKE 'importc%';")
+    cleanup.commit()
+    for connection in connections:
+        connection.close()
+
+
+def insert_users(connection, prefix):
+    connection.cursor().execute(INSERT_USERS, (prefix, prefix))
+
+
+def test_sync_finds_rows_committed_after_higher_ids(app, connect):
+    with app.app_context():
+        user_dao.refresh_email_filter(wait=True)
+        writer_c, writer_a = connect(), connect()
+        # C holds the older xid; A's rows get the lower ids and commit last
+        writer_c.cursor().execute("SELECT pg_current_xact_id();")
+        insert_users(writer_a, 'importa')
+        insert_users(writer_c, 'importc')
+        writer_c.commit()
+        assert user_dao.email_may_exist('importc1@x.com')
+        assert not user_dao.email_may_exist('nobody@x.com')
+        writer_a.commit()
+        assert user_dao.email_may_exist('importa1@x.com')
+        assert user_dao.email_may_exist('importA150@x.com')
@@ -0,0 +1,67 @@
+"""
+Login throttle limits at the edges of the sliding window.
+"""
+import pytest
+
+from resources.login_throttle import InProcessCounters, LoginThrottle, LoginThrottled, SlidingWindow
+
+WINDOW = 100
+LIMIT = 5
+
+
+@pytest.fixture
+def window():
+    return SlidingWindow(InProcessCounters(1000, 2 * WINDOW), LIMIT, WINDOW)
+
+
+def attempts(window, count, now):
+    return [window.acquire('k', now)[1] for _ in range(count)]
+
+
+def test_limit_within_one_window(window):
+    assert attempts(window, LIMIT, 100) == [0] * LIMIT
+    # Allowed again once the full window only weighs LIMIT - 1
+    assert window.acquire('k', 100)[0] is None
+    assert window.retry_after('k', 100) == 120
+    assert window.acquire('k', 219)[0] is None
+    assert window.acquire('k', 220)[1] == 0
+
+
+def test_previous_window_counts_by_its_overlap(window):
+    attempts(window, LIMIT, 150)
+    # At the boundary the previous window still counts in full
+    assert window.acquire('k', 200)[0] is None
+    # Half way through, half of it is left: room for two more
+    assert attempts(window, 2, 250) == [0, 0]
+    assert window.acquire('k', 250) == (None, 10)
+    assert window.acquire('k', 259)[0] is None
+    assert window.acquire('k', 260)[1] == 0
+
+
+def test_windows_before_the_previous_are_ignored(window):
+    attempts(window, LIMIT, 150)
+    assert attempts(window, LIMIT, 300) == [0] * LIMIT
+
+
+def test_refused_attempts_are_not_counted(window):
+    attempts(window, LIMIT, 100)
+    for _ in range(10):
+        window.acquire('k', 150)
+    assert window.counters.get('k:1') == LIMIT
+
+
+def test_success_clears_email_failures_but_not_the_client():
+    # On the clock: a window long enough not to roll over mid-test
+    window = 10 ** 6
+    counters = InProcessCounters(1000, 2 * window)
+    throttle = LoginThrottle(SlidingWindow(counters, 2, window), SlidingWindow(counters, 3, window))
+    throttle.reserve('A@x.com', 'client')
+    attempt = throttle.reserve('a@x.com', 'client')
+    with pytest.raises(LoginThrottled):
+        throttle.reserve('a@x.com', 'client')
+    throttle.record_success('a@x.com', attempt)
+    throttle.reserve('a@x.com', 'client')
+    # The client keeps its first failure; the successful attempt was given back
+    throttle.reserve('b@x.com', 'client')
+    with pytest.raises(LoginThrottled):
+        throttle.reserve('b@x.com', 'client')
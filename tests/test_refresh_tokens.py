@@ -0,0 +1,59 @@
+"""
+Refresh token rotation on the in-process and shared stores.
+"""
+import time
+
+import pytest
+
+from resources.refresh_tokens import RefreshTokenRejected, RefreshTokens, SharedStore
+from resources.user_cache import ExpiringStore, LocalClient
+
+LIFETIME = 3600
+
+
+@pytest.fixture(params=['memory', 'shared'])
+def tokens(request):
+    store = ExpiringStore(LIFETIME) if request.param == 'memory' else SharedStore(LocalClient())
+    return RefreshTokens(store, LIFETIME)
+
+
+def token_claims(session, jti):
+    return dict(session, jti=jti, exp=time.time() + LIFETIME)
+
+
+def test_rotation_keeps_the_session(tokens):
+    session = RefreshTokens.new_family()
+    assert tokens.rotate(token_claims(session, 'a'), 7) == session
+    assert tokens.rotate(token_claims(session, 'b'), 7) == session
+    assert tokens.stats() == {'rotated': 2, 'reused': 0}
+
+
+def test_reused_token_revokes_its_family(tokens):
+    session, other = RefreshTokens.new_family(), RefreshTokens.new_family()
+    tokens.rotate(token_claims(session, 'a'), 7)
+    tokens.rotate(token_claims(other, 'x'), 7)
+    with pytest.raises(RefreshTokenRejected, match='reused'):
+        tokens.rotate(token_claims(session, 'a'), 7)
+    # The successor the legitimate client holds is refused too
+    with pytest.raises(RefreshTokenRejected, match='revoked'):
+        tokens.rotate(token_claims(session, 'b'), 7)
+    # Other sessions of the user carry on
+    assert tokens.rotate(token_claims(other, 'y'), 7) == other
+    assert tokens.stats()['reused'] == 1
+
+
+def test_revoke_user_ends_sessions_started_before(tokens):
+    session = RefreshTokens.new_family()
+    session['fat'] -= 1
+    tokens.revoke_user(7)
+    with pytest.raises(RefreshTokenRejected, match='revoked'):
+        tokens.rotate(token_claims(session, 'a'), 7)
+    assert tokens.rotate(token_claims(session, 'b'), 8) == session
+    later = RefreshTokens.new_family()
+    later['fat'] += 1
+    assert tokens.rotate(token_claims(later, 'c'), 7) == later
+
+
+def test_token_without_session_is_refused(tokens):
+    with pytest.raises(RefreshTokenRejected):
+        tokens.rotate({'jti': 'a', 'exp': time.time() + LIFETIME}, 7)
@@ -0,0 +1,55 @@
+"""
+KeyRing verification across a signing key rotation.
+"""
+import jwt
+import pytest
+from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
+
+from resources.signing_keys import KeyRing
+
+
+@pytest.fixture(scope='module')
+def old_key():
+    return ed25519.Ed25519PrivateKey.generate()
+
+
+@pytest.fixture(scope='module')
+def new_key():
+    return ed25519.Ed25519PrivateKey.generate()
+
+
+def sign(ring, claims):
+    return jwt.encode(claims, ring.signing_key, algorithm=ring.algorithm, headers={'kid': ring.signing_kid})
+
+
+def verify(ring, token):
+    key = ring.verification_key(jwt.get_unverified_header(token))
+    return jwt.decode(token, key, algorithms=[ring.algorithm])
+
+
+def test_retired_key_still_verifies(old_key, new_key):
+    before = KeyRing([old_key], 'EdDSA', 3600)
+    token = sign(before, {'sub': '7'})
+    # Step 2 of a rotation: the new key signs, the old one only verifies
+    after = KeyRing([new_key, old_key], 'EdDSA', 3600)
+    assert after.signing_kid != before.signing_kid
+    assert verify(after, token) == {'sub': '7'}
+    assert verify(after, sign(after, {'sub': '8'})) == {'sub': '8'}
+
+
+def test_removed_key_is_refused(old_key, new_key):
+    token = sign(KeyRing([old_key], 'EdDSA', 3600), {'sub': '7'})
+    with pytest.raises(jwt.InvalidTokenError, match='unknown key'):
+        verify(KeyRing([new_key], 'EdDSA', 3600), token)
+
+
+def test_algorithm_must_match_the_key(old_key):
+    ring = KeyRing([old_key], 'EdDSA', 3600)
+    with pytest.raises(jwt.InvalidTokenError):
+        ring.verification_key({'kid': ring.signing_kid, 'alg': 'RS256'})
+
+
+def test_first_key_must_match_the_algorithm(old_key):
+    rsa_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    with pytest.raises(ValueError):
+        KeyRing([rsa_key, old_key], 'EdDSA', 3600)
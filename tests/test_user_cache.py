@@ -0,0 +1,40 @@
+"""
+UserCache invalidation against loads that read the row before a write.
+"""
+import time
+
+import pytest
+
+from resources.user_cache import InProcessBackend, LocalClient, SharedBackend, UserCache
+
+OLD = {'id': 7, 'username': 'old'}
+NEW = {'id': 7, 'username': 'new'}
+
+
+@pytest.fixture(params=['memory', 'shared'])
+def cache(request):
+    backend = InProcessBackend(100, 60) if request.param == 'memory' else SharedBackend(LocalClient(), 60)
+    return UserCache(backend, invalidation_hold=1)
+
+
+def test_stale_load_during_hold_is_not_cached(cache):
+    cache.store(7, OLD)
+    # A load reads OLD, an update commits and invalidates, then the load stores
+    cache.invalidate(7)
+    cache.store(7, OLD)
+    assert cache.lookup(7) is None
+    assert cache.get_or_load(7, lambda: NEW) == NEW
+    assert cache.lookup(7) is None
+
+
+def test_loads_are_cached_after_the_hold(cache):
+    cache.invalidate(7)
+    time.sleep(1.1)
+    cache.store(7, NEW)
+    assert cache.lookup(7) == NEW
+
+
+def test_cached_row_is_not_replaced_by_a_load(cache):
+    cache.store(7, NEW)
+    cache.store(7, OLD)
+    assert cache.get_or_load(7, lambda: OLD) == NEW